@@ -1,35 +1,91 @@
 import os
+import re
+import json
 import time
-from threading import Thread
+import random
+import asyncio
+from typing import List, Tuple, Dict, Optional
 from abc import ABCMeta, abstractmethod
-from subprocess import run, PIPE, STDOUT
+from subprocess import PIPE, STDOUT, DEVNULL
 
 import jinja2
 
 from config import SiteConfig
+from executor import ActionResult
 from utils import SimpleLog, _Single
 
 log = SimpleLog(__name__).log
 
 
-class AbstractAction(Thread, metaclass=ABCMeta):
+# PLAY RECAP中每个主机一行: "10.0.0.1 : ok=2 changed=1 unreachable=0 failed=0 skipped=0 ..."
+_RECAP_RE = re.compile(r"^(\S+)\s+:\s+ok=(\d+)\s+changed=(\d+)\s+unreachable=(\d+)\s+failed=(\d+)", re.M)
+
+
+def parse_recap(output: str) -> Dict[str, bool]:
+    """主机 -> 是否成功(没有unreachable与failed)，不在PLAY RECAP中的主机没有结果"""
+    return {match.group(1): match.group(4) == "0" and match.group(5) == "0"
+            for match in _RECAP_RE.finditer(output)}
+
+
+def _recap_name(host: str) -> str:
+    """站点的主机为ip:port，PLAY RECAP中是不带端口的inventory主机名"""
+    address, _, port = host.rpartition(":")
+    return address if address and port.isdigit() else host
+
+
+class AbstractAction(metaclass=ABCMeta):
+    """
+    恢复动作，由executor.ActionExecutor在事件循环中执行。
+    batch_key相同的动作可以由run_batch()合并为一次执行，batch_key为None的动作总是单独执行
+    """
     def __init__(self, conf: SiteConfig, host: str):
-        Thread.__init__(self)
         self.conf = conf
         # host是错误的主机
         self.host = host
 
+    @property
+    def batch_key(self) -> Optional[Tuple[str, str]]:
+        return None
+
+    def _result(self, ok: bool, returncode: int, start: float, **kwargs) -> ActionResult:
+        return ActionResult(self.conf.name, self.host, ok, returncode, time.time() - start, **kwargs)
+
     @staticmethod
-    def run_playbook(playbook: str) -> str:
-        cmd = "ansible-playbook {}".format(playbook)
-        stdout = run(cmd, shell=True, stdout=PIPE, stderr=STDOUT).stdout
+    async def exec_playbook(playbook: str, timeout: float, forks: int = 0) -> Tuple[int, str, bool]:
+        """不经过shell执行ansible-playbook，返回(返回码, 输出, 是否超时)，超时或被取消时结束进程"""
+        argv = ["ansible-playbook", playbook] + (["--forks", str(forks)] if forks else [])
+        proc = await asyncio.create_subprocess_exec(*argv, stdin=DEVNULL, stdout=PIPE, stderr=STDOUT)
+        try:
+            stdout, _ = await asyncio.wait_for(proc.communicate(), timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            log.error(f"{playbook}执行超过{timeout}秒，已结束")
+            return proc.returncode, "", True
+        except asyncio.CancelledError:
+            proc.kill()
+            await asyncio.shield(proc.wait())
+            raise
         output = stdout.decode("utf8", errors="ignore")
-        return output
+        log.debug(f"action log: {output}")
+        return proc.returncode, output, False
+
+    def write_playbook(self, tmpl: str, **kwargs) -> str:
+        _filename = "{}_{}_{}.yml".format(self.conf.name, self.host, time.time())
+        task_file = os.path.join(os.path.pardir, "tasks_yaml", _filename)
+        with open(task_file, 'w') as f:
+            f.write(jinja2.Template(tmpl).render(**kwargs))
+        return task_file
 
     @abstractmethod
-    def run(self) -> None:
+    async def run(self, timeout: float) -> ActionResult:
         pass
 
+    @classmethod
+    async def run_batch(cls, actions: List["AbstractAction"], timeout: float, forks: int) -> List[ActionResult]:
+        """按actions的顺序返回每个主机的结果，默认逐个执行"""
+        return [await action.run(timeout) for action in actions]
+
 
 class AbstractActionFactory(_Single, metaclass=ABCMeta):
     @staticmethod
@@ -38,10 +94,43 @@ class AbstractActionFactory(_Single, metaclass=ABCMeta):
         pass
 
 
-class RestartProcessAction(AbstractAction):
+class _PlaybookAction(AbstractAction):
+    """
+    渲染_tmpl并执行ansible-playbook的动作，hosts为主机列表。同一站点的同类动作合并为一个playbook，
+    由ansible按forks并行执行，每个主机的结果从PLAY RECAP中解析
+    """
+    _tmpl = ""
+
+    @property
+    def batch_key(self) -> Optional[Tuple[str, str]]:
+        return self.conf.name, type(self).__name__
+
+    def render(self, hosts: List[str]) -> str:
+        return self.write_playbook(self._tmpl, hosts=json.dumps(hosts), name=self.conf.name)
+
+    async def run(self, timeout: float) -> ActionResult:
+        return (await self.run_batch([self], timeout, 0))[0]
+
+    @classmethod
+    async def run_batch(cls, actions: List["_PlaybookAction"], timeout: float, forks: int) -> List[ActionResult]:
+        start = time.time()
+        task_file = actions[0].render([action.host for action in actions])
+        returncode, output, timed_out = await cls.exec_playbook(task_file, timeout, forks)
+        if timed_out:
+            return [action._result(False, returncode, start, timeout=True) for action in actions]
+        hosts = parse_recap(output)
+        if len(actions) > 1:
+            log.info(f"{actions[0].conf.name}合并{len(actions)}个主机执行{cls.__name__}, "
+                     f"成功{sum(hosts.values())}, 返回码{returncode}")
+        # 单个主机的动作没有PLAY RECAP(例如playbook语法错误)时按返回码判断
+        single = returncode == 0 and len(actions) == 1
+        return [action._result(hosts.get(_recap_name(action.host), hosts.get(action.host, single)), returncode, start,
+                               output=output) for action in actions]
+
+
+class RestartProcessAction(_PlaybookAction):
     _tmpl = r"""        
-              - hosts:
-                - {{ host }}
+              - hosts: {{ hosts }}
                 gather_facts: False
                 tasks:
                 - name: Restart Process {{ name }}
@@ -59,37 +148,62 @@ class RestartProcessAction(AbstractAction):
     def __repr__(self) -> str:
         return f"RestartProcessAction({self.conf.recover.name})"
 
-    def run(self) -> None:
-        _filename = "{}_{}_{}.yml".format(self.conf.name, self.host, time.time())
-        task_file = os.path.join(os.path.pardir, "tasks_yaml", _filename)
-        with open(task_file, 'w') as f:
-            f.write(jinja2.Template(self._tmpl).render(host=self.host, name=self.conf.name))
-        logs = self.run_playbook(task_file)
-        log.debug(f"action log: {logs}")
 
-
-class RestartIISWebsiteAction(AbstractAction):
+class RestartIISWebsiteAction(_PlaybookAction):
     _tmpl = r"""        
-           - hosts:
-             - {{ host }}
+           - hosts: {{ hosts }}
              gather_facts: False
              tasks:
              - name: Restart IIS Website {{ name }}
                win_iis_website: name={{ name }} state=restarted
            """
 
-    def run(self) -> None:
-        _filename = "{}_{}_{}.yml".format(self.conf.name, self.host, time.time())
-        task_file = os.path.join(os.path.pardir, "tasks_yaml", _filename)
-        with open(task_file, 'w') as f:
-            f.write(jinja2.Template(self._tmpl).render(name=self.conf.name, host=self.host))
-        logs = self.run_playbook(task_file)
-        log.debug(f"action log: {logs}")
-
     def __repr__(self) -> str:
         return f"RestartIISWebsiteAction({self.conf.name}, {self.host})"
 
 
+class SimulatedAction(AbstractAction):
+    """
+    压测用的模拟动作，不执行ansible: 按recover.latency秒等待，按recover.failure_rate随机失败，
+    每次执行记录在类属性operations中(站点, 主机, 开始时间, 结束时间, 是否成功)，所有站点共用。
+    与playbook动作一样按站点合并，合并后整批只等待一次，runs为实际的执行次数
+    """
+    operations: List[Tuple[str, str, float, float, bool]] = list()
+    runs = 0
+
+    def __repr__(self) -> str:
+        return f"SimulatedAction({self.conf.name}, {self.host})"
+
+    @property
+    def batch_key(self) -> Optional[Tuple[str, str]]:
+        return self.conf.name, "simulated"
+
+    @classmethod
+    def reset(cls):
+        cls.operations = list()
+        cls.runs = 0
+
+    async def run(self, timeout: float) -> ActionResult:
+        return (await self.run_batch([self], timeout, 0))[0]
+
+    @classmethod
+    async def run_batch(cls, actions: List["SimulatedAction"], timeout: float, forks: int) -> List[ActionResult]:
+        start = time.time()
+        cls.runs += 1
+        try:
+            await asyncio.wait_for(asyncio.sleep(actions[0].conf.recover.latency), timeout)
+            timed_out = False
+        except asyncio.TimeoutError:
+            timed_out = True
+        results = list()
+        for action in actions:
+            ok = not timed_out and random.random() >= action.conf.recover.failure_rate
+            cls.operations.append((action.conf.name, action.host, start, time.time(), ok))
+            log.debug(f"simulated action {action.conf.name} {action.host}, result: {ok}")
+            results.append(action._result(ok, 0 if ok else 1, start, timeout=timed_out))
+        return results
+
+
 class ActionFactory(AbstractActionFactory):
     @staticmethod
     def create_action(site_conf: SiteConfig, host: str) -> AbstractAction:
@@ -97,4 +211,6 @@ class ActionFactory(AbstractActionFactory):
             return RestartProcessAction(site_conf, host)
         elif site_conf.recover.type == "restart_iis":
             return RestartIISWebsiteAction(site_conf, host)
+        elif site_conf.recover.type == "simulated":
+            return SimulatedAction(site_conf, host)
         raise Exception("No support action")
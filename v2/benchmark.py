@@ -0,0 +1,632 @@
+"""
+本地压测，后端均为mock_server.py启动的替身服务，不依赖config.yml与真实网关
+
+    python benchmark.py engine --hosts 50 --rounds 20
+    python benchmark.py shard --hosts 200 --workers 4
+    python benchmark.py loop --hosts 500 --rounds 20
+    python benchmark.py store --hosts 50000 --rounds 20
+    python benchmark.py snapshot --hosts 10000
+    python benchmark.py gateway_api --endpoints 2 --rounds 50
+    python benchmark.py nginx_conf --upstreams 200 --hosts 50
+    python benchmark.py slb --hosts 100 --burst 40
+    python benchmark.py e2e --hosts 2000 --failing 0.01
+    python benchmark.py actions --hosts 30
+    python benchmark.py quorum --hosts 30
+"""
+import re
+import sys
+import time
+import os
+import random
+import socket
+import asyncio
+import logging
+import tempfile
+import tracemalloc
+import argparse
+import subprocess
+import multiprocessing
+from typing import List, Tuple
+
+from check import SiteCheck
+from record import SiteRecord
+from store import ArraySiteRecord
+from config import SiteConfig, _DefaultConfig
+from shard import ShardCoordinator
+from snapshot import SnapshotStore, SnapshotConfig
+from gateway import NGINXAPIGateway, AliyunSLBGateway, SimulatedGateway, _SLBClient
+from nginxconf import NGINXConfig
+from limiter import AdmissionController
+from client import ProbeClient, RawProbeClient
+from utils import install_event_loop
+
+
+def _wait_port(port: int, timeout: float = 10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise Exception(f"mock server on {port} not ready")
+
+
+def start_backends(port: int, count: int) -> subprocess.Popen:
+    """替身后端运行在独立进程中，避免把服务端的CPU算到检测端"""
+    proc = subprocess.Popen([sys.executable, "mock_server.py", "backends", "--port", str(port), "--count", str(count)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _port in range(port, port + count):
+        _wait_port(_port)
+    return proc
+
+
+def start_backend_group(port: int, count: int, procs: int) -> Tuple[List[subprocess.Popen], List[str]]:
+    """把count个后端分到procs个替身进程，避免替身服务成为瓶颈"""
+    size = -(-count // procs)
+    backends = [start_backends(_port, min(size, port + count - _port)) for _port in range(port, port + count, size)]
+    return backends, [f"127.0.0.1:{_port}" for _port in range(port, port + count)]
+
+
+async def _bench_engine(engine: str, servers: List[str], rounds: int, method: str):
+    client, raw_client = ProbeClient(), RawProbeClient()
+    check = SiteCheck(hostname="bench.local", path="/", timeout=5, method=method, servers=servers,
+                      client=client, limiter=AdmissionController(), raw_client=raw_client, engine=engine)
+    # 预热，建立连接
+    await check.check_servers()
+    cpu, wall = time.process_time(), time.perf_counter()
+    for _ in range(rounds):
+        await check.check_servers()
+    cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+    probes = rounds * len(servers)
+    print(f"{engine:8} {method:5} {probes:8d} probes {probes / wall:10.0f} probes/s "
+          f"{cpu / probes * 1e6:8.1f} us CPU/probe")
+    await client.close()
+    await raw_client.close()
+
+
+def bench_engine(args):
+    proc = start_backends(args.port, args.hosts)
+    servers = [f"127.0.0.1:{port}" for port in range(args.port, args.port + args.hosts)]
+    try:
+        for method in ("get", "head"):
+            for engine in ("aiohttp", "raw"):
+                asyncio.run(_bench_engine(engine, servers, args.rounds, method))
+    finally:
+        proc.terminate()
+
+
+async def _bench_cycle(servers: List[str], rounds: int, engine: str) -> Tuple[float, float]:
+    client, raw_client = ProbeClient({"limit_per_host": 1}), RawProbeClient({"limit_per_host": 1})
+    check = SiteCheck(hostname="bench.local", path="/", timeout=5, method="get", servers=servers,
+                      client=client, limiter=AdmissionController(), raw_client=raw_client, engine=engine)
+    await check.check_servers()
+    cpu, wall = time.process_time(), time.perf_counter()
+    for _ in range(rounds):
+        await check.check_servers()
+    cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+    await client.close()
+    await raw_client.close()
+    return wall / rounds, cpu / rounds
+
+
+def bench_loop(args):
+    backends, servers = start_backend_group(args.port, args.hosts, args.backends)
+    try:
+        for engine in ("aiohttp", "raw"):
+            for name in ("asyncio", "uvloop"):
+                if install_event_loop(name) != name:
+                    print(f"{name:8} {engine:8} skipped, not installed")
+                    continue
+                cycle, cpu = asyncio.run(_bench_cycle(servers, args.rounds, engine))
+                print(f"{name:8} {engine:8} {len(servers)} hosts cycle {cycle * 1000:8.1f} ms "
+                      f"CPU {cpu * 1000:8.1f} ms/cycle")
+    finally:
+        install_event_loop("asyncio")
+        for proc in backends:
+            proc.terminate()
+
+
+async def _bench_record(record, cycles: List[List[Tuple[int, str]]]) -> float:
+    wall = 0.0
+    for results in cycles:
+        start = time.perf_counter()
+        await record.update(results)
+        await record.get_results()
+        wall += time.perf_counter() - start
+    return wall
+
+
+def bench_store(args):
+    logging.disable(logging.INFO)
+    servers = [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}:80" for i in range(args.hosts)]
+    site = SiteConfig({"site": "bench.local", "inactive": args.hosts,
+                       "gateway": {"type": "static", "servers": servers}}, _DefaultConfig({}), {})
+    random.seed(0)
+    cycles = list()
+    for _ in range(args.rounds):
+        failing = set(random.sample(servers, int(args.hosts * args.failing)))
+        # 与SiteCheck.check_servers一致，结果按site.servers的顺序返回
+        cycles.append([(500 if server in failing else 200, server) for server in site.servers])
+    for name, cls in (("dict", SiteRecord), ("array", ArraySiteRecord)):
+        wall = asyncio.run(_bench_record(cls(site), cycles))
+        # 内存单独测量，避免tracemalloc影响计时
+        tracemalloc.start()
+        record = cls(site)
+        for results in cycles:
+            asyncio.run(record.update(results))
+        size = sum(stat.size for stat in tracemalloc.take_snapshot().statistics("filename")
+                   if stat.traceback[0].filename.endswith(("record.py", "store.py", "utils.py")))
+        tracemalloc.stop()
+        print(f"{name:6} {args.hosts} hosts {wall / args.rounds * 1000:8.1f} ms/cycle "
+              f"state {size / args.hosts:6.1f} bytes/host, {size // 1024} KiB")
+
+
+def bench_snapshot(args):
+    logging.disable(logging.INFO)
+    servers = [f"10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}:80" for i in range(args.hosts)]
+    site = SiteConfig({"site": "bench.local", "inactive": args.hosts // 10, "max_failed": 1,
+                       "gateway": {"type": "static", "servers": servers}}, _DefaultConfig({}), {})
+    # 所有主机都有记录，其中max_inactive个已下线
+    record = SiteRecord(site)
+    asyncio.run(_bench_record(record, [[(500, server) for server in site.servers]]))
+    if os.path.exists(args.file):
+        os.remove(args.file)
+    store = SnapshotStore(SnapshotConfig({"file": args.file}))
+    export, save, restore = list(), list(), list()
+    for _ in range(args.rounds):
+        start = time.perf_counter()
+        states = store.export({site.name: record})
+        export.append(time.perf_counter() - start)
+        store.save(states)
+        save.append(store.save_ms / 1000)
+        asyncio.run(store.restore([site], {site.name: SiteRecord(site)}))
+        restore.append(store.restore_ms / 1000)
+    print(f"{args.hosts} hosts, file {os.path.getsize(args.file) // 1024} KiB")
+    for name, values in (("export", export), ("save", save), ("restore", restore)):
+        print(f"{name:8} min {min(values) * 1000:8.1f} ms  avg {sum(values) / len(values) * 1000:8.1f} ms")
+    os.remove(args.file)
+
+
+def start_upstream_api(port: int, upstream: str, servers: List[str]) -> subprocess.Popen:
+    proc = subprocess.Popen([sys.executable, "mock_server.py", "upstream_api", "--port", str(port),
+                             "--upstream", upstream, "--servers"] + servers,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _wait_port(port)
+    return proc
+
+
+async def _bench_transitions(gateway: NGINXAPIGateway, servers: List[str], rounds: int) -> dict:
+    times = {"down": list(), "up": list()}
+    for server in random.sample(servers, min(rounds, len(servers))):
+        for status in ("down", "up"):
+            start = time.perf_counter()
+            if status == "down":
+                change = await gateway.change_server_offline(server)
+            else:
+                change = await gateway.change_server_online(server)
+            assert change.outcome == "ok", change
+            times[status].append(time.perf_counter() - start)
+    await NGINXAPIGateway.close()
+    return times
+
+
+def bench_gateway_api(args):
+    logging.disable(logging.INFO)
+    servers = [f"10.0.{i >> 8 & 255}.{i & 255}:80" for i in range(args.hosts)]
+    procs = [start_upstream_api(port, "backend", servers) for port in range(args.port, args.port + args.endpoints)]
+    try:
+        endpoints = [f"http://127.0.0.1:{port}/api/9" for port in range(args.port, args.port + args.endpoints)]
+        gateway = NGINXAPIGateway({"type": "nginx_api", "upstream": "backend"}, {"endpoints": endpoints})
+        start = time.perf_counter()
+        found = gateway.get_servers()
+        print(f"discovery {len(found)} servers from {args.endpoints} endpoints {(time.perf_counter() - start) * 1000:.1f} ms")
+        random.seed(0)
+        times = asyncio.run(_bench_transitions(gateway, servers, args.rounds))
+        for status, values in times.items():
+            values.sort()
+            print(f"{status:5} p50 {values[len(values) // 2] * 1000:6.1f} ms  p95 {values[int(len(values) * 0.95)] * 1000:6.1f} ms"
+                  f"  max {values[-1] * 1000:6.1f} ms")
+    finally:
+        for proc in procs:
+            proc.terminate()
+
+
+def start_slb_api(port: int, lb_id: str, servers: List[str], delay: float) -> subprocess.Popen:
+    proc = subprocess.Popen([sys.executable, "mock_server.py", "slb_api", "--port", str(port), "--id", lb_id,
+                             "--delay", str(delay), "--servers"] + servers,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    _wait_port(port)
+    return proc
+
+
+async def _bench_slb(gateway: AliyunSLBGateway, servers: List[str], together: bool) -> Tuple[float, int, int]:
+    """返回下线的耗时、SetBackendServers调用次数与请求数"""
+    client, start = gateway._client, time.perf_counter()
+    batches, requests = client.batches, client.requests
+    if together:
+        changes = await asyncio.gather(*[gateway.change_server_offline(server) for server in servers])
+    else:
+        changes = [await gateway.change_server_offline(server) for server in servers]
+    assert all(change.outcome == "ok" for change in changes), changes
+    result = (time.perf_counter() - start, client.batches - batches, client.requests - requests)
+    await asyncio.gather(*[gateway.change_server_online(server) for server in servers])
+    await AliyunSLBGateway.close()
+    return result
+
+
+def bench_slb(args):
+    """同时下线burst个主机: 每个主机单独调用 vs 合并为SetBackendServers批量调用"""
+    logging.disable(logging.INFO)
+    servers = [f"10.0.{i >> 8 & 255}.{i & 255}:80" for i in range(args.hosts)]
+    proc = start_slb_api(args.port, "lb-bench", servers, args.delay)
+    try:
+        endpoint = f"http://127.0.0.1:{args.port}"
+        burst = random.Random(0).sample(servers, args.burst)
+        for name, together in (("per host", False), ("batched", True)):
+            _SLBClient._shared.clear()
+            gateway = AliyunSLBGateway({"type": "slb", "id": "lb-bench", "port": 80},
+                                       {"key": "key", "secret": "secret", "region": "cn-hangzhou",
+                                        "endpoint": endpoint, "batch_window": args.batch_window})
+            start = time.perf_counter()
+            found = gateway.get_servers()
+            discovery = (time.perf_counter() - start) * 1000
+            elapsed, batches, requests = asyncio.run(_bench_slb(gateway, burst, together))
+            print(f"{name:8} {len(found)} servers (discovery {discovery:.1f} ms), offline {args.burst} hosts "
+                  f"{elapsed * 1000:8.1f} ms, {batches} SetBackendServers calls, {requests} requests")
+    finally:
+        proc.terminate()
+
+
+def _failing_backends(port: int, count: int, failing: List[int], start, queue):
+    """替身后端进程: start被设置后failing中的端口开始返回500，结束时通过queue返回每个端口第一次返回500的时间"""
+    from mock_server import MockBackends
+
+    async def _run():
+        backends = MockBackends()
+        await backends.start(port, count)
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, start.wait)
+        first: dict = dict()
+        backends.failing = set(failing)
+        # 只在失败开始后统计，请求计数变化时检查一次
+        while len(first) < len(failing):
+            requests = backends.requests
+            await asyncio.sleep(0.005)
+            if backends.requests != requests:
+                for _port in failing:
+                    first.setdefault(_port, time.time())
+        queue.put(first)
+        await asyncio.Event().wait()
+
+    asyncio.run(_run())
+
+
+def bench_e2e(args):
+    """
+    从后端开始失败到在模拟网关上下线的端到端时间，检测、记录、网关变更与恢复动作都走main.py的流程，
+    网关与动作为SimulatedGateway/SimulatedAction，不需要SSH与ansible
+    """
+    import main
+    from action import SimulatedAction
+    from utils import NotifyFactory
+
+    logging.disable(logging.WARNING)
+    random.seed(0)
+    ports = list(range(args.port, args.port + args.hosts))
+    failing = sorted(random.sample(ports, max(1, int(args.hosts * args.failing))))
+    start, queue = multiprocessing.Event(), multiprocessing.Queue()
+    size = -(-args.hosts // args.backends)
+    procs = [multiprocessing.Process(target=_failing_backends, daemon=True,
+                                     args=(_port, min(size, args.port + args.hosts - _port),
+                                           [p for p in failing if _port <= p < _port + size], start, queue))
+             for _port in range(args.port, args.port + args.hosts, size)]
+    for proc in procs:
+        proc.start()
+    for _port in ports:
+        _wait_port(_port)
+    site = SiteConfig({"site": "bench.local", "max_failed": args.max_failed, "check_interval": 1, "timeout": 2,
+                       "inactive": args.hosts, "engine": "raw",
+                       "recover": {"enable": True, "type": "simulated", "latency": args.action_latency},
+                       "gateway": {"type": "simulated", "count": args.hosts, "port": args.port}},
+                      _DefaultConfig({}), {"simulated": {"latency": args.gateway_latency, "seed": 0}})
+    gateway: SimulatedGateway = site.gateway
+    notify = NotifyFactory.get_notify([])
+
+    async def _dispatch(_site, check_results, error_hosts):
+        await main.handle_results(_site, notify, check_results, error_hosts)
+
+    async def _run() -> float:
+        task = asyncio.ensure_future(main.run_sites([site], _dispatch))
+        # 预热两个周期，建立连接
+        await asyncio.sleep(2)
+        injected = time.time()
+        start.set()
+        targets = {f"127.0.0.1:{p}" for p in failing}
+        deadline = injected + args.timeout
+        while not targets <= gateway.offline and time.time() < deadline:
+            await asyncio.sleep(0.05)
+        # 等待排队的恢复动作完成
+        await asyncio.sleep(0.1)
+        while main.executor.busy and time.time() < deadline:
+            await asyncio.sleep(0.05)
+        task.cancel()
+        return injected
+
+    injected = asyncio.run(_run())
+    first = dict()
+    for _ in procs:
+        first.update({f"127.0.0.1:{p}": at for p, at in queue.get(timeout=10).items()})
+    for proc in procs:
+        proc.terminate()
+    removed = {server: gateway.changed_at(server, "down") for server in first}
+    done = sorted(at - first[server] for server, at in removed.items() if at)
+    wrong = gateway.offline - set(first)
+    print(f"{args.hosts} hosts, {len(failing)} failing, max_failed={args.max_failed}, "
+          f"gateway latency {args.gateway_latency * 1000:.0f} ms")
+    if done:
+        print(f"first failed probe -> removed: p50 {done[len(done) // 2]:.2f}s  "
+              f"p95 {done[int(len(done) * 0.95)]:.2f}s  max {done[-1]:.2f}s  "
+              f"(injection -> first failed probe max {max(first.values()) - injected:.2f}s)")
+    print(f"removed {len(done)}/{len(failing)}, wrongly removed {len(wrong)}, gateway operations "
+          f"{len(gateway.operations)}, actions {len(SimulatedAction.operations)} in {SimulatedAction.runs} runs")
+
+
+# 替身ansible-playbook: 启动(解析inventory、建立连接)耗时startup秒，每个主机per_host秒，按--forks并行，
+# 与ansible一样在PLAY RECAP中输出不带端口的inventory主机名
+_STUB_ANSIBLE = """#!{python}
+import sys, time, json
+lines = open(sys.argv[1]).read().splitlines()
+hosts = json.loads(next(line for line in lines if "- hosts:" in line).split("hosts:", 1)[1])
+forks = int(sys.argv[sys.argv.index("--forks") + 1]) if "--forks" in sys.argv else 5
+time.sleep({startup} + {per_host} * -(-len(hosts) // forks))
+print("PLAY RECAP")
+for host in hosts:
+    print(host.rpartition(":")[0] + " : ok=1 changed=1 unreachable=0 failed=0 skipped=0")
+"""
+
+
+async def _bench_actions(executor, site: SiteConfig, hosts: List[str]) -> float:
+    done = list()
+    executor.add_listener(done.append)
+    worker = asyncio.ensure_future(executor.run())
+    start = time.perf_counter()
+    for host in hosts:
+        executor.submit(site, host)
+    while len(done) < len(hosts):
+        await asyncio.sleep(0.01)
+    worker.cancel()
+    assert all(result.ok for result in done), done
+    return time.perf_counter() - start
+
+
+def bench_actions(args):
+    """同时下线的主机各自执行一次ansible-playbook vs 按站点合并为一个playbook"""
+    from action import ActionFactory
+    from executor import ActionExecutor, ActionConfig
+
+    logging.disable(logging.WARNING)
+    workdir = tempfile.mkdtemp()
+    stub = os.path.join(workdir, "ansible-playbook")
+    with open(stub, "w") as f:
+        f.write(_STUB_ANSIBLE.format(python=sys.executable, startup=args.startup, per_host=args.per_host))
+    os.chmod(stub, 0o755)
+    os.environ["PATH"] = workdir + os.pathsep + os.environ["PATH"]
+    # playbook写在../tasks_yaml中
+    os.makedirs(os.path.join(workdir, "tasks_yaml"))
+    os.makedirs(os.path.join(workdir, "run"))
+    os.chdir(os.path.join(workdir, "run"))
+    hosts = [f"10.0.0.{i}:80" for i in range(1, args.hosts + 1)]
+    site = SiteConfig({"site": "bench.local", "recover": {"enable": True, "type": "restart_iis"},
+                       "gateway": {"type": "static", "servers": hosts}}, _DefaultConfig({}), {})
+    for name, window in (("per host", 0), ("batched", args.batch_window)):
+        executor = ActionExecutor(ActionConfig({"concurrency": args.concurrency, "batch_window": window,
+                                                "forks": args.forks}), ActionFactory.create_action)
+        elapsed = asyncio.run(_bench_actions(executor, site, hosts))
+        print(f"{name:8} {args.hosts} hosts {elapsed:6.2f}s, {executor.runs} ansible-playbook runs "
+              f"(concurrency {args.concurrency}, forks {args.forks})")
+
+
+def bench_quorum(args):
+    """
+    三个实例在进程内交换判定(不经过UDP)，开启share_load，所有主机都失败:
+    每个主机都要由站点的leader下线，输出下线所需的周期数与每个实例的检测次数
+    """
+    import json
+    import zlib
+    from quorum import QuorumGate, QuorumConfig
+
+    logging.disable(logging.WARNING)
+    members = {f"m{i}": f"127.0.0.1:{args.port + i}" for i in range(1, args.members + 1)}
+    site = SiteConfig({"site": "bench.local", "max_failed": args.max_failed, "inactive": args.hosts,
+                       "gateway": {"type": "simulated", "count": args.hosts, "port": 8000}},
+                      _DefaultConfig({}), {"simulated": {}})
+    servers = sorted(site.servers)
+    instances = dict()
+    for name in members:
+        gate = QuorumGate(QuorumConfig({"enable": True, "instance": name, "members": members,
+                                        "quorum": args.quorum, "share_load": True}))
+        # 跳过启动后等待其他实例上报的ttl
+        gate._started -= gate.conf.ttl
+        record = SiteRecord(site)
+        record.quorum = gate
+        instances[name] = gate, record, [0]
+
+    def exchange():
+        for name, (gate, _, _) in instances.items():
+            for packet in gate._encode():
+                message = json.loads(zlib.decompress(packet))
+                for peer, (other, _, _) in instances.items():
+                    if peer != name:
+                        other.receive(message)
+
+    async def cycle() -> set:
+        offline = set()
+        for gate, record, probes in instances.values():
+            assigned = [server for server in servers if gate.assigned(site.name, server)]
+            probes[0] += len(assigned)
+            await record.update([(500, server) for server in assigned])
+            gate.publish(site.name, record.get_failed_hosts())
+            offline.update(result.host for result in await record.get_results() if result.action == "offline")
+        exchange()
+        return offline
+
+    exchange()
+    leader = instances["m1"][0].leader(site.name)
+    done, cycles = set(), 0
+    while len(done) < len(servers) and cycles < args.cycles:
+        done |= asyncio.run(cycle())
+        cycles += 1
+    probes = {name: item[2][0] for name, item in instances.items()}
+    print(f"leader {leader}: {len(done)}/{len(servers)} hosts offline in {cycles} cycles, probes {probes}")
+    assert len(done) == len(servers), sorted(set(servers) - done)
+
+
+def bench_nginx_conf(args):
+    """每个站点单独过滤整个配置文件(原来每个站点一次sed) vs 解析一次后按端口查询"""
+    lines = []
+    for u in range(args.upstreams):
+        lines.append(f"upstream site{u} {{")
+        for i in range(args.hosts):
+            prefix = "#" if i % 10 == 0 else ""
+            lines.append(f"    {prefix}server 10.{u >> 8 & 255}.{u & 255}.{i}:{8000 + u} weight=1 max_fails=3;")
+        lines.append("}")
+    text = "\n".join(lines)
+    ports = [8000 + u for u in range(args.upstreams)]
+    start = time.perf_counter()
+    for port in ports:
+        pattern = re.compile(rf".*\bserver\b(.*\b:{port}\b).*")
+        filtered = {match.group(1).strip() for match in map(pattern.match, text.splitlines()) if match}
+    scan = time.perf_counter() - start
+    start = time.perf_counter()
+    conf = NGINXConfig.parse("bench.conf", text)
+    parse = time.perf_counter() - start
+    start = time.perf_counter()
+    for port in ports:
+        servers = conf.servers_by_port(port)
+    lookup = time.perf_counter() - start
+    assert servers == filtered, (servers, filtered)
+    print(f"{args.upstreams} upstreams x {args.hosts} hosts, {len(text) // 1024} KiB")
+    print(f"filter per site {scan * 1000:8.1f} ms")
+    print(f"parse once      {parse * 1000:8.1f} ms + lookup {lookup * 1000:6.1f} ms")
+
+
+def _shard_worker(items: List[Tuple[float, List[str]]], queue):
+    async def _run() -> int:
+        client, limiter = ProbeClient(), AdmissionController()
+        checks = [SiteCheck(hostname="bench.local", path="/", timeout=5, method="get", servers=servers,
+                            client=client, limiter=limiter) for _, servers in items]
+        deadline, probes = time.perf_counter() + items[0][0], 0
+        while time.perf_counter() < deadline:
+            results = await asyncio.gather(*[check.check_servers() for check in checks])
+            probes += sum(len(result) for result in results)
+        await client.close()
+        return probes
+
+    queue.put(asyncio.run(_run()))
+
+
+async def _collect(coordinator: ShardCoordinator) -> int:
+    total, count = 0, len(coordinator.shards)
+    async for probes in coordinator.events():
+        total += probes
+        count -= 1
+        if not count:
+            return total
+
+
+def bench_shard(args):
+    backends, servers = start_backend_group(args.port, args.hosts, args.workers)
+    # 每个站点10个后端，按站点分片
+    items = [(args.duration, servers[i:i + 10]) for i in range(0, len(servers), 10)]
+    try:
+        workers, base = 1, None
+        while workers <= args.workers:
+            coordinator = ShardCoordinator(items, workers, _shard_worker, weight=lambda item: len(item[1]),
+                                           restart=False)
+            coordinator.start()
+            rate = asyncio.run(_collect(coordinator)) / args.duration
+            coordinator.stop()
+            base = base if base else rate
+            print(f"workers={workers:2d} {rate:10.0f} probes/s  speedup {rate / base:4.2f}x")
+            workers *= 2
+    finally:
+        for proc in backends:
+            proc.terminate()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="local benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+    _engine = sub.add_parser("engine", help="aiohttp vs raw asyncio-streams probe engine")
+    _engine.add_argument("--port", type=int, default=18080)
+    _engine.add_argument("--hosts", type=int, default=50)
+    _engine.add_argument("--rounds", type=int, default=20)
+    _engine.set_defaults(func=bench_engine)
+    _shard = sub.add_parser("shard", help="probe throughput with 1..N sharded worker processes")
+    _shard.add_argument("--port", type=int, default=18080)
+    _shard.add_argument("--hosts", type=int, default=200)
+    _shard.add_argument("--workers", type=int, default=multiprocessing.cpu_count())
+    _shard.add_argument("--duration", type=float, default=5)
+    _shard.set_defaults(func=bench_shard)
+    _loop = sub.add_parser("loop", help="probe cycle time and CPU with asyncio vs uvloop")
+    _loop.add_argument("--port", type=int, default=18080)
+    _loop.add_argument("--hosts", type=int, default=500)
+    _loop.add_argument("--backends", type=int, default=2, help="stand-in backend processes")
+    _loop.add_argument("--rounds", type=int, default=20)
+    _loop.set_defaults(func=bench_loop)
+    _store = sub.add_parser("store", help="dict SiteRecord vs array-backed record store")
+    _store.add_argument("--hosts", type=int, default=50000)
+    _store.add_argument("--rounds", type=int, default=20)
+    _store.add_argument("--failing", type=float, default=0.02, help="failing ratio per cycle")
+    _store.set_defaults(func=bench_store)
+    _snapshot = sub.add_parser("snapshot", help="record snapshot save and restore time")
+    _snapshot.add_argument("--hosts", type=int, default=10000)
+    _snapshot.add_argument("--rounds", type=int, default=5)
+    _snapshot.add_argument("--file", default="bench_state.db")
+    _snapshot.set_defaults(func=bench_snapshot)
+    _api = sub.add_parser("gateway_api", help="offline/online latency through the dynamic upstream API")
+    _api.add_argument("--port", type=int, default=18000)
+    _api.add_argument("--endpoints", type=int, default=2, help="stand-in NGINX instances")
+    _api.add_argument("--hosts", type=int, default=200, help="servers in the upstream")
+    _api.add_argument("--rounds", type=int, default=50)
+    _api.set_defaults(func=bench_gateway_api)
+    _nginx = sub.add_parser("nginx_conf", help="per-site config filtering vs one parsed upstream index")
+    _nginx.add_argument("--upstreams", type=int, default=200)
+    _nginx.add_argument("--hosts", type=int, default=50, help="servers per upstream")
+    _nginx.set_defaults(func=bench_nginx_conf)
+    _slb = sub.add_parser("slb", help="per-host vs batched SLB backend weight updates")
+    _slb.add_argument("--port", type=int, default=18100)
+    _slb.add_argument("--hosts", type=int, default=100, help="backends behind the SLB")
+    _slb.add_argument("--burst", type=int, default=40, help="hosts going offline together")
+    _slb.add_argument("--delay", type=float, default=0.02, help="mock API latency per request")
+    _slb.add_argument("--batch_window", type=float, default=0.05)
+    _slb.set_defaults(func=bench_slb)
+    _e2e = sub.add_parser("e2e", help="first failed probe to host removed, with simulated gateway and action")
+    _e2e.add_argument("--port", type=int, default=19000)
+    _e2e.add_argument("--hosts", type=int, default=2000)
+    _e2e.add_argument("--backends", type=int, default=4, help="stand-in backend processes")
+    _e2e.add_argument("--failing", type=float, default=0.01, help="ratio of hosts that start failing")
+    _e2e.add_argument("--max_failed", type=int, default=3)
+    _e2e.add_argument("--gateway_latency", type=float, default=0.05)
+    _e2e.add_argument("--action_latency", type=float, default=0.5)
+    _e2e.add_argument("--timeout", type=float, default=30, help="seconds to wait for all removals")
+    _e2e.set_defaults(func=bench_e2e)
+    _actions = sub.add_parser("actions", help="one ansible-playbook per host vs one batched playbook per site")
+    _actions.add_argument("--hosts", type=int, default=30)
+    _actions.add_argument("--concurrency", type=int, default=4)
+    _actions.add_argument("--forks", type=int, default=10)
+    _actions.add_argument("--batch_window", type=float, default=0.5)
+    _actions.add_argument("--startup", type=float, default=1.5, help="stub ansible startup seconds")
+    _actions.add_argument("--per_host", type=float, default=0.5, help="stub seconds per host per fork")
+    _actions.set_defaults(func=bench_actions)
+    _quorum = sub.add_parser("quorum", help="share_load quorum: every failing host is taken offline by the leader")
+    _quorum.add_argument("--port", type=int, default=19900)
+    _quorum.add_argument("--members", type=int, default=3)
+    _quorum.add_argument("--quorum", type=int, default=2)
+    _quorum.add_argument("--hosts", type=int, default=30)
+    _quorum.add_argument("--max_failed", type=int, default=2)
+    _quorum.add_argument("--cycles", type=int, default=10)
+    _quorum.set_defaults(func=bench_quorum)
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,154 @@
+import zlib
+import asyncio
+from typing import List, Tuple, Set, Iterable, Callable, Awaitable
+
+import aiohttp
+
+from utils import SimpleLog
+from metrics import LatencyTracker
+from limiter import AdmissionController
+from client import ProbeClient, RawProbeClient
+
+log = SimpleLog(__name__).log
+
+
+class SiteCheck(object):
+    def __init__(self, hostname: str, path: str, timeout: int, method: str, servers: List[str],
+                 client: ProbeClient, limiter: AdmissionController, data: dict = None,
+                 raw_client: RawProbeClient = None, engine: str = "aiohttp", tracker: LatencyTracker = None):
+        self.hostname = hostname
+        self.path = path
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.method = method
+        self.servers = servers
+        self.client = client
+        self.limiter = limiter
+        self.headers = dict(Host=hostname)
+        self.data = data if data else {}
+        self.engine = engine
+        self.raw_client = raw_client
+        assert engine == "aiohttp" or (engine == "raw" and raw_client), f"{hostname} check engine error"
+        # raw引擎的请求报文只在这里编码一次
+        self._request = RawProbeClient.encode_request(hostname, path, method, self.data)
+        self._head = method.lower() == "head"
+        self.tracker = tracker
+        # spread模式下还未完成的检测，下个周期不重复发起
+        self._pending: Set[str] = set()
+
+    async def _get_check(self, session: aiohttp.ClientSession, server: str) -> Tuple[int, str]:
+        try:
+            async with session.get(f"http://{server}{self.path}", headers=self.headers, timeout=self.timeout) as resp:
+                if resp.status > 400:
+                    log.info(f"http://{server}{self.path}, {resp.status}")
+                return resp.status, server
+        except asyncio.exceptions.TimeoutError:
+            log.debug(f"http://{server}{self.path} check timeout")
+            return 504, server
+        except aiohttp.ClientError as e:
+            log.debug(f"http://{server}{self.path} check error: {e}")
+            return 502, server
+
+    async def _post_check(self, session: aiohttp.ClientSession, server: str) -> Tuple[int, str]:
+        try:
+            async with session.post(f"http://{server}{self.path}", data=self.data,
+                                    headers=self.headers, timeout=self.timeout) as resp:
+                if resp.status > 400:
+                    log.info(f"http://{server}{self.path}, {resp.status}")
+                return resp.status, server
+        except asyncio.exceptions.TimeoutError:
+            log.debug(f"http://{server}{self.path} check timeout")
+            return 504, server
+        except aiohttp.ClientError as e:
+            log.debug(f"http://{server}{self.path} check error: {e}")
+            return 502, server
+
+    async def _head_check(self, session: aiohttp.ClientSession, server: str) -> Tuple[int, str]:
+        try:
+            async with session.head(f"http://{server}{self.path}", headers=self.headers, timeout=self.timeout) as resp:
+                if resp.status > 400:
+                    log.info(f"http://{server}{self.path}, {resp.status}")
+                return resp.status, server
+        except asyncio.exceptions.TimeoutError:
+            log.debug(f"http://{server}{self.path} check timeout")
+            return 504, server
+        except aiohttp.ClientError as e:
+            log.debug(f"http://{server}{self.path} check error: {e}")
+            return 502, server
+
+    async def _raw_check(self, server: str) -> Tuple[int, str]:
+        try:
+            status = await asyncio.wait_for(self.raw_client.probe(server, self._request, self._head),
+                                            timeout=self.timeout.total)
+            if status > 400:
+                log.info(f"http://{server}{self.path}, {status}")
+            return status, server
+        except asyncio.TimeoutError:
+            log.debug(f"http://{server}{self.path} check timeout")
+            return 504, server
+        except (OSError, ValueError, asyncio.IncompleteReadError) as e:
+            log.debug(f"http://{server}{self.path} check error: {e}")
+            return 502, server
+
+    def _check(self, session: aiohttp.ClientSession, server: str) -> Awaitable[Tuple[int, str]]:
+        if self.engine == "raw":
+            return self._raw_check(server)
+        if self.method.lower() == "get":
+            return self._get_check(session, server)
+        elif self.method.lower() == "post":
+            return self._post_check(session, server)
+        elif self.method.lower() == "head":
+            return self._head_check(session, server)
+        raise Exception("no support check method")
+
+    async def _probe(self, session: aiohttp.ClientSession, server: str) -> Tuple[int, str]:
+        # 所有站点共用准入控制，限制全局并发与速率
+        async with self.limiter.admit(self.hostname):
+            loop = asyncio.get_event_loop()
+            start = loop.time()
+            result = await self._check(session, server)
+        if self.tracker is not None:
+            # 只统计检测本身的耗时，不含排队等待
+            now = loop.time()
+            self.tracker.observe(server, (now - start) * 1000, now)
+        return result
+
+    def phase(self, server: str) -> float:
+        """主机在周期内固定的相位[0, 1)，同一主机在不同站点的相位也不同"""
+        return zlib.crc32(f"{self.hostname}/{server}".encode()) / 2 ** 32
+
+    async def check_servers(self, servers: Iterable[str] = None, results: List[Tuple[int, str]] = None):
+        """传入results时每个检测完成后立即加入results，调用被取消时已完成的结果仍保留在results中"""
+        # 共用进程级连接池，不再每个周期新建Session
+        session = self.client.session
+        servers = self.servers if servers is None else servers
+        if results is None:
+            return list(await asyncio.gather(*[self._probe(session, server) for server in servers]))
+
+        async def _collect(server: str):
+            results.append(await self._probe(session, server))
+
+        await asyncio.gather(*[_collect(server) for server in servers])
+        return results
+
+    async def spread_servers(self, window: float, on_result: Callable[[List[Tuple[int, str]]], Awaitable[None]],
+                             servers: Iterable[str] = None) -> int:
+        """
+        按各主机的相位在window内依次发起检测，每个结果完成后立即交给on_result，
+        window结束时返回本周期发起的检测数，超出window的检测继续在后台完成
+        """
+        session = self.client.session
+
+        async def _delayed(server: str):
+            try:
+                await asyncio.sleep(self.phase(server) * window)
+                await on_result([await self._probe(session, server)])
+            finally:
+                self._pending.discard(server)
+
+        servers = self.servers if servers is None else servers
+        servers = [server for server in servers if server not in self._pending]
+        self._pending.update(servers)
+        tasks = [asyncio.ensure_future(_delayed(server)) for server in servers]
+        if tasks:
+            await asyncio.wait(tasks, timeout=window)
+        return len(tasks)
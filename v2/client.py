@@ -0,0 +1,210 @@
+import asyncio
+from urllib.parse import urlencode
+from typing import Optional, Dict, List, Tuple
+
+import aiohttp
+
+from utils import SimpleLog
+
+DEFAULT_LIMIT = 1000
+DEFAULT_LIMIT_PER_HOST = 4
+DEFAULT_KEEPALIVE = 30
+DEFAULT_DNS_TTL = 300
+# raw引擎为了复用连接最多读取并丢弃的响应体大小，超过则关闭连接
+MAX_DRAIN_SIZE = 64 * 1024
+log = SimpleLog(__name__).log
+
+
+class ProbeClient(object):
+    """
+    进程内共用的检测HTTP客户端，整个进程生命周期只建一个连接池:
+    长连接复用、DNS缓存、限制单个后端的连接数，连接池异常关闭后自动重建
+    """
+    def __init__(self, data: dict = None):
+        data = data if data else {}
+        self.limit = data.get("limit", DEFAULT_LIMIT)
+        self.limit_per_host = data.get("limit_per_host", DEFAULT_LIMIT_PER_HOST)
+        self.keepalive = data.get("keepalive_timeout", DEFAULT_KEEPALIVE)
+        self.dns_ttl = data.get("dns_ttl", DEFAULT_DNS_TTL)
+        assert isinstance(self.limit, int) \
+               and isinstance(self.limit_per_host, int) \
+               and isinstance(self.keepalive, int) \
+               and isinstance(self.dns_ttl, int), "Config file client section error"
+        self._session: Optional[aiohttp.ClientSession] = None
+        # 新建连接数/复用连接数/连接池重建次数，用来确认连接确实被复用
+        self.created = 0
+        self.reused = 0
+        self.rebuilds = 0
+
+    def __repr__(self) -> str:
+        return f"ProbeClient(created={self.created}, reused={self.reused}, rebuilds={self.rebuilds})"
+
+    async def _on_create(self, session, ctx, params):
+        self.created += 1
+
+    async def _on_reuse(self, session, ctx, params):
+        self.reused += 1
+
+    def _build(self) -> aiohttp.ClientSession:
+        trace = aiohttp.TraceConfig()
+        trace.on_connection_create_end.append(self._on_create)
+        trace.on_connection_reuseconn.append(self._on_reuse)
+        connector = aiohttp.TCPConnector(
+            limit=self.limit, limit_per_host=self.limit_per_host,
+            ttl_dns_cache=self.dns_ttl, keepalive_timeout=self.keepalive
+        )
+        return aiohttp.ClientSession(connector=connector, trace_configs=[trace])
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            self._session = self._build()
+        elif self._session.closed or self._session.connector is None or self._session.connector.closed:
+            log.warning("检测连接池已关闭，重建连接池")
+            self.rebuilds += 1
+            self._session = self._build()
+        return self._session
+
+    @property
+    def reuse_ratio(self) -> float:
+        total = self.created + self.reused
+        return self.reused / total if total else 0.0
+
+    def stats(self) -> str:
+        return f"连接新建{self.created}, 复用{self.reused}, 复用率{self.reuse_ratio:.1%}, 重建{self.rebuilds}"
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class RawProbeClient(object):
+    """
+    基于asyncio.open_connection的轻量检测引擎，只用于判断状态码:
+    每个(站点, 路径, 方法)的请求报文预先编码，只解析状态行和必要的响应头，
+    响应体能直接丢弃的连接放回空闲池复用，否则关闭
+    """
+    def __init__(self, data: dict = None):
+        data = data if data else {}
+        self.limit_per_host = data.get("limit_per_host", DEFAULT_LIMIT_PER_HOST)
+        self.keepalive = data.get("keepalive_timeout", DEFAULT_KEEPALIVE)
+        self._idle: Dict[str, List[Tuple[asyncio.StreamReader, asyncio.StreamWriter, float]]] = dict()
+        self.created = 0
+        self.reused = 0
+
+    def __repr__(self) -> str:
+        return f"RawProbeClient(created={self.created}, reused={self.reused})"
+
+    @staticmethod
+    def encode_request(hostname: str, path: str, method: str, data: dict = None) -> bytes:
+        method = method.upper()
+        lines = [f"{method} {path} HTTP/1.1", f"Host: {hostname}", "Connection: keep-alive",
+                 "User-Agent: monitor-auto"]
+        body = b""
+        if method == "POST":
+            body = urlencode(data if data else {}).encode()
+            lines.append("Content-Type: application/x-www-form-urlencoded")
+        if body or method == "POST":
+            lines.append(f"Content-Length: {len(body)}")
+        return ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body
+
+    @staticmethod
+    def _address(server: str) -> Tuple[str, int]:
+        host, _, port = server.rpartition(":")
+        if not host or not port.isdigit():
+            return server, 80
+        return host, int(port)
+
+    def _get_idle(self, server: str, now: float) -> Optional[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]:
+        idle = self._idle.get(server)
+        while idle:
+            reader, writer, expire = idle.pop()
+            if expire > now and not writer.is_closing() and not reader.at_eof():
+                return reader, writer
+            writer.close()
+        return None
+
+    def _put_idle(self, server: str, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, now: float):
+        idle = self._idle.setdefault(server, [])
+        if len(idle) < self.limit_per_host:
+            idle.append((reader, writer, now + self.keepalive))
+        else:
+            writer.close()
+
+    @staticmethod
+    async def _read_response(reader: asyncio.StreamReader, head: bool) -> Tuple[int, bool]:
+        """返回状态码以及连接是否可以复用"""
+        status_line = await reader.readline()
+        if not status_line:
+            raise ConnectionResetError("connection closed before status line")
+        # HTTP/1.1 200 OK
+        parts = status_line.split(None, 2)
+        if len(parts) < 2 or not parts[0].startswith(b"HTTP/"):
+            raise ValueError(f"bad status line {status_line!r}")
+        status = int(parts[1])
+        length, reusable = None, parts[0] == b"HTTP/1.1"
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.partition(b":")
+            name = name.strip().lower()
+            if name == b"content-length":
+                length = int(value.strip())
+            elif name == b"transfer-encoding":
+                reusable = False
+            elif name == b"connection" and value.strip().lower() == b"close":
+                reusable = False
+        if head or status in (204, 304) or 100 <= status < 200:
+            return status, reusable
+        if length is None or length > MAX_DRAIN_SIZE:
+            return status, False
+        if length:
+            await reader.readexactly(length)
+        return status, reusable
+
+    async def probe(self, server: str, request: bytes, head: bool = False) -> int:
+        loop = asyncio.get_event_loop()
+        conn = self._get_idle(server, loop.time())
+        if conn is not None:
+            self.reused += 1
+            try:
+                return await self._send(server, conn, request, head)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # 空闲连接可能已被后端关闭，换新连接重试一次
+                pass
+        host, port = self._address(server)
+        conn = await asyncio.open_connection(host, port)
+        self.created += 1
+        return await self._send(server, conn, request, head)
+
+    async def _send(self, server: str, conn: Tuple[asyncio.StreamReader, asyncio.StreamWriter],
+                    request: bytes, head: bool) -> int:
+        reader, writer = conn
+        try:
+            writer.write(request)
+            await writer.drain()
+            status, reusable = await self._read_response(reader, head)
+        except BaseException:
+            writer.close()
+            raise
+        if reusable:
+            self._put_idle(server, reader, writer, asyncio.get_event_loop().time())
+        else:
+            writer.close()
+        return status
+
+    @property
+    def reuse_ratio(self) -> float:
+        total = self.created + self.reused
+        return self.reused / total if total else 0.0
+
+    def stats(self) -> str:
+        return f"raw连接新建{self.created}, 复用{self.reused}, 复用率{self.reuse_ratio:.1%}"
+
+    async def close(self):
+        for idle in self._idle.values():
+            for _, writer, _ in idle:
+                writer.close()
+        self._idle.clear()
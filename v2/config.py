@@ -1,9 +1,18 @@
 import logging
-from typing import List
+from typing import List, Set
 
 import yaml
 
+from client import ProbeClient, RawProbeClient
 from gateway import GatewayFactory
+from metrics import LatencySLO
+from quorum import QuorumConfig
+from snapshot import SnapshotConfig
+from discovery import DiscoveryConfig
+from reconcile import ReconcileConfig
+from executor import ActionConfig
+from ssh import SSHPool
+from limiter import AdmissionController
 from utils import _Single, SimpleLog, NotifyFactory, AbstractAsyncNotifies
 
 CONFIG_FILE = "config.yml"
@@ -16,6 +25,17 @@ DEFAULT_PATH = "/"
 DEFAULT_RECOVER = False
 DEFAULT_CHECK_INTERVAL = 1
 DEFAULT_METHOD = "get"
+DEFAULT_REPORT_INTERVAL = 60
+DEFAULT_SCHEDULE = "burst"
+DEFAULT_MAX_IN_FLIGHT = 0
+DEFAULT_ENGINE = "aiohttp"
+DEFAULT_WORKERS = 1
+DEFAULT_EVENT_LOOP = "asyncio"
+DEFAULT_RECORD_STORE = "dict"
+DEFAULT_WINDOW = "decay"
+DEFAULT_WINDOW_SIZE = 0
+DEFAULT_ADAPTIVE_MAX_INTERVAL = 30
+DEFAULT_ADAPTIVE_RECOVER_INTERVAL = 5
 DEFAULT_LOG_LEVEL = logging.INFO
 log = SimpleLog(__name__).log
 
@@ -44,6 +64,25 @@ class _DefaultConfig(_Single):
         self.recover = data.get("recover", DEFAULT_RECOVER)
         self.check_interval = data.get("check_interval", DEFAULT_CHECK_INTERVAL)
         self.check_method = data.get("check_method", DEFAULT_METHOD)
+        self.report_interval = data.get("report_interval", DEFAULT_REPORT_INTERVAL)
+        # burst: 每个周期同时检测所有后端; spread: 按固定的相位把检测均匀分散到整个周期
+        self.schedule = data.get("schedule", DEFAULT_SCHEDULE)
+        # 单个站点同时进行的检测数(站点配额)，0为不限制
+        self.max_in_flight = data.get("max_in_flight", DEFAULT_MAX_IN_FLIGHT)
+        self.adaptive = data.get("adaptive", {})
+        # aiohttp: 完整的HTTP客户端; raw: 只解析状态行的轻量检测引擎
+        self.engine = data.get("engine", DEFAULT_ENGINE)
+        self.latency_slo = data.get("latency_slo", {})
+        # 检测进程数，大于1时按站点分片到多个进程
+        self.workers = data.get("workers", DEFAULT_WORKERS)
+        # asyncio或uvloop，uvloop未安装时回退到asyncio
+        self.event_loop = data.get("event_loop", DEFAULT_EVENT_LOOP)
+        # 主机状态记录的实现 dict: 每个主机一个HostRecord; array: 按主机编号存放在数组中
+        self.record_store = data.get("record_store", DEFAULT_RECORD_STORE)
+        # 失败计数方式 decay: 失败加一成功减一，间隔超过duration清零; time: 最近duration秒内的失败次数;
+        # count: 最近window_size次检测中的失败次数，window_size为0时取duration内的检测次数
+        self.window = data.get("window", DEFAULT_WINDOW)
+        self.window_size = data.get("window_size", DEFAULT_WINDOW_SIZE)
         assert isinstance(self.max_failed, int) \
                and isinstance(self.duration, int) \
                and isinstance(self.timeout, int)   \
@@ -51,6 +90,17 @@ class _DefaultConfig(_Single):
                and isinstance(self.max_inactive, int) \
                and isinstance(self.recover, bool) \
                and isinstance(self.check_interval, int) \
+               and isinstance(self.report_interval, int) \
+               and isinstance(self.max_in_flight, int) \
+               and self.schedule in ("burst", "spread") \
+               and isinstance(self.adaptive, dict) \
+               and self.engine in ("aiohttp", "raw") \
+               and isinstance(self.latency_slo, dict) \
+               and isinstance(self.workers, int) \
+               and self.event_loop in ("asyncio", "uvloop") \
+               and self.record_store in ("dict", "array") \
+               and self.window in ("decay", "time", "count") \
+               and isinstance(self.window_size, int) \
                and isinstance(self.path, str), "Config file default section error"
 
     def __repr__(self) -> str:
@@ -62,11 +112,41 @@ class _RecoverConfig(object):
         self.enable = data.get("enable", False)
         self.type = data.get("type", "None")
         self.name = data.get("name", "None")
+        # type为simulated时动作的耗时(秒)与失败比例
+        self.latency = data.get("latency", 0)
+        self.failure_rate = data.get("failure_rate", 0)
+        assert self.latency >= 0 and 0 <= self.failure_rate <= 1, "Config file recover section error"
 
     def __repr__(self) -> str:
         return f"AutoRecoverConfig(auto={self.enable}, type={self.type}, name={self.name})"
 
 
+class _AdaptiveConfig(object):
+    """
+    自适应检测频率: 正常主机逐步退避到max_interval，有失败记录的主机按min_interval加快检测，
+    已下线的主机按recover_interval检测是否恢复。
+    正常主机的第一次失败最晚max_interval秒后才被检测到，之后还要max_failed - 1次min_interval的检测，
+    max_interval限制在不超过原来的最长发现时间(max_failed * check_interval)
+    """
+    def __init__(self, data: dict, check_interval: int, max_failed: int):
+        self.enable = data.get("enable", False)
+        self.min_interval = data.get("min_interval", check_interval)
+        self.max_interval = data.get("max_interval", DEFAULT_ADAPTIVE_MAX_INTERVAL)
+        self.recover_interval = data.get("recover_interval", DEFAULT_ADAPTIVE_RECOVER_INTERVAL)
+        assert isinstance(self.enable, bool) \
+               and 0 < self.min_interval <= check_interval <= self.max_interval \
+               and self.recover_interval > 0, "Config file adaptive section error"
+        # min_interval不大于check_interval，所以上限不小于check_interval
+        limit = max_failed * check_interval - (max_failed - 1) * self.min_interval
+        if self.enable and self.max_interval > limit:
+            log.warning(f"adaptive max_interval {self.max_interval} exceeds detection budget "
+                        f"max_failed * check_interval, use {limit}")
+        self.max_interval = min(self.max_interval, limit)
+
+    def __repr__(self) -> str:
+        return f"AdaptiveConfig(enable={self.enable}, min={self.min_interval}, max={self.max_interval})"
+
+
 class SiteConfig(object):
     def __init__(self, site_data: dict, default: _DefaultConfig, gateway_data: dict):
         self.name = site_data.get("site")
@@ -86,12 +166,36 @@ class SiteConfig(object):
         self._gateway = GatewayFactory.get_gateway(site_data, gateway_data)
         self.method = site_data.get("check_method") if site_data.get("check_method") else default.check_method
         self.post_data = site_data.get("post_data")
+        self.check_interval = site_data.get("check_interval") if site_data.get("check_interval") else default.check_interval
+        self.schedule = site_data.get("schedule") if site_data.get("schedule") else default.schedule
+        self.max_in_flight = site_data.get("max_in_flight") if site_data.get("max_in_flight") else default.max_in_flight
+        self.engine = site_data.get("engine") if site_data.get("engine") else default.engine
+        self.record_store = site_data.get("record_store") if site_data.get("record_store") else default.record_store
+        self.window = site_data.get("window") if site_data.get("window") else default.window
+        window_size = site_data.get("window_size") if site_data.get("window_size") else default.window_size
+        self.window_size = window_size if window_size else max(self.duration // self.check_interval, self.max_failed)
+        # array记录只实现了decay计数
+        assert self.window in ("decay", "time", "count") and self.window_size >= self.max_failed \
+               and (self.window == "decay" or self.record_store == "dict"), f"Config file site {self.name} window error"
+        latency_slo = site_data.get("latency_slo") if site_data.get("latency_slo") else default.latency_slo
+        self.latency_slo = LatencySLO(latency_slo)
+        adaptive = site_data.get("adaptive") if site_data.get("adaptive") else default.adaptive
+        self.adaptive = _AdaptiveConfig(adaptive, self.check_interval, self.max_failed)
+        # 单个周期(检测+处理)的最长时间，超过则取消本周期，不影响其他站点
+        self.deadline = site_data.get("deadline") if site_data.get("deadline") else self.timeout + self.check_interval
         if self.method.lower() == "post" and not self.post_data:
             log.warning(f"{self.name} check method is POST, but post_data is None")
 
     def __repr__(self) -> str:
         return f"SiteConfig(name={self.name})"
 
+    @property
+    def tick_interval(self) -> int:
+        """站点任务实际的调度间隔，自适应模式下为最快的检测间隔"""
+        if self.adaptive.enable:
+            return self.adaptive.min_interval
+        return self.check_interval
+
     @property
     def gateway(self):
         return self._gateway
@@ -100,10 +204,15 @@ class SiteConfig(object):
     def servers(self):
         if self._fetch:
             return self._servers
-        self._servers = self._gateway.get_servers()
+        self._servers = set(self._gateway.get_servers())
         self._fetch = True
         return self._servers
 
+    def swap_servers(self, servers: Set[str]):
+        """整体替换为新的集合，不修改原集合，正在遍历原集合的检测不受影响"""
+        self._servers = set(servers)
+        self._fetch = True
+
 
 class AppConfig(_Single):
     def __init__(self, file_name: str = CONFIG_FILE):
@@ -123,6 +232,18 @@ class AppConfig(_Single):
     def check_interval(self) -> int:
         return self._default.check_interval
 
+    @property
+    def event_loop(self) -> str:
+        return self._default.event_loop
+
+    @property
+    def workers(self) -> int:
+        return self._default.workers
+
+    @property
+    def report_interval(self) -> int:
+        return self._default.report_interval
+
     @property
     def sites(self) -> List[SiteConfig]:
         result = list()
@@ -131,6 +252,43 @@ class AppConfig(_Single):
             result.append(_site_config)
         return result
 
+    @property
+    def client(self) -> ProbeClient:
+        return ProbeClient(self._data.get("client", {}))
+
+    @property
+    def raw_client(self) -> RawProbeClient:
+        return RawProbeClient(self._data.get("client", {}))
+
+    @property
+    def limiter(self) -> AdmissionController:
+        return AdmissionController(self._data.get("limiter", {}))
+
+    @property
+    def quorum(self) -> QuorumConfig:
+        return QuorumConfig(self._data.get("quorum", {}))
+
+    @property
+    def snapshot(self) -> SnapshotConfig:
+        return SnapshotConfig(self._data.get("snapshot", {}))
+
+    @property
+    def discovery(self) -> DiscoveryConfig:
+        return DiscoveryConfig(self._data.get("discovery", {}))
+
+    @property
+    def reconcile(self) -> ReconcileConfig:
+        return ReconcileConfig(self._data.get("reconcile", {}))
+
+    @property
+    def action(self) -> ActionConfig:
+        return ActionConfig(self._data.get("action", {}))
+
+    @property
+    def ssh_pool(self) -> SSHPool:
+        nginx_data = self._gateway_conf.get("nginx") or {}
+        return SSHPool.shared(nginx_data.get("ssh", {}))
+
     @property
     def notify(self) -> AbstractAsyncNotifies:
         _notify_datas = self._data.get("notify", [])
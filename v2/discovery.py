@@ -0,0 +1,89 @@
+import time
+import asyncio
+import hashlib
+from typing import Set, Dict, Callable, Iterable, Optional
+
+from utils import SimpleLog
+
+DEFAULT_DISCOVERY_TTL = 300
+log = SimpleLog(__name__).log
+
+
+class DiscoveryConfig(object):
+    def __init__(self, data: dict):
+        self.enable = data.get("enable", False)
+        # 重新获取后端主机的间隔(秒)
+        self.ttl = data.get("ttl", DEFAULT_DISCOVERY_TTL)
+        assert isinstance(self.enable, bool) and self.ttl > 0, "Config file discovery section error"
+
+    def __repr__(self) -> str:
+        return f"DiscoveryConfig(enable={self.enable}, ttl={self.ttl})"
+
+
+def digest(servers: Iterable[str]) -> str:
+    return hashlib.sha1("\n".join(sorted(servers)).encode()).hexdigest()
+
+
+class Discovery(object):
+    """
+    每ttl秒在线程池中重新获取各站点的后端主机，不阻塞检测。
+    结果的哈希与上次相同时不做任何处理；有变化时整体替换站点的主机集合，
+    新增与移除的主机交给on_change，由调用方同步到检测与记录
+    """
+    def __init__(self, conf: DiscoveryConfig, sites: list, on_change: Callable[[object, Set[str], Set[str]], None]):
+        self.conf = conf
+        self._sites = sites
+        self._on_change = on_change
+        self._digests: Dict[str, str] = {site.name: digest(site.servers) for site in sites}
+        self.refreshes = 0
+        self.unchanged = 0
+        self.changes = 0
+        self.failures = 0
+        self.refresh_ms = 0.0
+
+    def __repr__(self) -> str:
+        return f"Discovery(sites={len(self._sites)}, ttl={self.conf.ttl})"
+
+    def apply(self, site, servers: Optional[Set[str]]) -> bool:
+        """返回站点的主机集合是否有变化"""
+        if not servers:
+            # 获取失败或网关返回空列表时保留原有主机，避免误删整个站点
+            self.failures += 1
+            log.warning(f"{site.name}获取后端主机失败，继续使用原有的{len(site.servers)}个主机")
+            return False
+        _digest = digest(servers)
+        if _digest == self._digests.get(site.name):
+            self.unchanged += 1
+            return False
+        old = site.servers
+        site.swap_servers(servers)
+        self._digests[site.name] = _digest
+        added, removed = set(servers) - set(old), set(old) - set(servers)
+        self.changes += 1
+        log.info(f"{site.name}后端主机变化: 新增{sorted(added)}, 移除{sorted(removed)}")
+        self._on_change(site, added, removed)
+        return True
+
+    async def refresh(self, site) -> bool:
+        loop = asyncio.get_event_loop()
+        try:
+            servers = await loop.run_in_executor(None, site.gateway.fetch_servers)
+        except Exception as e:
+            log.exception(f"{site.name}获取后端主机异常: {e}")
+            servers = None
+        return self.apply(site, servers)
+
+    async def refresh_all(self):
+        start = time.perf_counter()
+        await asyncio.gather(*[self.refresh(site) for site in self._sites])
+        self.refreshes += 1
+        self.refresh_ms = (time.perf_counter() - start) * 1000
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.conf.ttl)
+            await self.refresh_all()
+
+    def stats(self) -> str:
+        return (f"后端发现: 刷新{self.refreshes}次, 未变化{self.unchanged}, 变化{self.changes}, "
+                f"失败{self.failures}, 最近一次耗时{self.refresh_ms:.1f}ms")
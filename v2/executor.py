@@ -0,0 +1,204 @@
+import time
+import asyncio
+from typing import Dict, Tuple, List, Callable, Optional
+
+from metrics import LatencyHistogram
+from utils import SimpleLog
+
+DEFAULT_ACTION_CONCURRENCY = 4
+DEFAULT_ACTION_TIMEOUT = 600
+DEFAULT_ACTION_BATCH_WINDOW = 2
+DEFAULT_ACTION_FORKS = 10
+log = SimpleLog(__name__).log
+
+
+class ActionConfig(object):
+    def __init__(self, data: dict):
+        # 同时执行的恢复动作数(ansible-playbook进程数)
+        self.concurrency = data.get("concurrency", DEFAULT_ACTION_CONCURRENCY)
+        # 单个动作的最长时间(秒)，超时后结束进程
+        self.timeout = data.get("timeout", DEFAULT_ACTION_TIMEOUT)
+        # 同一站点的同类动作在batch_window秒内合并为一次执行(一个playbook)，0为不合并
+        self.batch_window = data.get("batch_window", DEFAULT_ACTION_BATCH_WINDOW)
+        # 合并执行时ansible同时处理的主机数
+        self.forks = data.get("forks", DEFAULT_ACTION_FORKS)
+        assert isinstance(self.concurrency, int) and self.concurrency > 0 \
+               and self.timeout > 0 and self.batch_window >= 0 \
+               and isinstance(self.forks, int) and self.forks > 0, "Config file action section error"
+
+    def __repr__(self) -> str:
+        return f"ActionConfig(concurrency={self.concurrency}, timeout={self.timeout}, batch_window={self.batch_window})"
+
+
+class ActionResult(object):
+    def __init__(self, site: str, host: str, ok: bool, returncode: int, elapsed: float,
+                 timeout: bool = False, cancelled: bool = False, output: str = ""):
+        self.site = site
+        self.host = host
+        self.ok = ok
+        self.returncode = returncode
+        # 从开始执行到结束的时间(秒)，不包括排队
+        self.elapsed = elapsed
+        self.timeout = timeout
+        self.cancelled = cancelled
+        self.output = output
+
+    def __repr__(self) -> str:
+        state = "timeout" if self.timeout else "cancelled" if self.cancelled else "ok" if self.ok else "failed"
+        return f"ActionResult({self.site}, {self.host}, {state}, {self.elapsed:.1f}s)"
+
+
+class ActionExecutor(object):
+    """
+    恢复动作的执行队列: 最多concurrency次执行同时进行，其余排队；同一站点的同一主机同时只有一个动作，
+    排队或执行中时再提交的直接丢弃。batch_key相同的动作先等待batch_window秒，合并为一次run_batch()执行。
+    执行超过timeout秒或其中的主机都被cancel()时结束进程，每个主机的ActionResult交给add_listener()注册的回调
+    """
+    def __init__(self, conf: ActionConfig, create: Callable[[object, str], object]):
+        self.conf = conf
+        # create(site, host)返回动作，动作的run(timeout)返回ActionResult
+        self._create = create
+        self._queue: Optional[asyncio.Queue] = None
+        # (站点, 主机) -> 排队中或执行中的动作
+        self._actions: Dict[Tuple[str, str], object] = dict()
+        # batch_key -> 等待合并的动作
+        self._batches: Dict[Tuple[str, str], List[Tuple[Tuple[str, str], object]]] = dict()
+        # (站点, 主机) -> (执行任务, 同一次执行的所有主机)
+        self._running: Dict[Tuple[str, str], Tuple[asyncio.Future, List[Tuple[str, str]]]] = dict()
+        self._listeners: List[Callable[[ActionResult], None]] = list()
+        self.histogram = LatencyHistogram()
+        self.submitted = 0
+        self.runs = 0
+        self.deduped = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.timeouts = 0
+        self.cancelled = 0
+
+    def __repr__(self) -> str:
+        return f"ActionExecutor(concurrency={self.conf.concurrency}, pending={len(self._actions)})"
+
+    @property
+    def queue(self) -> asyncio.Queue:
+        # 在事件循环中第一次使用时创建
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        return self._queue
+
+    def add_listener(self, callback: Callable[[ActionResult], None]):
+        self._listeners.append(callback)
+
+    def pending(self, site_name: str, host: str) -> bool:
+        return (site_name, host) in self._actions
+
+    @property
+    def busy(self) -> int:
+        """排队与执行中的动作数"""
+        return len(self._actions)
+
+    def submit(self, site, host: str) -> bool:
+        """返回是否加入队列，该主机已有动作排队或执行中时返回False"""
+        key = (site.name, host)
+        if key in self._actions:
+            self.deduped += 1
+            log.info(f"{site.name} {host}已有恢复动作在执行，忽略本次动作")
+            return False
+        action = self._create(site, host)
+        self._actions[key] = action
+        self.submitted += 1
+        batch_key = action.batch_key
+        if batch_key is None or not self.conf.batch_window:
+            self.queue.put_nowait([(key, action)])
+            return True
+        batch = self._batches.setdefault(batch_key, list())
+        batch.append((key, action))
+        if len(batch) == 1:
+            asyncio.ensure_future(self._flush(batch_key))
+        return True
+
+    async def _flush(self, batch_key: Tuple[str, str]):
+        await asyncio.sleep(self.conf.batch_window)
+        batch = self._batches.pop(batch_key, [])
+        if batch:
+            self.queue.put_nowait(batch)
+
+    def cancel(self, site_name: str, host: str) -> bool:
+        """主机已恢复时取消它的动作: 排队中的不再执行，执行中的结束进程"""
+        key = (site_name, host)
+        if self._actions.pop(key, None) is None:
+            return False
+        task, keys = self._running.get(key, (None, []))
+        if task is not None and not any(_key in self._actions for _key in keys):
+            # 同一次执行的主机都已取消时才结束进程
+            task.cancel()
+        log.info(f"{site_name} {host}的恢复动作已取消")
+        return True
+
+    def _finish(self, result: ActionResult):
+        if result.cancelled:
+            self.cancelled += 1
+        elif result.timeout:
+            self.timeouts += 1
+        elif result.ok:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+        if not result.cancelled:
+            self.histogram.observe(result.elapsed * 1000)
+        if not result.ok and not result.cancelled:
+            log.error(f"恢复动作未成功: {result}, 输出: {result.output[-500:]}")
+        for callback in self._listeners:
+            try:
+                callback(result)
+            except Exception as e:
+                log.exception(f"处理动作结果异常: {e}")
+
+    async def _execute(self, batch: List[Tuple[Tuple[str, str], object]]) -> List[ActionResult]:
+        start, actions, keys = time.time(), [action for _, action in batch], [key for key, _ in batch]
+        if len(actions) == 1:
+            coro = actions[0].run(self.conf.timeout)
+        else:
+            coro = type(actions[0]).run_batch(actions, self.conf.timeout, self.conf.forks)
+        task = asyncio.ensure_future(coro)
+        self.runs += 1
+        for key in keys:
+            self._running[key] = (task, keys)
+        try:
+            result = await task
+            return [result] if len(actions) == 1 else result
+        except asyncio.CancelledError:
+            if any(self._actions.get(key) is action for key, action in batch):
+                # 不是cancel()取消的，执行器本身被取消(进程退出)
+                task.cancel()
+                raise
+            return [ActionResult(key[0], key[1], False, -1, time.time() - start, cancelled=True) for key in keys]
+        except Exception as e:
+            log.exception(f"{keys}恢复动作异常: {e}")
+            return [ActionResult(key[0], key[1], False, -1, time.time() - start, output=str(e)) for key in keys]
+        finally:
+            for key in keys:
+                self._running.pop(key, None)
+
+    async def _worker(self):
+        while True:
+            batch = await self.queue.get()
+            # 排队期间已取消的主机不再执行
+            batch = [(key, action) for key, action in batch if self._actions.get(key) is action]
+            if not batch:
+                continue
+            results = await self._execute(batch)
+            for (key, action), result in zip(batch, results):
+                if self._actions.get(key) is action:
+                    del self._actions[key]
+                elif not result.cancelled:
+                    # 执行期间已取消，其他主机仍在同一次执行中
+                    result.cancelled = True
+                self._finish(result)
+
+    async def run(self):
+        await asyncio.gather(*[self._worker() for _ in range(self.conf.concurrency)])
+
+    def stats(self) -> str:
+        return (f"恢复动作: 提交{self.submitted}, 合并为{self.runs}次执行, 排队与执行中{self.busy}(执行中{len(self._running)}), "
+                f"重复忽略{self.deduped}, 成功{self.succeeded}, 失败{self.failed}, 超时{self.timeouts}, "
+                f"取消{self.cancelled}, p95={self.histogram.quantile(0.95)}ms")
@@ -1,25 +1,97 @@
-from typing import Set
+import hmac
+import time
+import json
+import uuid
+import base64
+import hashlib
+import random
+import asyncio
+import threading
+from urllib.error import HTTPError
+from urllib.parse import quote, urlencode
+from urllib.request import urlopen
+from typing import Set, Dict, List, Tuple, Optional
 from abc import ABCMeta, abstractmethod
-from subprocess import run, PIPE, TimeoutExpired
 
+import aiohttp
+
+from ssh import SSHPool, SSHSession
+from nginxconf import NGINXConfig
 from utils import _Single, SimpleLog
 
+DEFAULT_CHANGE_TIMEOUT = 10
+DEFAULT_BATCH_WINDOW = 0.5
+# 同一NGINX主机上并发的获取在该时间(秒)内共用一次远程命令
+DEFAULT_FETCH_MAX_AGE = 1
+DEFAULT_API_TIMEOUT = 2
+DEFAULT_API_CONNECTIONS = 4
+DEFAULT_SLB_CACHE_TTL = 10
+DEFAULT_SLB_WEIGHT = 100
+# SetBackendServers一次最多修改的后端数
+SLB_BATCH_LIMIT = 20
+DEFAULT_SIMULATED_LATENCY = 0.05
 log = SimpleLog(__name__).log
 
 
+class GatewayChange(object):
+    """
+    一次主机上/下线在各网关主机上的结果: 每台网关主机是否成功、耗时与是否超时，
+    outcome为汇总结果 ok: 全部成功; partial: 部分成功; failed: 全部失败
+    """
+    def __init__(self, server: str, status: str):
+        self.server = server
+        self.status = status
+        self.results: Dict[str, bool] = dict()
+        self.elapsed_ms: Dict[str, float] = dict()
+        self.timeouts: Set[str] = set()
+
+    def __repr__(self) -> str:
+        return f"GatewayChange({self.status} {self.server}, {self.outcome}, failed={self.failed})"
+
+    def add(self, host: str, ok: bool, elapsed_ms: float, timeout: bool = False):
+        self.results[host] = ok
+        self.elapsed_ms[host] = elapsed_ms
+        if timeout:
+            self.timeouts.add(host)
+
+    @property
+    def failed(self) -> List[str]:
+        return [host for host, ok in self.results.items() if not ok]
+
+    @property
+    def outcome(self) -> str:
+        failed = len(self.failed)
+        if not failed:
+            return "ok"
+        return "failed" if failed == len(self.results) else "partial"
+
+
 class AbstractGateway(metaclass=ABCMeta):
     @abstractmethod
     def get_servers(self) -> Set[str]:
         pass
 
     @abstractmethod
-    def change_server_online(self, server: str):
+    async def change_server_online(self, server: str, targets: Set[str] = None) -> GatewayChange:
+        """targets为需要修改的网关目标(get_offline_by_target的key)，None为全部"""
         pass
 
     @abstractmethod
-    def change_server_offline(self, server: str):
+    async def change_server_offline(self, server: str, targets: Set[str] = None) -> GatewayChange:
         pass
 
+    def get_offline_servers(self) -> Optional[Set[str]]:
+        """网关上当前已下线的主机，None表示该网关无法查询"""
+        return None
+
+    def get_offline_by_target(self) -> Optional[Dict[str, Optional[Set[str]]]]:
+        """每个网关目标(例如每台NGINX)上已下线的主机，无法查询的目标为None，网关无法查询时返回None"""
+        return None
+
+    def fetch_servers(self) -> Optional[Set[str]]:
+        """不使用缓存重新获取后端主机，用于定期刷新，获取失败时返回None"""
+        return set(self.get_servers())
+
 
 class AbstractGatewayFactory(metaclass=ABCMeta):
     @staticmethod
@@ -36,139 +108,831 @@ class StaticGateway(AbstractGateway):
     def get_servers(self) -> Set[str]:
         return self._servers
 
-    def change_server_offline(self, server: str):
+    async def change_server_offline(self, server: str, targets: Set[str] = None) -> GatewayChange:
         # print("static backend, nothing to do")
-        pass
+        return GatewayChange(server, "down")
 
-    def change_server_online(self, server: str):
+    async def change_server_online(self, server: str, targets: Set[str] = None) -> GatewayChange:
         # print("static backend, nothing to do")
-        pass
+        return GatewayChange(server, "up")
 
     def __repr__(self) -> str:
         return f"StaticGateway(servers={self._servers})"
 
 
-class _RemoteNGINX(object):
-    _cmd_fmt = """ssh {username}@{host} '{command}'"""
-    _filter_fmt = r"""sed -rn "s/.*\bserver\b(.*\b:{port}\b).*/\1/p;" {config_file}"""
+class SimulatedGateway(AbstractGateway):
+    """
+    压测用的模拟网关，不连接任何真实网关: 上/下线按latency(±jitter)秒等待，按failure_rate随机失败，
+    每次操作记录在operations中(时间, up/down, 主机, 是否成功)，offline为当前已下线的主机，供压测断言与统计。
+    servers可直接列出，也可用count个从port开始的端口生成，与mock_server.py backends一致
+    """
+    def __init__(self, data: dict, gateway_data: dict = None):
+        gateway_data = gateway_data if gateway_data else {}
+        self._servers = set(data.get("servers", []))
+        host, port = data.get("host", "127.0.0.1"), data.get("port", 18080)
+        self._servers.update(f"{host}:{_port}" for _port in range(port, port + data.get("count", 0)))
+        self.latency = gateway_data.get("latency", DEFAULT_SIMULATED_LATENCY)
+        self.jitter = gateway_data.get("jitter", 0)
+        self.failure_rate = gateway_data.get("failure_rate", 0)
+        self._random = random.Random(gateway_data.get("seed"))
+        self.offline: Set[str] = set()
+        self.operations: List[Tuple[float, str, str, bool]] = list()
+        assert self._servers and self.latency >= self.jitter >= 0 \
+               and 0 <= self.failure_rate <= 1, "Config file gateway simulated section error"
+
+    def get_servers(self) -> Set[str]:
+        return self._servers
+
+    def get_offline_servers(self) -> Optional[Set[str]]:
+        return set(self.offline)
+
+    def get_offline_by_target(self) -> Optional[Dict[str, Optional[Set[str]]]]:
+        return {"simulated": set(self.offline)}
+
+    def changed_at(self, server: str, status: str) -> Optional[float]:
+        """主机第一次成功变为status的时间"""
+        for at, _status, _server, ok in self.operations:
+            if ok and _status == status and _server == server:
+                return at
+        return None
+
+    async def _change(self, status: str, server: str) -> GatewayChange:
+        start = time.perf_counter()
+        await asyncio.sleep(self.latency + self._random.uniform(-self.jitter, self.jitter))
+        ok = self._random.random() >= self.failure_rate
+        if ok and status == "down":
+            self.offline.add(server)
+        elif ok:
+            self.offline.discard(server)
+        self.operations.append((time.time(), status, server, ok))
+        change = GatewayChange(server, status)
+        change.add("simulated", ok, (time.perf_counter() - start) * 1000)
+        return change
+
+    async def change_server_online(self, server: str, targets: Set[str] = None) -> GatewayChange:
+        return await self._change("up", server)
+
+    async def change_server_offline(self, server: str, targets: Set[str] = None) -> GatewayChange:
+        return await self._change("down", server)
+
+    def stats(self) -> str:
+        failed = sum(1 for *_, ok in self.operations if not ok)
+        return f"模拟网关: 操作{len(self.operations)}次, 失败{failed}, 已下线{len(self.offline)}"
 
-    def __init__(self, host: str, username: str):
+    def __repr__(self) -> str:
+        return f"SimulatedGateway(servers={len(self._servers)}, offline={len(self.offline)})"
+
+
+class _RemoteNGINX(object):
+    """
+    单台NGINX主机，同一(用户, 主机)的所有站点共用一个实例。
+    上/下线先按配置文件排队batch_window秒，同一配置文件的修改合并为一次sed，
+    配置文件有变化时才执行一次nginx -t与reload。修改后没有确认reload成功(reload失败、命令超时)的配置文件
+    记为待reload，之后的修改即使sed没有变化也会reload，查询下线主机前也先补一次reload
+    """
+    # 每个配置文件输出"@@ 文件 修改时间 哈希"，哈希与上次相同时不再输出内容；cat后补一个换行，避免下一个标记接在最后一行
+    _file_fmt = (r'f={conf};if [ -r "$f" ];then h=$(md5sum < "$f"|cut -d" " -f1);'
+                 r'echo "@@ $f $(stat -L -c %Y "$f") $h";[ "$h" = "{last}" ]||{{ cat "$f";echo; }};'
+                 r'else echo "@@ $f - -";fi')
+    _up_expr = r'-e "s/(\s+?)#+?(.*\bserver\b\s+?\b{server}\b.*)/\1\2/g"'
+    # 已注释的行不再处理，已下线的主机不需要先检查
+    _down_expr = r'-e "/^\s*#/!s/(.*\bserver\b\s+?\b{server}\b.*)/#\1/g"'
+    # force为"&&false"时即使文件没有变化也reload
+    _batch_fmt = (r'before=$(md5sum < {conf})&&sed --follow-symlinks -ri {exprs} {conf}'
+                  r'&&if [ "$(md5sum < {conf})" = "$before" ]{force};then echo UNCHANGED;'
+                  r'else nginx -t&&nginx -s reload&&echo RELOADED;fi')
+    _reload_cmd = "nginx -t&&nginx -s reload&&echo RELOADED"
+    _shared: Dict[Tuple[str, str], "_RemoteNGINX"] = dict()
+
+    def __init__(self, host: str, username: str, session: SSHSession, batch_window: float = DEFAULT_BATCH_WINDOW):
         self._host = host
         self._username = username
-        self._fetch_servers = set()
+        # 同一NGINX主机的所有站点共用一个复用会话
+        self._session = session
+        self.batch_window = batch_window
+        # 已注册的配置文件及其解析结果，一次远程命令获取所有配置文件
+        self._files: List[str] = list()
+        self._configs: Dict[str, NGINXConfig] = dict()
+        # 发现与快照恢复在线程池中并发获取，同一主机只执行一次
+        self._refresh_lock = threading.Lock()
+        self._refreshed = 0.0
+        self.fetches = 0
+        self.skipped = 0
+        # 配置文件 -> 排队中的(up/down, 主机, 结果)
+        self._pending: Dict[str, List[Tuple[str, str, asyncio.Future]]] = dict()
+        self._locks: Dict[str, asyncio.Lock] = dict()
+        # 已修改但没有确认reload成功的配置文件，文件内容与NGINX实际使用的可能不一致
+        self._unreloaded: Set[str] = set()
+        self.changes = 0
+        self.batches = 0
+        self.reloads = 0
 
     def __repr__(self) -> str:
         return "RemoteNGINX(host={})".format(self._host)
 
-    def _run(self, cmd: str) -> str:
-        _command = self._cmd_fmt.format(username=self._username, host=self._host, command=cmd)
-        try:
-            std = run(_command, shell=True, timeout=5, stdout=PIPE, stderr=PIPE)
-            stdout = std.stdout.decode("utf8", errors="ignore")
-            if std.returncode and std.stderr:
-                err_output = std.stderr.decode("utf8", errors="ignore")
-                log.error("执行远程命令失败，原始命令输出{}".format(err_output))
-                stdout = ""
-            elif std.returncode == 0 and stdout == "":
-                stdout = ""
-        except TimeoutExpired:
-            stdout = ""
-            log.error("执行远程命令超时...")
+    @classmethod
+    def shared(cls, host: str, username: str, session: SSHSession,
+               batch_window: float = DEFAULT_BATCH_WINDOW) -> "_RemoteNGINX":
+        key = (username, host)
+        if key not in cls._shared:
+            cls._shared[key] = cls(host, username, session, batch_window)
+        return cls._shared[key]
+
+    @property
+    def host(self) -> str:
+        return self._host
+
+    @property
+    def reloads_saved(self) -> int:
+        """每个修改单独执行时需要的reload次数减去实际reload次数"""
+        return self.changes - self.reloads
+
+    def _output(self, returncode: int, stdout: str, stderr: str) -> str:
+        if returncode and stderr:
+            log.error("执行远程命令失败，原始命令输出{}".format(stderr))
+            return ""
         return stdout
 
+    def _run(self, cmd: str) -> str:
+        return self._output(*self._session.run_sync(cmd))
+
+    async def run(self, cmd: str) -> str:
+        """通过复用会话异步执行，不阻塞事件循环"""
+        return self._output(*await self._session.run(cmd))
+
+    def register(self, config_file: str):
+        if config_file not in self._files:
+            self._files.append(config_file)
+            # 新注册的配置文件需要重新获取
+            self._refreshed = 0.0
+
+    def fetch_command(self) -> str:
+        return ";".join(self._file_fmt.format(conf=conf, last=self._configs[conf].digest if conf in self._configs else "")
+                        for conf in self._files)
+
+    def _parse_fetch(self, output: str) -> bool:
+        """按"@@"标记拆分各配置文件，哈希未变化的保留上次的解析结果"""
+        chunks: List[Tuple[List[str], List[str]]] = list()
+        for line in output.split("\n"):
+            if line.startswith("@@ "):
+                chunks.append((line.split(" ")[1:], list()))
+            elif chunks:
+                chunks[-1][1].append(line)
+        for (conf, mtime, digest), lines in chunks:
+            if digest == "-":
+                log.error(f"{self._host}上无法读取{conf}")
+                self._configs.pop(conf, None)
+            elif conf in self._configs and self._configs[conf].digest == digest:
+                self._configs[conf].mtime = int(mtime)
+            else:
+                self._configs[conf] = NGINXConfig.parse(conf, "\n".join(lines), digest, int(mtime))
+                log.debug(f"{self._host}上{conf}有变化，重新解析: {self._configs[conf]}")
+        return bool(chunks)
+
+    def refresh(self, max_age: float = 0) -> bool:
+        """
+        一次远程命令获取所有已注册的配置文件，max_age秒内已获取过时直接使用本地结果。
+        命令执行失败时返回False，保留上次的解析结果
+        """
+        with self._refresh_lock:
+            if time.time() - self._refreshed < max_age:
+                return True
+            self.fetches += 1
+            if not self._parse_fetch(self._run(self.fetch_command())):
+                return False
+            self._refreshed = time.time()
+            return True
+
+    def config(self, config_file: str, max_age: float = DEFAULT_FETCH_MAX_AGE) -> Optional[NGINXConfig]:
+        self.register(config_file)
+        if not self.refresh(max_age):
+            return None
+        return self._configs.get(config_file)
+
     def get_servers(self, config_file: str, backend_port: int) -> Set[str]:
-        if not self._fetch_servers:
-            command = self._filter_fmt.format(port=backend_port, config_file=config_file)
-            for line in self._run(command).split("\n"):
-                if line:
-                    self._fetch_servers.add(line.strip())
-        log.debug("获取到的后端服务器信息为: {}".format(self._fetch_servers))
-        return self._fetch_servers
-
-    def change_server(self, status: str, config_file: str, server: str) -> bool:
+        # 启动时各站点依次调用，第一次获取后直接使用本地解析结果
+        conf = self._configs.get(config_file) or self.config(config_file)
+        servers = conf.servers_by_port(backend_port) if conf else set()
+        log.debug("获取到的后端服务器信息为: {}".format(servers))
+        return servers
+
+    def fetch_servers(self, config_file: str, backend_port: int) -> Optional[Set[str]]:
+        """重新获取，远程配置文件的哈希未变化时直接使用上次的解析结果，命令执行失败时返回None"""
+        conf = self.config(config_file)
+        return conf.servers_by_port(backend_port) if conf else None
+
+    def reload(self, config_file: str) -> bool:
+        """补一次待reload配置文件的reload，成功后文件内容即NGINX实际使用的配置"""
+        if config_file not in self._unreloaded:
+            return True
+        if "RELOADED" not in self._run(self._reload_cmd):
+            log.error(f"{self._host}上{config_file}已修改，reload仍未成功")
+            return False
+        log.info(f"{self._host}上{config_file}补充reload成功")
+        self.reloads += 1
+        self._unreloaded.discard(config_file)
+        # 失败的修改没有更新本地解析结果，重新获取
+        self._refreshed = 0.0
+        return True
+
+    def get_offline_servers(self, config_file: str, backend_port: int) -> Optional[Set[str]]:
+        """命令执行失败或配置文件还未reload时返回None，与没有已下线的主机区分开"""
+        if not self.reload(config_file):
+            return None
+        conf = self.config(config_file)
+        return conf.offline_servers(backend_port) if conf else None
+
+    def batch_command(self, config_file: str, changes: List[Tuple[str, str]]) -> str:
+        """多个修改按提交顺序合并为一次sed，同一主机先下线再上线时结果为上线"""
+        exprs = " ".join((self._up_expr if status == "up" else self._down_expr).format(server=server)
+                         for status, server in changes)
+        force = "&&false" if config_file in self._unreloaded else ""
+        return self._batch_fmt.format(conf=config_file, exprs=exprs, force=force)
+
+    async def change_server(self, status: str, config_file: str, server: str) -> bool:
         """
-        :param status: error/ok
+        :param status: up/down
         :param config_file: /etc/nginx/conf.d/test.conf
         :param server: 128.0.255.27:15672
         :return:
         """
-        if status == "up":
-            _cmd = (r'sed --follow-symlinks -ri '
-                    r'"s/(\s+?)#+?(.*\bserver\b\s+?\b{server}\b.*)/\1\2/g" {conf}'
-                    r'&&nginx -t&&nginx -s reload')
-            command = _cmd.format(server=server, conf=config_file)
-        elif status == "down":
-            _cmd = (r'sed --follow-symlinks -ri '
-                    r'"s/(.*\bserver\b\s+?\b{server}\b.*)/#\1/g" {conf}'
-                    r'&&nginx -t&&nginx -s reload')
-            check_cmd = r'grep -e ".*#.*\bserver\b.*\b{host}\b.*" {conf}'.format(host=server, conf=config_file)
-            # 先检查当前主机是否已经在下线状态,匹配成功说明已经下线，忽略，未匹配到就执行cmd
-            command = "{check}||({cmd})".format(check=check_cmd, cmd=_cmd.format(server=server, conf=config_file))
-        else:
+        if status not in ("up", "down"):
             raise Exception("Only support up or down status")
-        return bool(self._run(command))
+        conf = self._configs.get(config_file)
+        if conf and conf.state(server) == status and config_file not in self._unreloaded:
+            # 本地解析结果已是目标状态，不需要远程修改；结果最多落后一个发现周期
+            self.skipped += 1
+            log.debug(f"{self._host}上{server}已是{status}状态，跳过修改")
+            return True
+        future = asyncio.get_event_loop().create_future()
+        batch = self._pending.setdefault(config_file, list())
+        batch.append((status, server, future))
+        self.changes += 1
+        if len(batch) == 1:
+            asyncio.ensure_future(self._flush(config_file))
+        # 调用方超时取消时修改仍会执行
+        return await asyncio.shield(future)
+
+    async def _flush(self, config_file: str):
+        await asyncio.sleep(self.batch_window)
+        lock = self._locks.setdefault(config_file, asyncio.Lock())
+        # 同一配置文件同时只有一次修改，等待期间提交的修改并入本批
+        async with lock:
+            batch = self._pending.pop(config_file, [])
+            if not batch:
+                return
+            command = self.batch_command(config_file, [(status, server) for status, server, _ in batch])
+            try:
+                # nginx -t的输出在stderr，以返回码判断是否成功
+                returncode, stdout, stderr = await self._session.run(command)
+            except Exception as e:
+                log.exception(f"{self._host}上修改{config_file}异常: {e}")
+                returncode, stdout, stderr = -1, "", str(e)
+            self.batches += 1
+            if "RELOADED" in stdout:
+                self.reloads += 1
+                self._unreloaded.discard(config_file)
+            elif returncode or "UNCHANGED" not in stdout:
+                # sed可能已执行，reload失败或结果未知
+                self._unreloaded.add(config_file)
+            if returncode:
+                log.error("{}上修改{}失败，原始命令输出{}".format(
+                    self._host, [server for _, server, _ in batch], stderr))
+            elif len(batch) > 1:
+                log.info(f"{self._host}上{config_file}合并{len(batch)}个修改, {stdout.strip()}")
+            conf = self._configs.get(config_file)
+            if returncode == 0 and conf:
+                for status, server, _ in batch:
+                    conf.set_state(server, status)
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_result(returncode == 0)
+
+    def stats(self) -> str:
+        return (f"{self._host} 修改{self.changes}, 合并为{self.batches}次, reload {self.reloads}次, "
+                f"节省{self.reloads_saved}次, 已是目标状态{self.skipped}, 获取配置{self.fetches}次")
+
+
+class _FanOutGateway(AbstractGateway):
+    """多个修改目标同时修改的网关，子类提供self._targets(有host属性，例如每台NGINX)、_apply与_offline_on"""
+    def __init__(self, change_timeout: float):
+        self._targets: list = list()
+        # 单个目标上一次修改的最长时间(包括排队与建立连接)
+        self.change_timeout = change_timeout
+        # 同一主机的上/下线按提交顺序执行
+        self._locks: Dict[str, asyncio.Lock] = dict()
 
+    @abstractmethod
+    async def _apply(self, target, status: str, server: str) -> bool:
+        pass
 
-class NGINXGateway(AbstractGateway):
+    @abstractmethod
+    def _offline_on(self, target) -> Optional[Set[str]]:
+        """单个目标上已下线的主机，查询失败时返回None"""
+        pass
+
+    def get_offline_by_target(self) -> Optional[Dict[str, Optional[Set[str]]]]:
+        return {target.host: self._offline_on(target) for target in self._targets}
+
+    def get_offline_servers(self) -> Optional[Set[str]]:
+        # 任意一个目标上已下线即视为已下线，上线时会在所有目标上修改
+        servers = set()
+        for offline in self.get_offline_by_target().values():
+            if offline is None:
+                return None
+            servers.update(offline)
+        return servers
+
+    async def _change_one(self, target, status: str, server: str, change: GatewayChange):
+        start = time.perf_counter()
+        try:
+            ok = await asyncio.wait_for(self._apply(target, status, server), self.change_timeout)
+            timeout = False
+        except asyncio.TimeoutError:
+            log.error(f"{target}上修改{server}超过{self.change_timeout}秒")
+            ok, timeout = False, True
+        change.add(target.host, ok, (time.perf_counter() - start) * 1000, timeout)
+        log.debug(f"change server {server} {status} on {target}, result: {ok}")
+
+    async def _change(self, status: str, server: str, targets: Set[str] = None) -> GatewayChange:
+        """所有目标(或targets中的目标)同时修改，一个慢或超时不影响其他目标"""
+        change = GatewayChange(server, status)
+        lock = self._locks.setdefault(server, asyncio.Lock())
+        async with lock:
+            await asyncio.gather(*[self._change_one(target, status, server, change) for target in self._targets
+                                   if targets is None or target.host in targets])
+        return change
+
+    async def change_server_online(self, server: str, targets: Set[str] = None) -> GatewayChange:
+        return await self._change("up", server, targets)
+
+    async def change_server_offline(self, server: str, targets: Set[str] = None) -> GatewayChange:
+        return await self._change("down", server, targets)
+
+
+class NGINXGateway(_FanOutGateway):
     def __init__(self, data: dict, gateway_data: dict):
+        assert data and gateway_data and gateway_data.get("hosts"), "config file error, remote NGINX hosts not config"
+        super().__init__(gateway_data.get("change_timeout", DEFAULT_CHANGE_TIMEOUT))
         self._fetch = False
         self._servers = set()
         self.upstream_port = data.get("upstream_port")
         self.config_file = data.get("config_file")
         ssh_user = gateway_data.get("user", "None")
         hosts = gateway_data.get("hosts", [])
-        assert data and gateway_data and hosts, "config file error, remote NGINX hosts not config"
-        self._nginxs = [_RemoteNGINX(host, ssh_user) for host in hosts]
+        pool = SSHPool.shared(gateway_data.get("ssh", {}))
+        # 同一配置文件的修改在batch_window秒内合并，只reload一次
+        batch_window = gateway_data.get("batch_window", DEFAULT_BATCH_WINDOW)
+        self._targets = [_RemoteNGINX.shared(host, ssh_user, pool.session(host, ssh_user), batch_window)
+                        for host in hosts]
+        for ngx in self._targets:
+            ngx.register(self.config_file)
         assert self.config_file and isinstance(self.upstream_port, int), "no site NGINX config file"
 
     def get_servers(self) -> Set[str]:
         if self._fetch:
             return self._servers
-        for ngx in self._nginxs:
+        for ngx in self._targets:
             servers = ngx.get_servers(self.config_file, self.upstream_port)
             self._servers.update(servers)
         self._fetch = True
         return self._servers
 
-    def change_server_online(self, server: str):
-        for ngx in self._nginxs:
-            result = ngx.change_server("up", self.config_file, server)
-            log.debug(f"change server {server} online on {ngx}, result: {result}")
+    def _offline_on(self, ngx: _RemoteNGINX) -> Optional[Set[str]]:
+        return ngx.get_offline_servers(self.config_file, self.upstream_port)
 
-    def change_server_offline(self, server: str):
-        for ngx in self._nginxs:
-            result = ngx.change_server("down", self.config_file, server)
-            log.debug(f"change server {server} offline on {ngx}, result: {result}")
+    def fetch_servers(self) -> Optional[Set[str]]:
+        servers = set()
+        for ngx in self._targets:
+            fetched = ngx.fetch_servers(self.config_file, self.upstream_port)
+            if fetched is None:
+                return None
+            servers.update(fetched)
+        return servers
+
+    async def _apply(self, ngx: _RemoteNGINX, status: str, server: str) -> bool:
+        return await ngx.change_server(status, self.config_file, server)
+
+    @staticmethod
+    def reload_stats() -> str:
+        """所有NGINX主机的修改合并与reload次数"""
+        return "NGINX: " + "; ".join(ngx.stats() for ngx in _RemoteNGINX._shared.values())
 
     def __repr__(self) -> str:
         return f"NGINXGateway(user=root, hosts=[])"
 
 
-# TODO 实现具体功能
-class AliyunSLBGateway(AbstractGateway):
+class _UpstreamAPI(object):
+    """
+    单台NGINX的动态upstream接口(NGINX Plus API或兼容的Lua/njs接口)，同一地址的所有站点共用:
+    GET  {endpoint}/http/upstreams/{upstream}/servers          -> [{"id": 0, "server": "ip:port", "down": false}]
+    PATCH {endpoint}/http/upstreams/{upstream}/servers/{id}    <- {"down": true}
+    修改走进程内共用的长连接，不需要reload；启动时的查询在事件循环之外，使用同步请求
+    """
+    _shared: Dict[str, "_UpstreamAPI"] = dict()
+    _session: Optional[aiohttp.ClientSession] = None
+
+    def __init__(self, endpoint: str, timeout: float):
+        self.endpoint = endpoint.rstrip("/")
+        self.timeout = timeout
+        # upstream -> {主机: 接口中的server id}
+        self._ids: Dict[str, Dict[str, int]] = dict()
+        self.requests = 0
+        self.failures = 0
+
+    def __repr__(self) -> str:
+        return f"UpstreamAPI({self.endpoint})"
+
+    @classmethod
+    def shared(cls, endpoint: str, timeout: float) -> "_UpstreamAPI":
+        if endpoint not in cls._shared:
+            cls._shared[endpoint] = cls(endpoint, timeout)
+        return cls._shared[endpoint]
+
+    @classmethod
+    def session(cls) -> aiohttp.ClientSession:
+        if cls._session is None or cls._session.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=DEFAULT_API_CONNECTIONS, keepalive_timeout=60)
+            cls._session = aiohttp.ClientSession(connector=connector)
+        return cls._session
+
+    @classmethod
+    async def close(cls):
+        if cls._session is not None:
+            await cls._session.close()
+            cls._session = None
+
+    @property
+    def host(self) -> str:
+        return self.endpoint
+
+    def _url(self, upstream: str, server_id: int = None) -> str:
+        url = f"{self.endpoint}/http/upstreams/{upstream}/servers"
+        return url if server_id is None else f"{url}/{server_id}"
+
+    def _index(self, upstream: str, peers: List[dict]) -> List[dict]:
+        self._ids[upstream] = {peer["server"]: peer["id"] for peer in peers}
+        return peers
+
+    def list_servers(self, upstream: str) -> Optional[List[dict]]:
+        """同步查询，失败时返回None"""
+        self.requests += 1
+        try:
+            with urlopen(self._url(upstream), timeout=self.timeout) as response:
+                return self._index(upstream, json.loads(response.read()))
+        except (OSError, ValueError) as e:
+            self.failures += 1
+            log.error(f"查询{self._url(upstream)}失败: {e}")
+            return None
+
+    async def _peer_id(self, upstream: str, server: str) -> Optional[int]:
+        if server not in self._ids.get(upstream, {}):
+            async with self.session().get(self._url(upstream), timeout=aiohttp.ClientTimeout(self.timeout)) as resp:
+                self.requests += 1
+                resp.raise_for_status()
+                self._index(upstream, await resp.json(content_type=None))
+        return self._ids[upstream].get(server)
+
+    async def change_server(self, status: str, upstream: str, server: str) -> bool:
+        try:
+            server_id = await self._peer_id(upstream, server)
+            if server_id is None:
+                log.error(f"{self.endpoint}的upstream {upstream}中没有{server}")
+                return False
+            async with self.session().patch(self._url(upstream, server_id), json={"down": status == "down"},
+                                            timeout=aiohttp.ClientTimeout(self.timeout)) as resp:
+                self.requests += 1
+                if resp.status == 404:
+                    # server id已变化(例如upstream被重新加载)，下次重新查询
+                    self._ids.pop(upstream, None)
+                resp.raise_for_status()
+                return True
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.failures += 1
+            log.error(f"{self.endpoint}上修改{server}失败: {e!r}")
+            return False
+
+
+class NGINXAPIGateway(_FanOutGateway):
+    """通过动态upstream接口上/下线，不修改配置文件、不reload，NGINX的worker与长连接不受影响"""
     def __init__(self, data: dict, gateway_data: dict):
+        assert data and gateway_data and gateway_data.get("endpoints"), "config file error, nginx_api endpoints not config"
+        super().__init__(gateway_data.get("change_timeout", DEFAULT_CHANGE_TIMEOUT))
         self._fetch = False
         self._servers = set()
-        self.id = data.get("id")
+        self.upstream = data.get("upstream")
+        timeout = gateway_data.get("timeout", DEFAULT_API_TIMEOUT)
+        self._targets = [_UpstreamAPI.shared(endpoint, timeout) for endpoint in gateway_data.get("endpoints")]
+        assert self.upstream and isinstance(self.upstream, str), "no site nginx_api upstream"
+
+    def get_servers(self) -> Set[str]:
+        if self._fetch:
+            return self._servers
+        for api in self._targets:
+            for peer in api.list_servers(self.upstream) or []:
+                self._servers.add(peer["server"])
+        self._fetch = True
+        return self._servers
+
+    def _offline_on(self, api: _UpstreamAPI) -> Optional[Set[str]]:
+        peers = api.list_servers(self.upstream)
+        if peers is None:
+            return None
+        return {peer["server"] for peer in peers if peer.get("down")}
+
+    def fetch_servers(self) -> Optional[Set[str]]:
+        servers = set()
+        for api in self._targets:
+            peers = api.list_servers(self.upstream)
+            if peers is None:
+                return None
+            servers.update(peer["server"] for peer in peers)
+        return servers
+
+    async def _apply(self, api: _UpstreamAPI, status: str, server: str) -> bool:
+        return await api.change_server(status, self.upstream, server)
+
+    @staticmethod
+    async def close():
+        """关闭所有站点共用的接口连接"""
+        await _UpstreamAPI.close()
+
+    def __repr__(self) -> str:
+        return f"NGINXAPIGateway(upstream={self.upstream})"
+
+
+def slb_signature(secret: str, method: str, params: Dict[str, str]) -> str:
+    """阿里云RPC风格接口的签名(版本1.0，HMAC-SHA1)，mock_server.py用同一函数校验"""
+    def encode(value: str) -> str:
+        return quote(str(value), safe="~")
+
+    query = "&".join(f"{encode(k)}={encode(v)}" for k, v in sorted(params.items()))
+    string_to_sign = f"{method}&{encode('/')}&{encode(query)}"
+    digest = hmac.new(f"{secret}&".encode(), string_to_sign.encode(), hashlib.sha1).digest()
+    return base64.b64encode(digest).decode()
+
+
+class _SLBClient(object):
+    """
+    阿里云SLB接口，同一(AccessKey, 地域)的所有站点共用:
+    DescribeHealthStatus获取后端的ip:port与ServerId，DescribeLoadBalancerAttribute获取权重，
+    SetBackendServers修改权重。查询结果缓存cache_ttl秒；同一SLB的修改在batch_window秒内合并，
+    每次最多提交SLB_BATCH_LIMIT个后端。修改走进程内共用的长连接，启动时的查询在事件循环之外，使用同步请求
+    """
+    version = "2014-05-15"
+    _shared: Dict[Tuple[str, str], "_SLBClient"] = dict()
+    _session: Optional[aiohttp.ClientSession] = None
+
+    def __init__(self, key: str, secret: str, region: str, gateway_data: dict):
+        self._key = key
+        self._secret = secret
+        self.region = region
+        self.endpoint = gateway_data.get("endpoint", f"https://slb.{region}.aliyuncs.com").rstrip("/")
+        self.timeout = gateway_data.get("timeout", DEFAULT_API_TIMEOUT)
+        self.batch_window = gateway_data.get("batch_window", DEFAULT_BATCH_WINDOW)
+        self.cache_ttl = gateway_data.get("cache_ttl", DEFAULT_SLB_CACHE_TTL)
+        # (SLB, 监听端口) -> (过期时间, 主机 -> (ServerId, 权重))
+        self._cache: Dict[Tuple[str, int], Tuple[float, Dict[str, Tuple[str, int]]]] = dict()
+        # SLB -> {ServerId: (权重, 结果)}，同一实例多次修改以最后一次为准
+        self._pending: Dict[str, Dict[str, Tuple[int, List[asyncio.Future]]]] = dict()
+        self._locks: Dict[str, asyncio.Lock] = dict()
+        self.requests = 0
+        self.failures = 0
+        self.cache_hits = 0
+        self.changes = 0
+        self.batches = 0
+
+    def __repr__(self) -> str:
+        return f"SLBClient(region={self.region}, key=****)"
+
+    @classmethod
+    def shared(cls, key: str, secret: str, region: str, gateway_data: dict) -> "_SLBClient":
+        if (key, region) not in cls._shared:
+            cls._shared[(key, region)] = cls(key, secret, region, gateway_data)
+        return cls._shared[(key, region)]
+
+    @classmethod
+    def session(cls) -> aiohttp.ClientSession:
+        if cls._session is None or cls._session.closed:
+            connector = aiohttp.TCPConnector(limit_per_host=DEFAULT_API_CONNECTIONS, keepalive_timeout=60)
+            cls._session = aiohttp.ClientSession(connector=connector)
+        return cls._session
+
+    @classmethod
+    async def close(cls):
+        if cls._session is not None:
+            await cls._session.close()
+            cls._session = None
+
+    @property
+    def host(self) -> str:
+        return self.endpoint
+
+    def _params(self, action: str, params: Dict[str, str]) -> Dict[str, str]:
+        params = dict(params, Action=action, Format="JSON", Version=self.version, AccessKeyId=self._key,
+                      RegionId=self.region, SignatureMethod="HMAC-SHA1", SignatureVersion="1.0",
+                      SignatureNonce=uuid.uuid4().hex,
+                      Timestamp=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()))
+        params["Signature"] = slb_signature(self._secret, "GET", params)
+        return params
+
+    def call_sync(self, action: str, **params) -> Optional[dict]:
+        """同步请求，失败时返回None"""
+        self.requests += 1
+        url = f"{self.endpoint}/?{urlencode(self._params(action, params), quote_via=quote)}"
+        try:
+            with urlopen(url, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except HTTPError as e:
+            self.failures += 1
+            log.error(f"SLB接口{action}失败: {e.code} {e.read().decode('utf8', errors='ignore')}")
+        except (OSError, ValueError) as e:
+            self.failures += 1
+            log.error(f"SLB接口{action}失败: {e}")
+        return None
+
+    async def call(self, action: str, **params) -> dict:
+        """异步请求，失败时抛出aiohttp.ClientError或asyncio.TimeoutError"""
+        self.requests += 1
+        async with self.session().get(self.endpoint + "/", params=self._params(action, params),
+                                      timeout=aiohttp.ClientTimeout(self.timeout)) as resp:
+            body = await resp.text(errors="ignore")
+            try:
+                data = json.loads(body)
+            except ValueError:
+                data = None
+            if resp.status != 200:
+                # 代理返回的错误页(例如502)不是JSON
+                message = f"{data.get('Code')}: {data.get('Message')}" if isinstance(data, dict) else body[:200]
+                raise aiohttp.ClientResponseError(resp.request_info, resp.history, status=resp.status, message=message)
+            if not isinstance(data, dict):
+                raise aiohttp.ClientResponseError(resp.request_info, resp.history, status=resp.status,
+                                                  message=f"invalid response: {body[:200]}")
+            return data
+
+    @staticmethod
+    def _backends(health: dict, attribute: dict) -> Dict[str, Tuple[str, int]]:
+        """主机(ip:port) -> (ServerId, 权重)"""
+        weights = {backend["ServerId"]: int(backend.get("Weight", 0))
+                   for backend in attribute.get("BackendServers", {}).get("BackendServer", [])}
+        return {f"{backend['ServerIp']}:{backend['Port']}": (backend["ServerId"], weights.get(backend["ServerId"], 0))
+                for backend in health.get("BackendServers", {}).get("BackendServer", [])
+                if backend["ServerId"] in weights}
+
+    def _cached(self, key: Tuple[str, int]) -> Optional[Dict[str, Tuple[str, int]]]:
+        expire, backends = self._cache.get(key, (0.0, None))
+        if expire > time.time():
+            self.cache_hits += 1
+            return backends
+        return None
+
+    def _store(self, key: Tuple[str, int], backends: Dict[str, Tuple[str, int]]) -> Dict[str, Tuple[str, int]]:
+        self._cache[key] = (time.time() + self.cache_ttl, backends)
+        return backends
+
+    def _invalidate(self, lb_id: str):
+        for key in [key for key in self._cache if key[0] == lb_id]:
+            self._cache.pop(key, None)
+
+    def describe(self, lb_id: str, port: int) -> Optional[Dict[str, Tuple[str, int]]]:
+        """同步查询，失败时返回None"""
+        cached = self._cached((lb_id, port))
+        if cached is not None:
+            return cached
+        health = self.call_sync("DescribeHealthStatus", LoadBalancerId=lb_id, ListenerPort=port)
+        attribute = self.call_sync("DescribeLoadBalancerAttribute", LoadBalancerId=lb_id) if health else None
+        if attribute is None:
+            return None
+        return self._store((lb_id, port), self._backends(health, attribute))
+
+    async def describe_async(self, lb_id: str, port: int) -> Optional[Dict[str, Tuple[str, int]]]:
+        cached = self._cached((lb_id, port))
+        if cached is not None:
+            return cached
+        try:
+            health, attribute = await asyncio.gather(
+                self.call("DescribeHealthStatus", LoadBalancerId=lb_id, ListenerPort=port),
+                self.call("DescribeLoadBalancerAttribute", LoadBalancerId=lb_id))
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            self.failures += 1
+            log.error(f"查询SLB {lb_id}失败: {e!r}")
+            return None
+        return self._store((lb_id, port), self._backends(health, attribute))
+
+    async def set_weight(self, lb_id: str, server_id: str, weight: int) -> bool:
+        future = asyncio.get_event_loop().create_future()
+        batch = self._pending.setdefault(lb_id, dict())
+        futures = batch[server_id][1] if server_id in batch else []
+        batch[server_id] = (weight, futures + [future])
+        self.changes += 1
+        if len(batch) == 1 and len(futures) == 0:
+            asyncio.ensure_future(self._flush(lb_id))
+        # 调用方超时取消时修改仍会执行
+        return await asyncio.shield(future)
+
+    async def _submit(self, lb_id: str, items: List[Tuple[str, Tuple[int, List[asyncio.Future]]]]):
+        backends = [{"ServerId": server_id, "Weight": str(weight)} for server_id, (weight, _) in items]
+        ok = False
+        try:
+            await self.call("SetBackendServers", LoadBalancerId=lb_id, BackendServers=json.dumps(backends))
+            ok = True
+        except Exception as e:
+            self.failures += 1
+            log.error(f"SLB {lb_id}修改{[server_id for server_id, _ in items]}失败: {e!r}")
+        finally:
+            # 无论结果如何都要通知等待的调用方，包括本批被取消时
+            self.batches += 1
+            for _, (_, futures) in items:
+                for future in futures:
+                    if not future.done():
+                        future.set_result(ok)
+
+    async def _flush(self, lb_id: str):
+        await asyncio.sleep(self.batch_window)
+        lock = self._locks.setdefault(lb_id, asyncio.Lock())
+        # 同一SLB同时只有一次修改，等待期间提交的修改并入本批
+        async with lock:
+            items = list(self._pending.pop(lb_id, {}).items())
+            if not items:
+                return
+            if len(items) > 1:
+                log.info(f"SLB {lb_id}合并{len(items)}个后端的修改")
+            await asyncio.gather(*[self._submit(lb_id, items[i:i + SLB_BATCH_LIMIT])
+                                   for i in range(0, len(items), SLB_BATCH_LIMIT)])
+            # 权重已变化，下次查询重新获取
+            self._invalidate(lb_id)
+
+    def stats(self) -> str:
+        return (f"SLB({self.region}): 请求{self.requests}, 失败{self.failures}, 缓存命中{self.cache_hits}, "
+                f"修改{self.changes}, 合并为{self.batches}次")
+
+
+class AliyunSLBGateway(_FanOutGateway):
+    """
+    通过SLB后端服务器的权重上/下线: 下线时权重设为0，上线时恢复下线前的权重。
+    权重按ECS实例(ServerId)设置，同一实例在该SLB上的其他端口也会一起下线
+    """
+    def __init__(self, data: dict, gateway_data: dict):
+        assert data and gateway_data, "config file error, slb not config"
+        super().__init__(gateway_data.get("change_timeout", DEFAULT_CHANGE_TIMEOUT))
+        self._fetch = False
+        self._servers = set()
+        self.id = str(data.get("id", ""))
         self.port = data.get("port")
         key = gateway_data.get("key")
         secret = gateway_data.get("secret")
         region = gateway_data.get("region")
         assert self.id and self.port and key and secret and region, "config file error"
+        self._client = _SLBClient.shared(key, secret, region, gateway_data)
+        self._targets = [self._client]
+        # 主机 -> ServerId，ServerId -> 下线前的权重
+        self._ids: Dict[str, str] = dict()
+        self._weights: Dict[str, int] = dict()
+
+    def _index(self, backends: Optional[Dict[str, Tuple[str, int]]]) -> Optional[Dict[str, Tuple[str, int]]]:
+        for server, (server_id, weight) in (backends or {}).items():
+            self._ids[server] = server_id
+            if weight > 0:
+                self._weights[server_id] = weight
+        return backends
 
     def get_servers(self) -> Set[str]:
         if self._fetch:
             return self._servers
-        return set()
+        self._servers.update(self._index(self._client.describe(self.id, self.port)) or {})
+        self._fetch = True
+        return self._servers
 
-    def change_server_offline(self, server: str):
-        pass
+    def _offline_on(self, client: _SLBClient) -> Optional[Set[str]]:
+        backends = self._index(client.describe(self.id, self.port))
+        if backends is None:
+            return None
+        return {server for server, (_, weight) in backends.items() if weight == 0}
+
+    def fetch_servers(self) -> Optional[Set[str]]:
+        backends = self._index(self._client.describe(self.id, self.port))
+        return set(backends) if backends is not None else None
+
+    async def _apply(self, client: _SLBClient, status: str, server: str) -> bool:
+        if server not in self._ids:
+            self._index(await client.describe_async(self.id, self.port))
+        server_id = self._ids.get(server)
+        if server_id is None:
+            log.error(f"SLB {self.id}的{self.port}端口没有后端{server}")
+            return False
+        weight = 0 if status == "down" else self._weights.get(server_id, DEFAULT_SLB_WEIGHT)
+        return await client.set_weight(self.id, server_id, weight)
 
-    def change_server_online(self, server: str):
-        pass
+    @staticmethod
+    async def close():
+        await _SLBClient.close()
+
+    @staticmethod
+    def slb_stats() -> str:
+        return "; ".join(client.stats() for client in _SLBClient._shared.values())
 
     def __repr__(self) -> str:
-        return f"AliyunSLBGateway(key=****, secret=****)"
+        return f"AliyunSLBGateway(id={self.id}, port={self.port}, key=****, secret=****)"
 
 
 class GatewayFactory(_Single, AbstractGatewayFactory):
@@ -179,8 +943,12 @@ class GatewayFactory(_Single, AbstractGatewayFactory):
         if backend_type == "nginx":
             nginx_data = gateway_data.get("nginx")
             return NGINXGateway(backend, nginx_data)
+        elif backend_type == "nginx_api":
+            return NGINXAPIGateway(backend, gateway_data.get("nginx_api"))
         elif backend_type == "static":
             return StaticGateway(backend)
+        elif backend_type == "simulated":
+            return SimulatedGateway(backend, gateway_data.get("simulated"))
         elif backend_type == "slb":
             slb_data = gateway_data.get("slb")
             return AliyunSLBGateway(backend, slb_data)
@@ -0,0 +1,165 @@
+import asyncio
+from contextlib import asynccontextmanager
+from collections import deque
+from typing import Dict, Deque, Optional
+
+from utils import SimpleLog
+
+DEFAULT_MAX_IN_FLIGHT = 0
+DEFAULT_RATE = 0
+log = SimpleLog(__name__).log
+
+
+class TokenBucket(object):
+    """
+    令牌桶，每秒补充rate个令牌，最多积累burst个。
+    没有令牌时按先后顺序排队，由一个定时器在补充出令牌时逐个唤醒，等待的协程不各自轮询
+    """
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._last = None
+        self._waiters: Deque[asyncio.Future] = deque()
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    def __repr__(self) -> str:
+        return f"TokenBucket(rate={self.rate}, burst={self.burst})"
+
+    def _refill(self, now: float):
+        if self._last is not None:
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def _wake(self):
+        """每个令牌唤醒一个排队的协程，还有排队的协程时等到下一个令牌补充出来"""
+        self._timer = None
+        loop = asyncio.get_event_loop()
+        self._refill(loop.time())
+        while self._waiters and self._tokens >= 1:
+            waiter = self._waiters.popleft()
+            if waiter.done():
+                # 已取消
+                continue
+            self._tokens -= 1
+            waiter.set_result(None)
+        if self._waiters:
+            self._timer = loop.call_later((1 - self._tokens) / self.rate, self._wake)
+
+    async def acquire(self):
+        loop = asyncio.get_event_loop()
+        while self._waiters and self._waiters[0].done():
+            self._waiters.popleft()
+        self._refill(loop.time())
+        if not self._waiters and self._tokens >= 1:
+            self._tokens -= 1
+            return
+        waiter = loop.create_future()
+        self._waiters.append(waiter)
+        if self._timer is None:
+            self._timer = loop.call_later((1 - self._tokens) / self.rate, self._wake)
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # 已分到令牌后被取消，令牌交给下一个排队的协程
+                self._tokens += 1
+                if self._timer is not None:
+                    self._timer.cancel()
+                self._wake()
+            raise
+
+
+class AdmissionController(object):
+    """
+    进程级的检测准入控制，所有SiteCheck共用:
+    全局最大并发数、每秒检测数的令牌桶、可选的单站点并发配额。
+    排队等待时间与检测耗时分开统计，用来区分是监控端饱和还是后端慢
+    """
+    def __init__(self, data: dict = None):
+        data = data if data else {}
+        self.max_in_flight = data.get("max_in_flight", DEFAULT_MAX_IN_FLIGHT)
+        self.rate = data.get("rate", DEFAULT_RATE)
+        self.burst = data.get("burst", max(int(self.rate), 1))
+        assert isinstance(self.max_in_flight, int) \
+               and isinstance(self.rate, (int, float)) \
+               and isinstance(self.burst, int), "Config file limiter section error"
+        self._semaphore = asyncio.Semaphore(self.max_in_flight) if self.max_in_flight else None
+        self._bucket = TokenBucket(self.rate, self.burst) if self.rate else None
+        self._quotas: Dict[str, asyncio.Semaphore] = dict()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.site_in_flight: Dict[str, int] = dict()
+        self.site_peak_in_flight: Dict[str, int] = dict()
+        # 当前统计周期内的准入次数、排队等待时间与检测耗时
+        self._admitted = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._probe_total = 0.0
+        self._probe_max = 0.0
+
+    def __repr__(self) -> str:
+        return f"AdmissionController(max_in_flight={self.max_in_flight}, rate={self.rate})"
+
+    def set_quota(self, site: str, quota: int):
+        """单站点并发配额，0为不限制"""
+        if quota:
+            self._quotas[site] = asyncio.Semaphore(quota)
+        else:
+            self._quotas.pop(site, None)
+
+    async def _acquire(self, quota: Optional[asyncio.Semaphore]):
+        # 先占站点配额，再取令牌，最后占全局并发，避免一个站点或等待令牌时占着全局名额
+        if quota is not None:
+            await quota.acquire()
+        try:
+            if self._bucket is not None:
+                await self._bucket.acquire()
+            if self._semaphore is not None:
+                await self._semaphore.acquire()
+        except BaseException:
+            if quota is not None:
+                quota.release()
+            raise
+
+    def _release(self, quota: Optional[asyncio.Semaphore]):
+        if self._semaphore is not None:
+            self._semaphore.release()
+        if quota is not None:
+            quota.release()
+
+    @asynccontextmanager
+    async def admit(self, site: str):
+        loop = asyncio.get_event_loop()
+        quota = self._quotas.get(site)
+        start = loop.time()
+        await self._acquire(quota)
+        admitted = loop.time()
+        self._admitted += 1
+        self._wait_total += admitted - start
+        self._wait_max = max(self._wait_max, admitted - start)
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        self.site_in_flight[site] = self.site_in_flight.get(site, 0) + 1
+        self.site_peak_in_flight[site] = max(self.site_peak_in_flight.get(site, 0), self.site_in_flight[site])
+        try:
+            yield
+        finally:
+            elapsed = loop.time() - admitted
+            self._probe_total += elapsed
+            self._probe_max = max(self._probe_max, elapsed)
+            self.in_flight -= 1
+            self.site_in_flight[site] -= 1
+            self._release(quota)
+
+    def report(self) -> str:
+        """输出当前统计周期的数据，并开始新的统计周期"""
+        count = self._admitted if self._admitted else 1
+        msg = (f"进行中检测{self.in_flight}, 峰值{self.peak_in_flight}; "
+               f"准入{self._admitted}次, 排队等待平均{self._wait_total / count * 1000:.1f}ms "
+               f"最大{self._wait_max * 1000:.1f}ms; "
+               f"检测耗时平均{self._probe_total / count * 1000:.1f}ms 最大{self._probe_max * 1000:.1f}ms")
+        self._admitted = 0
+        self._wait_total = self._wait_max = 0.0
+        self._probe_total = self._probe_max = 0.0
+        return msg
@@ -1,265 +1,360 @@
 import time
 import asyncio
-from typing import List, Tuple, Dict, Set
-
-import aiohttp
+import logging
+import argparse
+import multiprocessing
+from typing import List, Tuple, Dict, Set, Callable, Awaitable
 
+from check import SiteCheck
+from metrics import LatencyTracker
+from shard import ShardCoordinator
+from quorum import QuorumGate
+from snapshot import SnapshotStore
+from discovery import Discovery
+from reconcile import Reconciler
+from store import RecordFactory
+from record import ErrorRecord, SiteRecord
 from action import ActionFactory
-from utils import SimpleLog, HostRecord
+from executor import ActionExecutor, ActionResult
+from gateway import GatewayChange, NGINXGateway, NGINXAPIGateway, AliyunSLBGateway
+from scheduler import SiteScheduler, AdaptivePlan
+from utils import SimpleLog, AbstractAsyncNotifies, install_event_loop
 from config import AppConfig, SiteConfig
 
 
 log = SimpleLog(__name__).log
 conf = AppConfig("config.yml")
 log.setLevel(conf.log_level)
+for _name in ("check", "record"):
+    logging.getLogger(_name).setLevel(conf.log_level)
 
 
 def get_time() -> str:
     return time.strftime("%Y-%m-%d %H:%M:%S")
 
 
-class ErrorRecord(object):
-    def __init__(self, host: str, status: int, action: str):
-        self.host = host
-        self.status = status
-        self.action = action
-
-
-class SiteCheck(object):
-    def __init__(self, hostname: str, path: str, timeout: int, method: str, servers: List[str], data: dict = None):
-        self.hostname = hostname
-        self.path = path
-        self.timeout = aiohttp.ClientTimeout(total=timeout)
-        self.method = method
-        self.servers = servers
-        self.data = data if data else {}
-
-    async def _get_check(self, session: aiohttp.ClientSession, server: str) -> Tuple[int, str]:
-        try:
-            async with session.get(f"http://{server}{self.path}") as resp:
-                if resp.status > 400:
-                    log.info(f"http://{server}{self.path}, {resp.status}")
-                return resp.status, server
-        except asyncio.exceptions.TimeoutError:
-            log.debug(f"http://{server}{self.path} check timeout")
-            return 504, server
-
-    async def _post_check(self, session: aiohttp.ClientSession, server: str) -> Tuple[int, str]:
-        try:
-            async with session.post(f"http://{server}{self.path}", data=self.data) as resp:
-                if resp.status > 400:
-                    log.info(f"http://{server}{self.path}, {resp.status}")
-                return resp.status, server
-        except asyncio.exceptions.TimeoutError:
-            log.debug(f"http://{server}{self.path} check timeout")
-            return 504, server
-
-    async def _head_check(self, session: aiohttp.ClientSession, server: str) -> Tuple[int, str]:
-        try:
-            async with session.head(f"http://{server}{self.path}") as resp:
-                if resp.status > 400:
-                    log.info(f"http://{server}{self.path}, {resp.status}")
-                return resp.status, server
-        except asyncio.exceptions.TimeoutError:
-            log.debug(f"http://{server}{self.path} check timeout")
-            return 504, server
-
-    async def check_servers(self):
-        headers = dict(Host=self.hostname)
-        async with aiohttp.ClientSession(headers=headers, timeout=self.timeout) as session:
-            if self.method.lower() == "get":
-                _tasks = [self._get_check(session, server) for server in self.servers]
-            elif self.method.lower() == "post":
-                _tasks = [self._post_check(session, server) for server in self.servers]
-            elif self.method.lower() == "head":
-                _tasks = [self._head_check(session, server) for server in self.servers]
-            else:
-                raise "no support check method"
-            _dones, _ = await asyncio.wait(_tasks)
-            results = [_done.result() for _done in _dones]
-            return results
-
-
-class AsyncCheck(object):
-    @staticmethod
-    async def _get_status(hostname: str, host: str, path: str, timeout: int) -> Tuple[int, str]:
-        url = "http://{}{}".format(host, path)
-        headers = dict(Host=hostname)
-        try:
-            async with aiohttp.ClientSession(headers=headers, timeout=aiohttp.ClientTimeout(total=timeout)) as session:
-                async with session.get(url) as resp:
-                    return resp.status, host
-        except Exception as e:
-            if not str(e):
-                e = "Check Coroutine Timeout, It mean HTTP Get Timeout"
-            log.warning(e)
-            return 504, host
-
-    async def checks(self, hostname: str, path: str, servers: Set[str], timeout: int) -> List[Tuple[int, str]]:
-        _tasks = [self._get_status(hostname, _host, path, timeout) for _host in servers]
-        _dones, _ = await asyncio.wait(_tasks)
-        results = [_done.result() for _done in _dones]
-        return results
-
-
-class SiteRecord(object):
-    def __init__(self, _site: SiteConfig):
-        self.conf = _site
-        self.name = _site.name
-        self.max_failed = _site.max_failed
-        self.auto_inter = _site.auto_interval
-        self.max_inactive = _site.max_inactive
-        if not self.max_inactive:
-            self.max_inactive = len(_site.servers) // 2
-        # 已经下线的主机存入self._inactive
-        self._inactive = set()
-        # self._record有所有曾经异常的记录
-        self._record: Dict[str: HostRecord] = dict()
-
-    def __repr__(self) -> str:
-        return "SiteRecord(name={},errors={})".format(self.name, self._record)
-
-    async def update(self, _results: List[Tuple[int, str]]):
-        for _result in _results:
-            status, host = _result
-            if status > 400:
-                # 判断是不是第一次发生
-                if host in self._record:
-                    # 之前有记录，需要更新
-                    if host in self._inactive:
-                        # 已下线，更新的计数为0，实际只更新了时间
-                        self._record[host].update(0)
-                    else:
-                        # 还未下线，继续更新记录
-                        if self._record[host].count < self.max_failed:
-                            # 防止整数溢出，只有小于才更新
-                            self._record[host].update(1)
-                        else:
-                            self._record[host].update(0)
-                else:
-                    # 初次，之前未记录
-                    self._record[host] = HostRecord(self.conf.duration, self.conf.auto_interval)
-                # 更新最后状态
-                self._record[host].set_status(status)
-            else:
-                # 状态码是正常的情况,如果存在，那就一直减少到0
-                if host in self._record and self._record[host].count > 0:
-                    self._record[host].update(-1)
-                pass
-        # 其他情况就不管
-        log.info(self._record)
-
-    def get_error_hosts(self) -> Set[str]:
-        results = set()
-        for host, record in self._record.items():
-            if record.count >= self.max_failed:
-                results.add(host)
-        results.update(self._inactive)
-        return results
-
-    async def get_results(self) -> List[ErrorRecord]:
-        results: List[ErrorRecord] = list()
-        for host, record in self._record.copy().items():
-            if record.count >= self.max_failed:
-                log.info("{}超过最大失败的次数,检查是否满足下线条件".format(host))
-                if host in self._inactive:
-                    log.info("{}已下线的主机还未恢复，等待下个动作的周期时间再执行相关动作".format(host))
-                    if record.is_action():
-                        record.next_action_time = time.time() + self.auto_inter
-                        error_record = ErrorRecord(host, record.last_status, "offline")
-                        results.append(error_record)
-                    else:
-                        log.info("{}不满足条件: 操作的间隔时间未到，忽略此次动作".format(host))
-                else:
-                    if self.max_inactive >= len(self._inactive) + 1:
-                        log.info("{}满足条件：下线主机数在范围内".format(host))
-                        record.next_action_time = time.time() + self.auto_inter
-                        self._inactive.add(host)
-                        error_record = ErrorRecord(host, record.last_status, "offline")
-                        results.append(error_record)
-                    else:
-                        log.info("{}不满足条件: 下线主机过多".format(host))
-                        # 通知加一个间隔时间，防止太频繁
-                        if record.is_notify():
-                            record.next_notify_time = time.time() + self.auto_inter
-                            error_record = ErrorRecord(host, record.last_status, "notify")
-                            results.append(error_record)
-            else:
-                # 记录没有大于，有可能是等于0或者1-7，更新计数
-                if record.count == 0 and host in self._inactive:
-                    log.info("{}之前异常，现在恢复。将执行上线".format(host))
-                    self._inactive.remove(host)
-                    ok_record = ErrorRecord(host, record.last_status, "online")
-                    results.append(ok_record)
-                if record.count == 0:
-                    del self._record[host]
-        return results
+MSG_FMT = "Time:\t{time}\nDomain:\t{site}\nErrHosts:\t{hosts}\nInfo:\t{info},latest status {status}\n"
+# 进行中的网关变更任务，保留引用直到完成
+_changes: Set[asyncio.Future] = set()
+
+
+async def change_gateway(site: SiteConfig, host: str, status: str, targets: Set[str] = None) -> GatewayChange:
+    """targets为只需要修改的网关主机，None为全部"""
+    if status == "down":
+        change = await site.gateway.change_server_offline(host, targets)
+    else:
+        change = await site.gateway.change_server_online(host, targets)
+    if change.outcome == "ok":
+        log.info(f"网关{site.gateway}上{host} {status}完成, 耗时{change.elapsed_ms}")
+    else:
+        log.error(f"网关{site.gateway}上{host} {status}结果{change.outcome}, 失败的网关主机{change.failed}, "
+                  f"超时{sorted(change.timeouts)}")
+    return change
+
+
+# 恢复动作排队执行，限制同时运行的ansible-playbook进程数
+executor = ActionExecutor(conf.action, ActionFactory.create_action)
+# 网关变更失败或被改回时由reconciler重试，未启用时只修改一次
+reconciler = Reconciler(conf.reconcile, change_gateway) if conf.reconcile.enable else None
+
+
+async def _set_state(site: SiteConfig, host: str, status: str):
+    if reconciler is not None:
+        await reconciler.want(site, host, status)
+    else:
+        await change_gateway(site, host, status)
+
+
+async def _offline(site: SiteConfig, host: str):
+    try:
+        await _set_state(site, host, "down")
+        # 从网关摘除后再执行恢复动作
+        if executor.submit(site, host):
+            log.info(f"{site.name} {host}恢复动作已加入队列")
+    except Exception as e:
+        log.exception(f"{site.name} {host}下线失败: {e}")
+
+
+async def _online(site: SiteConfig, host: str):
+    # 主机已恢复，不再需要恢复动作
+    executor.cancel(site.name, host)
+    try:
+        await _set_state(site, host, "up")
+    except Exception as e:
+        log.exception(f"{site.name} {host}上线失败: {e}")
+
+
+def submit_change(coro: Awaitable[None]):
+    """网关变更在后台执行，不阻塞检测周期"""
+    task = asyncio.ensure_future(coro)
+    _changes.add(task)
+    task.add_done_callback(_changes.discard)
+
+
+async def handle_results(site: SiteConfig, notify: AbstractAsyncNotifies,
+                         check_results: List[ErrorRecord], error_hosts: Set[str]):
+    hosts = "\n\t{}".format("\n\t".join(error_hosts))
+    for err_record in check_results:
+        if err_record.action == "offline":
+            if site.recover.enable and executor.pending(site.name, err_record.host):
+                # 已下线主机的重复offline结果: 上次的恢复动作还没结束，不重复下线和提交动作
+                log.info(f"{site.name} {err_record.host}恢复动作还在排队或执行，忽略本次下线")
+            elif site.recover.enable:
+                log.info(f"使用网关{site.gateway}对主机{err_record.host}下线")
+                submit_change(_offline(site, err_record.host))
+            if not site.recover.enable:
+                site.recover.type = "error occur"
+            log.info(f"发送{err_record.host}异常通知信息")
+            await notify.send_msgs(
+                MSG_FMT.format(
+                    time=get_time(), site=site.name, hosts=hosts,
+                    info=f"{err_record.host} {site.recover.type}",
+                    status=f"{err_record.status}",
+                    total=len(error_hosts)
+                )
+            )
+        elif err_record.action == "notify":
+            log.info(f"发送主机{err_record.host}异常通知信息")
+            await notify.send_msgs(
+                MSG_FMT.format(
+                    time=get_time(), site=site.name, hosts=hosts,
+                    info=f"{err_record.host} Error Occur",
+                    status=f"{err_record.status}",
+                    total=len(error_hosts)
+                )
+            )
+        elif err_record.action == "online":
+            if site.recover.enable:
+                log.info(f"通过网关{site.gateway}对主机{err_record.host}进行上线")
+                submit_change(_online(site, err_record.host))
+            # 恢复后发送信息
+            await notify.send_msgs(
+                MSG_FMT.format(
+                    time=get_time(), site=site.name, hosts=hosts, status=200,
+                    info=f"{err_record.host} Recover", total=len(error_hosts)
+                )
+            )
+    # 主机上/下线，重启站点动作在这里完成，避免SiteConfig对象到处传
+
+
+def get_sites() -> List[SiteConfig]:
+    sites = list()
+    for site in conf.sites:
+        if not site.servers:
+            log.warning("{} 无待检测服务器".format(site.name))
+            continue
+        sites.append(site)
+    return sites
+
+
+async def run_sites(sites: List[SiteConfig],
+                    dispatch: Callable[[SiteConfig, List[ErrorRecord], Set[str]], Awaitable[None]],
+                    apply_changes: bool = True):
+    """
+    检测sites并维护记录，需要上/下线、通知的结果交给dispatch处理。
+    apply_changes为False时(分片进程)上/下线与动作由协调进程执行，本进程不启动executor、reconciler与SSH主连接检查
+    """
+    # 检查结果记录
+    records: Dict[str, SiteRecord] = {site.name: RecordFactory.create_record(site) for site in sites}
+    client = conf.client
+    raw_client = conf.raw_client
+    limiter = conf.limiter
+    for site in sites:
+        limiter.set_quota(site.name, site.max_in_flight)
+    trackers: Dict[str, LatencyTracker] = {
+        site.name: LatencyTracker(site.name, site.latency_slo, site.duration) for site in sites
+    }
+    checks: Dict[str, SiteCheck] = {
+        site.name: SiteCheck(hostname=site.name, path=site.path, timeout=site.timeout, method=site.method,
+                             servers=site.servers, client=client, limiter=limiter, data=site.post_data,
+                             raw_client=raw_client, engine=site.engine, tracker=trackers[site.name])
+        for site in sites
+    }
+
+    gate = QuorumGate(conf.quorum) if conf.quorum.enable else None
+    if gate is not None:
+        await gate.start()
+        for record in records.values():
+            record.quorum = gate
+    snapshots = SnapshotStore(conf.snapshot) if conf.snapshot.enable else None
+    if snapshots is not None:
+        await snapshots.restore(sites, records)
+    plans: Dict[str, AdaptivePlan] = {
+        site.name: AdaptivePlan(site.adaptive, site.check_interval) for site in sites if site.adaptive.enable
+    }
+
+    def _servers_changed(site: SiteConfig, added: Set[str], removed: Set[str]):
+        """后端发现有变化，下个周期开始检测新的主机集合"""
+        checks[site.name].servers = site.servers
+        records[site.name].update_servers(site.servers, removed)
+        trackers[site.name].forget(removed)
+        if site.name in plans:
+            plans[site.name].forget(removed)
+        if reconciler is not None:
+            reconciler.forget(site.name, removed)
+
+    def _action_done(result: ActionResult):
+        """动作结果交回站点记录，多进程模式下记录在分片进程中，动作在协调进程中执行，不交回"""
+        if result.site in records and not result.cancelled:
+            records[result.site].action_done(result.host, result.ok)
+
+    # burst模式下已完成、还未记录的检测结果，检测超过deadline被取消时不丢弃
+    collected: Dict[str, List[Tuple[int, str]]] = {site.name: list() for site in sites}
+
+    async def _update(site: SiteConfig, _results: List[Tuple[int, str]], now: float):
+        record, plan = records[site.name], plans.get(site.name)
+        _results = trackers[site.name].apply(_results, asyncio.get_event_loop().time())
+        await record.update(_results)
+        if plan:
+            for _, server in _results:
+                plan.schedule(server, record.get_state(server), now)
+
+    async def _probe(site: SiteConfig) -> int:
+        plan = plans.get(site.name)
+        now = asyncio.get_event_loop().time()
+        servers = plan.due(site.servers, now) if plan else None
+        if gate is not None:
+            # 多实例分摊检测，只检测分配给本实例的主机
+            servers = [server for server in (site.servers if servers is None else servers)
+                       if gate.assigned(site.name, server)]
+        if site.schedule == "spread":
+            return await checks[site.name].spread_servers(
+                site.tick_interval, lambda _results: _update(site, _results, now), servers)
+        result = await checks[site.name].check_servers(servers, collected[site.name])
+        return len(result)
+
+    async def _settle(site: SiteConfig):
+        """get_results会修改记录，之后的dispatch必须完成，不受检测的deadline约束"""
+        record = records[site.name]
+        if collected[site.name]:
+            result, collected[site.name] = collected[site.name], list()
+            await _update(site, result, asyncio.get_event_loop().time())
+        if gate is not None:
+            gate.publish(site.name, record.get_failed_hosts())
+        check_results = await record.get_results()
+        error_hosts = record.get_error_hosts()
+        await dispatch(site, check_results, error_hosts)
+
+    scheduler = SiteScheduler(sites, _probe, _settle, conf.report_interval)
+    scheduler.add_reporter(client.stats)
+    scheduler.add_reporter(raw_client.stats)
+    scheduler.add_reporter(limiter.report)
+    for tracker in trackers.values():
+        scheduler.add_reporter(tracker.stats)
+    if gate is not None:
+        scheduler.add_reporter(gate.stats)
+        asyncio.ensure_future(gate.run())
+    if snapshots is not None:
+        scheduler.add_reporter(snapshots.stats)
+        asyncio.ensure_future(snapshots.run(records))
+    if conf.discovery.enable:
+        discovery = Discovery(conf.discovery, sites, _servers_changed)
+        scheduler.add_reporter(discovery.stats)
+        asyncio.ensure_future(discovery.run())
+    ssh_pool = conf.ssh_pool
+    if apply_changes:
+        if ssh_pool.sessions:
+            scheduler.add_reporter(ssh_pool.stats)
+            scheduler.add_reporter(NGINXGateway.reload_stats)
+            asyncio.ensure_future(ssh_pool.run())
+        executor.add_listener(_action_done)
+        scheduler.add_reporter(executor.stats)
+        asyncio.ensure_future(executor.run())
+        if reconciler is not None:
+            scheduler.add_reporter(reconciler.stats)
+            asyncio.ensure_future(reconciler.run())
+    if any(isinstance(site.gateway, AliyunSLBGateway) for site in sites):
+        scheduler.add_reporter(AliyunSLBGateway.slb_stats)
+    try:
+        await scheduler.run()
+    finally:
+        await client.close()
+        await raw_client.close()
+        await NGINXAPIGateway.close()
+        await AliyunSLBGateway.close()
+        if apply_changes:
+            # 分片进程继承了协调进程的主连接状态，主连接由协调进程关闭
+            ssh_pool.close()
+        if gate is not None:
+            gate.close()
+        if snapshots is not None:
+            # 退出前保存最后一次快照
+            snapshots.save(snapshots.export(records))
 
 
 async def main():
     log.info("程序启动....")
     notify = conf.notify
-    sites = conf.sites
-    # 检查结果记录
-    records: Dict[str, SiteRecord] = {site.name: SiteRecord(site) for site in sites}
-    msg_fmt = "Time:\t{time}\nDomain:\t{site}\nErrHosts:\t{hosts}\nInfo:\t{info},latest status {status}\n"
-    "TotalError:\t{total}"
-    while True:
-        for site in sites:
-            if not site.servers:
-                log.warning("{} 无待检测服务器".format(site.name))
-                continue
-            # task = AsyncCheck().checks(site.name, site.path, site.servers, site.timeout)
-            task = SiteCheck(hostname=site.name, path=site.path, timeout=site.timeout,
-                             method=site.method, servers=site.servers, data=site.post_data).check_servers()
-            result = await task
-            await records[site.name].update(result)
-            check_results = await records[site.name].get_results()
-            error_hosts = records[site.name].get_error_hosts()
-            hosts = "\n\t{}".format("\n\t".join(error_hosts))
-            for err_record in check_results:
-                if err_record.action == "offline":
-                    if site.recover.enable:
-                        log.info(f"使用网关{site.gateway}对主机{err_record.host}下线")
-                        site.gateway.change_server_offline(err_record.host)
-                        action = ActionFactory.create_action(site, err_record.host)
-                        log.info("启动Action线程....")
-                        action.start()
-                    if not site.recover.enable:
-                        site.recover.type = "error occur"
-                    log.info(f"发送{err_record.host}异常通知信息")
-                    await notify.send_msgs(
-                        msg_fmt.format(
-                            time=get_time(), site=site.name, hosts=hosts,
-                            info=f"{err_record.host} {site.recover.type}",
-                            status=f"{err_record.status}",
-                            total=len(error_hosts)
-                        )
-                    )
-                elif err_record.action == "notify":
-                    log.info(f"发送主机{err_record.host}异常通知信息")
-                    await notify.send_msgs(
-                        msg_fmt.format(
-                            time=get_time(), site=site.name, hosts=hosts,
-                            info=f"{err_record.host} Error Occur",
-                            status=f"{err_record.status}",
-                            total=len(error_hosts)
-                        )
-                    )
-                elif err_record.action == "online":
-                    if site.recover.enable:
-                        log.info(f"通过网关{site.gateway}对主机{err_record.host}进行上线")
-                        site.gateway.change_server_online(err_record.host)
-                    # 恢复后发送信息
-                    await notify.send_msgs(
-                        msg_fmt.format(
-                            time=get_time(), site=site.name, hosts=hosts, status=200,
-                            info=f"{err_record.host} Recover", total=len(error_hosts)
-                        )
-                    )
-            # 主机上/下线，重启站点动作在这里完成，避免SiteConfig对象到处传
-        time.sleep(conf.check_interval)
+
+    async def _dispatch(site: SiteConfig, check_results: List[ErrorRecord], error_hosts: Set[str]):
+        await handle_results(site, notify, check_results, error_hosts)
+
+    await run_sites(get_sites(), _dispatch)
+
+
+def shard_worker(sites: List[SiteConfig], queue: multiprocessing.Queue):
+    """
+    分片进程: 只检测分到的站点并维护这些站点的记录，站点的记录只在一个进程中，
+    max_inactive等策略不受分片影响。上/下线、动作与通知交回协调进程执行
+    """
+    async def _dispatch(site: SiteConfig, check_results: List[ErrorRecord], error_hosts: Set[str]):
+        if check_results:
+            queue.put(dict(site=site.name, error_hosts=sorted(error_hosts),
+                           results=[(r.host, r.status, r.action) for r in check_results]))
+
+    asyncio.run(run_sites(sites, _dispatch, apply_changes=False))
+
+
+async def coordinate(coordinator: ShardCoordinator, sites: List[SiteConfig]):
+    log.info("程序启动(多进程模式)....")
+    notify = conf.notify
+    site_map = {site.name: site for site in sites}
+    # 多进程模式下上/下线与动作都在协调进程中执行
+    reporters: List[Callable[[], str]] = [coordinator.stats, executor.stats]
+    asyncio.ensure_future(executor.run())
+    if reconciler is not None:
+        reporters.append(reconciler.stats)
+        asyncio.ensure_future(reconciler.run())
+    ssh_pool = conf.ssh_pool
+    if ssh_pool.sessions:
+        reporters.append(ssh_pool.stats)
+        asyncio.ensure_future(ssh_pool.run())
+
+    async def _report():
+        """检测速率等统计由分片进程输出，协调进程只输出分片进程与上/下线、动作的统计"""
+        while True:
+            await asyncio.sleep(conf.report_interval)
+            for reporter in reporters:
+                log.info(reporter())
+
+    asyncio.ensure_future(_report())
+    try:
+        async for event in coordinator.events():
+            results = [ErrorRecord(host, status, action) for host, status, action in event["results"]]
+            await handle_results(site_map[event["site"]], notify, results, set(event["error_hosts"]))
+    finally:
+        ssh_pool.close()
+
+
+def run(event_loop: str = None):
+    loop_name = install_event_loop(event_loop if event_loop else conf.event_loop)
+    log.info(f"使用{loop_name}事件循环")
+    if conf.workers <= 1:
+        asyncio.run(main())
+        return
+    assert not conf.quorum.enable, "quorum mode does not support multiple workers"
+    sites = get_sites()
+    # 分片进程要在事件循环启动之前创建，fork出的进程沿用已安装的事件循环实现
+    coordinator = ShardCoordinator(sites, conf.workers, shard_worker,
+                                   weight=lambda site: len(site.servers) / site.check_interval)
+    coordinator.start()
+    try:
+        asyncio.run(coordinate(coordinator, sites))
+    finally:
+        coordinator.stop()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="monitor-auto")
+    parser.add_argument("--loop", choices=("asyncio", "uvloop"), help="event loop, overrides config.yml")
+    run(parser.parse_args().loop)
@@ -0,0 +1,190 @@
+from bisect import bisect_left
+from typing import List, Tuple, Dict, Iterable, Optional
+
+from utils import SimpleLog
+
+# 延迟直方图默认的桶上限(毫秒)，最后一个桶为超过10秒
+BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+DEFAULT_WINDOW_SLOTS = 6
+# 延迟超过SLO时作为失败交给SiteRecord的状态码，与检测超时一致
+SLOW_STATUS = 504
+log = SimpleLog(__name__).log
+
+
+class LatencyHistogram(object):
+    """固定桶的延迟直方图，只保存每个桶的计数，合并的直方图要使用相同的桶"""
+    def __init__(self, bounds: Tuple[float, ...] = BUCKETS_MS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0
+        self.sum = 0.0
+
+    def __repr__(self) -> str:
+        return f"LatencyHistogram(total={self.total}, p95={self.quantile(0.95)})"
+
+    def observe(self, ms: float):
+        self.counts[bisect_left(self.bounds, ms)] += 1
+        self.total += 1
+        self.sum += ms
+
+    def merge(self, other: "LatencyHistogram"):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.total += other.total
+        self.sum += other.sum
+
+    def clear(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0
+        self.sum = 0.0
+
+    def quantile(self, q: float) -> float:
+        """分位数在所在桶的上下限之间按计数线性插值，不会超过桶的上限，超过最大桶时为inf"""
+        if not self.total:
+            return 0.0
+        rank, cumulative = q * self.total, 0
+        for i, count in enumerate(self.counts):
+            if count and cumulative + count >= rank:
+                if i == len(self.bounds):
+                    return float("inf")
+                lower = self.bounds[i - 1] if i else 0.0
+                return round(lower + (self.bounds[i] - lower) * (rank - cumulative) / count, 1)
+            cumulative += count
+        return float("inf")
+
+    @property
+    def mean(self) -> float:
+        return self.sum / self.total if self.total else 0.0
+
+    def to_dict(self) -> dict:
+        buckets = {f"le_{bound}": count for bound, count in zip(self.bounds, self.counts)}
+        buckets["le_inf"] = self.counts[-1]
+        return dict(total=self.total, mean=round(self.mean, 1), p50=self.quantile(0.5),
+                    p95=self.quantile(0.95), p99=self.quantile(0.99), buckets=buckets)
+
+
+class WindowHistogram(object):
+    """
+    滑动窗口直方图，window秒分成slots片，每片一个固定桶直方图，
+    过期的分片整体清零后复用，不保存单个样本
+    """
+    def __init__(self, window: float, slots: int = DEFAULT_WINDOW_SLOTS, bounds: Tuple[float, ...] = BUCKETS_MS):
+        self.slot_width = window / slots
+        self.bounds = bounds
+        self._slots = [LatencyHistogram(bounds) for _ in range(slots)]
+        self._epochs = [-1] * slots
+
+    def __repr__(self) -> str:
+        return f"WindowHistogram(window={self.slot_width * len(self._slots)})"
+
+    def observe(self, ms: float, now: float):
+        epoch = int(now // self.slot_width)
+        index = epoch % len(self._slots)
+        if self._epochs[index] != epoch:
+            self._slots[index].clear()
+            self._epochs[index] = epoch
+        self._slots[index].observe(ms)
+
+    def snapshot(self, now: float) -> LatencyHistogram:
+        epoch = int(now // self.slot_width)
+        result = LatencyHistogram(self.bounds)
+        for slot, slot_epoch in zip(self._slots, self._epochs):
+            if epoch - slot_epoch < len(self._slots):
+                result.merge(slot)
+        return result
+
+
+class LatencySLO(object):
+    """站点延迟SLO，例如duration窗口内p95不超过2000ms，样本数不足min_samples时不判定"""
+    def __init__(self, data: dict):
+        self.quantile = data.get("quantile", 0.95)
+        self.threshold = data.get("threshold", 0)
+        self.min_samples = data.get("min_samples", 5)
+        assert 0 < self.quantile < 1 \
+               and isinstance(self.threshold, (int, float)) \
+               and isinstance(self.min_samples, int), "Config file latency_slo section error"
+
+    def __repr__(self) -> str:
+        return f"LatencySLO(p{self.quantile * 100:g}<={self.threshold}ms)"
+
+    @property
+    def enable(self) -> bool:
+        return self.threshold > 0
+
+
+class LatencyTracker(object):
+    """
+    单个站点的延迟统计: 站点与每个主机的累计直方图、每个主机duration窗口内的直方图，
+    以及按SLO对每个主机的判定结果。超过SLO的主机本次检测按失败交给SiteRecord。
+    SLO的阈值是桶的边界之一，阈值以下的样本不会因为所在的桶跨过阈值而被判定超过SLO
+    """
+    def __init__(self, site: str, slo: LatencySLO, window: float):
+        self.site = site
+        self.slo = slo
+        self.window = window
+        self.bounds = tuple(sorted(set(BUCKETS_MS) | {slo.threshold})) if slo.enable else BUCKETS_MS
+        self.histogram = LatencyHistogram(self.bounds)
+        self.hosts: Dict[str, LatencyHistogram] = dict()
+        self._windows: Dict[str, WindowHistogram] = dict()
+        # 主机 -> (窗口内分位数, 是否超过SLO)
+        self.decisions: Dict[str, Tuple[float, bool]] = dict()
+
+    def __repr__(self) -> str:
+        return f"LatencyTracker(site={self.site}, slo={self.slo})"
+
+    def observe(self, server: str, ms: float, now: float):
+        self.histogram.observe(ms)
+        if server not in self.hosts:
+            self.hosts[server] = LatencyHistogram(self.bounds)
+            self._windows[server] = WindowHistogram(self.window, bounds=self.bounds)
+        self.hosts[server].observe(ms)
+        self._windows[server].observe(ms, now)
+
+    def is_breached(self, server: str, now: float) -> bool:
+        if not self.slo.enable or server not in self._windows:
+            return False
+        window = self._windows[server].snapshot(now)
+        value = window.quantile(self.slo.quantile)
+        breached = window.total >= self.slo.min_samples and value > self.slo.threshold
+        if breached and not self.decisions.get(server, (0, False))[1]:
+            log.info(f"{self.site} {server} p{self.slo.quantile * 100:g}={value}ms 超过SLO {self.slo.threshold}ms")
+        self.decisions[server] = (value, breached)
+        return breached
+
+    def apply(self, results: List[Tuple[int, str]], now: float) -> List[Tuple[int, str]]:
+        """状态正常但延迟超过SLO的结果改为失败状态"""
+        if not self.slo.enable:
+            return results
+        return [(SLOW_STATUS, server) if status <= 400 and self.is_breached(server, now) else (status, server)
+                for status, server in results]
+
+    def forget(self, servers: Iterable[str]):
+        """站点移除的主机不再统计，站点的累计直方图保留"""
+        for server in servers:
+            self.hosts.pop(server, None)
+            self._windows.pop(server, None)
+            self.decisions.pop(server, None)
+
+    def breached_hosts(self) -> List[str]:
+        return [server for server, (_, breached) in self.decisions.items() if breached]
+
+    def query(self, server: Optional[str] = None) -> dict:
+        """查询站点或单个主机的直方图与SLO判定"""
+        if server is None:
+            return dict(site=self.site, histogram=self.histogram.to_dict(), breached=self.breached_hosts())
+        value, breached = self.decisions.get(server, (0.0, False))
+        histogram = self.hosts.get(server, LatencyHistogram(self.bounds))
+        return dict(site=self.site, host=server, histogram=histogram.to_dict(),
+                    window_quantile=value, breached=breached)
+
+    def stats(self) -> str:
+        summary = self.query()
+        histogram = summary["histogram"]
+        msg = (f"{self.site} 延迟: {histogram['total']}次, 平均{histogram['mean']}ms p50={histogram['p50']}ms "
+               f"p95={histogram['p95']}ms p99={histogram['p99']}ms")
+        if self.hosts:
+            slowest = max(self.hosts, key=lambda server: self.hosts[server].quantile(0.95))
+            msg += f", 最慢主机{slowest} p95={self.query(slowest)['histogram']['p95']}ms"
+        if self.slo.enable:
+            msg += f", 超过SLO主机{summary['breached']}"
+        return msg
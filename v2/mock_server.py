@@ -0,0 +1,267 @@
+"""
+本地替身服务，在没有真实后端与网关的环境下测试和压测使用
+
+    python mock_server.py backends --port 18080 --count 50
+    python mock_server.py upstream_api --port 18000 --upstream backend --servers 10.0.0.1:80 10.0.0.2:80
+    python mock_server.py slb_api --port 18100 --id lb-test --servers 10.0.0.1:80 10.0.0.2:80
+"""
+import json
+import asyncio
+import argparse
+from typing import Set, List, Dict
+
+from aiohttp import web
+
+from gateway import slb_signature
+from utils import SimpleLog
+
+log = SimpleLog(__name__).log
+
+
+class MockBackends(object):
+    """
+    极简的HTTP/1.1后端，一个端口代表一个后端主机，支持keep-alive。
+    端口在failing中时返回500，用来模拟后端异常
+    """
+    def __init__(self):
+        self.failing: Set[int] = set()
+        self.requests = 0
+        self._servers: List[asyncio.AbstractServer] = list()
+
+    def __repr__(self) -> str:
+        return f"MockBackends(ports={len(self._servers)}, failing={len(self.failing)})"
+
+    def _protocol(self, port: int) -> asyncio.Protocol:
+        backends = self
+
+        class _BackendProtocol(asyncio.Protocol):
+            def __init__(self):
+                self.transport = None
+                self.buffer = b""
+
+            def connection_made(self, transport):
+                self.transport = transport
+
+            def data_received(self, data: bytes):
+                self.buffer += data
+                while b"\r\n\r\n" in self.buffer:
+                    head, _, rest = self.buffer.partition(b"\r\n\r\n")
+                    length = 0
+                    for line in head.split(b"\r\n")[1:]:
+                        name, _, value = line.partition(b":")
+                        if name.strip().lower() == b"content-length":
+                            length = int(value.strip())
+                    if len(rest) < length:
+                        return
+                    self.buffer = rest[length:]
+                    backends.requests += 1
+                    if port in backends.failing:
+                        status, body = b"500 Internal Server Error", b"error"
+                    else:
+                        status, body = b"200 OK", b"ok"
+                    response = b"HTTP/1.1 " + status + b"\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n"
+                    if not head.startswith(b"HEAD"):
+                        response += body
+                    self.transport.write(response)
+
+        return _BackendProtocol()
+
+    async def start(self, port: int, count: int = 1, host: str = "127.0.0.1") -> List[str]:
+        """启动count个后端，返回"host:port"形式的后端列表"""
+        loop = asyncio.get_event_loop()
+        servers = list()
+        for _port in range(port, port + count):
+            server = await loop.create_server(lambda p=_port: self._protocol(p), host, _port)
+            self._servers.append(server)
+            servers.append(f"{host}:{_port}")
+        return servers
+
+    async def close(self):
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        self._servers.clear()
+
+
+class MockUpstreamAPI(object):
+    """
+    动态upstream接口的替身，接口与NGINX Plus API的upstream部分一致:
+    GET /api/9/http/upstreams/{upstream}/servers, PATCH /api/9/http/upstreams/{upstream}/servers/{id}。
+    delay为每个请求的额外延迟(秒)，用来模拟慢的NGINX
+    """
+    prefix = "/api/9"
+
+    def __init__(self, upstreams: Dict[str, List[str]], delay: float = 0):
+        self.delay = delay
+        self.upstreams: Dict[str, List[dict]] = {
+            name: [dict(id=i, server=server, weight=1, down=False) for i, server in enumerate(servers)]
+            for name, servers in upstreams.items()
+        }
+        self.requests = 0
+        self.patches = 0
+        self._runner = None
+
+    def __repr__(self) -> str:
+        return f"MockUpstreamAPI(upstreams={list(self.upstreams)}, patches={self.patches})"
+
+    def down_servers(self, upstream: str) -> Set[str]:
+        return {peer["server"] for peer in self.upstreams.get(upstream, []) if peer["down"]}
+
+    async def _list(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await asyncio.sleep(self.delay)
+        peers = self.upstreams.get(request.match_info["upstream"])
+        if peers is None:
+            return web.json_response({"error": {"status": 404, "text": "upstream not found"}}, status=404)
+        return web.json_response(peers)
+
+    async def _patch(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await asyncio.sleep(self.delay)
+        peers = self.upstreams.get(request.match_info["upstream"], [])
+        server_id = int(request.match_info["id"])
+        for peer in peers:
+            if peer["id"] == server_id:
+                data = await request.json()
+                for key in ("down", "weight"):
+                    if key in data:
+                        peer[key] = data[key]
+                self.patches += 1
+                return web.json_response(peer)
+        return web.json_response({"error": {"status": 404, "text": "server not found"}}, status=404)
+
+    async def start(self, port: int, host: str = "127.0.0.1") -> str:
+        """返回接口地址，作为gateway.nginx_api.endpoints的一项"""
+        app = web.Application()
+        app.router.add_get(self.prefix + "/http/upstreams/{upstream}/servers", self._list)
+        app.router.add_patch(self.prefix + "/http/upstreams/{upstream}/servers/{id}", self._patch)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        return f"http://{host}:{port}{self.prefix}"
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+class MockSLBAPI(object):
+    """
+    阿里云SLB接口的替身，校验签名，支持DescribeHealthStatus、DescribeLoadBalancerAttribute与SetBackendServers。
+    每个主机(ip:port)对应一个ECS实例，ServerId为i-序号；delay为每个请求的额外延迟(秒)
+    """
+    def __init__(self, lb_id: str, port: int, servers: List[str], key: str = "key", secret: str = "secret",
+                 delay: float = 0):
+        self.lb_id = lb_id
+        self.port = port
+        self.key = key
+        self.secret = secret
+        self.delay = delay
+        self.backends: Dict[str, dict] = {
+            f"i-{i}": dict(ServerId=f"i-{i}", ServerIp=server.rpartition(":")[0],
+                           Port=int(server.rpartition(":")[2]), Weight=100)
+            for i, server in enumerate(servers)
+        }
+        self.requests = 0
+        self.sets = 0
+        self._runner = None
+
+    def __repr__(self) -> str:
+        return f"MockSLBAPI(id={self.lb_id}, backends={len(self.backends)}, sets={self.sets})"
+
+    def down_servers(self) -> Set[str]:
+        return {f"{b['ServerIp']}:{b['Port']}" for b in self.backends.values() if b["Weight"] == 0}
+
+    @staticmethod
+    def _error(code: str, message: str, status: int = 400) -> web.Response:
+        return web.json_response({"Code": code, "Message": message, "RequestId": "mock"}, status=status)
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        self.requests += 1
+        await asyncio.sleep(self.delay)
+        params = dict(request.query)
+        signature = params.pop("Signature", "")
+        if params.get("AccessKeyId") != self.key:
+            return self._error("InvalidAccessKeyId.NotFound", "Specified access key is not found.", 404)
+        if signature != slb_signature(self.secret, request.method, params):
+            return self._error("SignatureDoesNotMatch", "Specified signature is not matched with our calculation.")
+        if params.get("LoadBalancerId") != self.lb_id:
+            return self._error("InvalidLoadBalancerId.NotFound", "The specified LoadBalancerId does not exist.")
+        action = params.get("Action")
+        if action == "DescribeHealthStatus":
+            backends = [dict(b, ListenerPort=self.port, ServerHealthStatus="normal") for b in self.backends.values()]
+            return web.json_response({"BackendServers": {"BackendServer": backends}})
+        if action == "DescribeLoadBalancerAttribute":
+            backends = [dict(ServerId=b["ServerId"], Weight=b["Weight"], Type="ecs") for b in self.backends.values()]
+            return web.json_response({"LoadBalancerId": self.lb_id, "BackendServers": {"BackendServer": backends}})
+        if action == "SetBackendServers":
+            changes = json.loads(params.get("BackendServers", "[]"))
+            if len(changes) > 20 or any(c.get("ServerId") not in self.backends for c in changes):
+                return self._error("InvalidParameter", "BackendServers is invalid.")
+            for change in changes:
+                self.backends[change["ServerId"]]["Weight"] = int(change["Weight"])
+            self.sets += 1
+            return web.json_response({"LoadBalancerId": self.lb_id, "BackendServers": {"BackendServer": changes}})
+        return self._error("InvalidAction.NotFound", f"Specified api {action} is not found.", 404)
+
+    async def start(self, port: int, host: str = "127.0.0.1") -> str:
+        """返回接口地址，作为gateway.slb.endpoint"""
+        app = web.Application()
+        app.router.add_get("/", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        return f"http://{host}:{port}"
+
+    async def close(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+async def _serve_backends(port: int, count: int):
+    backends = MockBackends()
+    servers = await backends.start(port, count)
+    log.info(f"mock backends listening on {servers[0]} ~ {servers[-1]}")
+    await asyncio.Event().wait()
+
+
+async def _serve_upstream_api(port: int, upstream: str, servers: List[str], delay: float):
+    api = MockUpstreamAPI({upstream: servers}, delay)
+    endpoint = await api.start(port)
+    log.info(f"mock upstream api listening on {endpoint}, upstream {upstream}: {servers}")
+    await asyncio.Event().wait()
+
+
+async def _serve_slb_api(port: int, lb_id: str, listener: int, servers: List[str], delay: float):
+    api = MockSLBAPI(lb_id, listener, servers, delay=delay)
+    endpoint = await api.start(port)
+    log.info(f"mock slb api listening on {endpoint}, {lb_id}:{listener}: {servers}")
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="local stand-in services")
+    sub = parser.add_subparsers(dest="service", required=True)
+    _backends = sub.add_parser("backends", help="HTTP backends, one per port")
+    _backends.add_argument("--port", type=int, default=18080)
+    _backends.add_argument("--count", type=int, default=50)
+    _api = sub.add_parser("upstream_api", help="dynamic upstream API (NGINX Plus compatible)")
+    _api.add_argument("--port", type=int, default=18000)
+    _api.add_argument("--upstream", default="backend")
+    _api.add_argument("--servers", nargs="+", default=["127.0.0.1:18080"])
+    _api.add_argument("--delay", type=float, default=0, help="extra seconds per request")
+    _slb = sub.add_parser("slb_api", help="Aliyun SLB backend server API (key/secret: key/secret)")
+    _slb.add_argument("--port", type=int, default=18100)
+    _slb.add_argument("--id", default="lb-test")
+    _slb.add_argument("--listener", type=int, default=80, help="SLB listener port")
+    _slb.add_argument("--servers", nargs="+", default=["127.0.0.1:18080"])
+    _slb.add_argument("--delay", type=float, default=0, help="extra seconds per request")
+    args = parser.parse_args()
+    if args.service == "backends":
+        asyncio.run(_serve_backends(args.port, args.count))
+    elif args.service == "upstream_api":
+        asyncio.run(_serve_upstream_api(args.port, args.upstream, args.servers, args.delay))
+    elif args.service == "slb_api":
+        asyncio.run(_serve_slb_api(args.port, args.id, args.listener, args.servers, args.delay))
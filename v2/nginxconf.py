@@ -0,0 +1,90 @@
+import re
+import hashlib
+from typing import List, Dict, Set, Optional
+
+# server行，可能已被注释: "    #server 10.0.0.1:80 weight=1;"
+_SERVER_RE = re.compile(r"^\s*(#+)?\s*server\s+([^\s;#]+)")
+_UPSTREAM_RE = re.compile(r"^\s*upstream\s+(\S+)\s*\{")
+
+
+class UpstreamServer(object):
+    __slots__ = ("address", "port", "line", "commented", "upstream")
+
+    def __init__(self, address: str, port: Optional[int], line: int, commented: bool, upstream: str):
+        self.address = address
+        self.port = port
+        # 在配置文件中的行号，从1开始
+        self.line = line
+        self.commented = commented
+        self.upstream = upstream
+
+    def __repr__(self) -> str:
+        return f"UpstreamServer({'#' if self.commented else ''}{self.address}, line={self.line})"
+
+
+class NGINXConfig(object):
+    """
+    一个NGINX配置文件中upstream块的server索引: 主机 -> 行号、端口与是否被注释。
+    被注释的server即已下线的主机，与sed修改的规则一致
+    """
+    def __init__(self, name: str, servers: List[UpstreamServer], digest: str = "", mtime: int = 0):
+        self.name = name
+        self.digest = digest
+        self.mtime = mtime
+        self.servers = servers
+        self._index: Dict[str, List[UpstreamServer]] = dict()
+        self._ports: Dict[Optional[int], List[UpstreamServer]] = dict()
+        for server in servers:
+            self._index.setdefault(server.address, list()).append(server)
+            self._ports.setdefault(server.port, list()).append(server)
+
+    def __repr__(self) -> str:
+        return f"NGINXConfig({self.name}, servers={len(self.servers)}, mtime={self.mtime})"
+
+    @classmethod
+    def parse(cls, name: str, text: str, digest: str = "", mtime: int = 0) -> "NGINXConfig":
+        """digest为远程md5sum的结果，为空时按text计算"""
+        servers: List[UpstreamServer] = list()
+        upstream, depth = None, 0
+        for number, line in enumerate(text.splitlines(), 1):
+            if upstream is None:
+                match = _UPSTREAM_RE.match(line)
+                if match:
+                    upstream, depth = match.group(1), 0
+                else:
+                    continue
+            match = _SERVER_RE.match(line)
+            if match:
+                address = match.group(2)
+                _, _, port = address.rpartition(":")
+                servers.append(UpstreamServer(address, int(port) if port.isdigit() else None,
+                                              number, bool(match.group(1)), upstream))
+            # 注释中的括号不计入层级
+            code = line.split("#", 1)[0]
+            depth += code.count("{") - code.count("}")
+            if depth <= 0:
+                upstream = None
+        return cls(name, servers, digest if digest else hashlib.md5(text.encode()).hexdigest(), mtime)
+
+    def servers_by_port(self, port: int) -> Set[str]:
+        """所有使用port端口的后端，包括已下线的"""
+        return {server.address for server in self._ports.get(port, [])}
+
+    def offline_servers(self, port: int) -> Set[str]:
+        return {server.address for server in self._ports.get(port, []) if server.commented}
+
+    def state(self, address: str) -> Optional[str]:
+        """up: 所有行都未注释; down: 都已注释; None: 没有该主机或状态不一致"""
+        lines = self._index.get(address)
+        if not lines:
+            return None
+        commented = {line.commented for line in lines}
+        if len(commented) > 1:
+            return None
+        return "down" if commented.pop() else "up"
+
+    def set_state(self, address: str, status: str):
+        """远程修改成功后同步到本地索引，本地索引不再对应digest，下次获取时重新解析"""
+        for line in self._index.get(address, []):
+            line.commented = status == "down"
+        self.digest = ""
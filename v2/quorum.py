@@ -0,0 +1,224 @@
+import json
+import time
+import zlib
+import asyncio
+import hashlib
+from typing import List, Dict, Set, Tuple, Optional
+
+from utils import SimpleLog
+
+DEFAULT_TTL = 10
+DEFAULT_FLUSH_INTERVAL = 1
+# 单个UDP包的最大字节数，超过时按站点拆成多个包
+MAX_DATAGRAM = 60000
+log = SimpleLog(__name__).log
+
+
+class QuorumConfig(object):
+    def __init__(self, data: dict):
+        self.enable = data.get("enable", False)
+        self.instance = data.get("instance", "")
+        # 实例名 -> UDP地址，所有实例使用同样的members配置
+        self.members: Dict[str, str] = data.get("members", {})
+        self.quorum = data.get("quorum", 2)
+        self.ttl = data.get("ttl", DEFAULT_TTL)
+        self.flush_interval = data.get("flush_interval", DEFAULT_FLUSH_INTERVAL)
+        # 分摊检测: 每个主机只由replicas个实例检测
+        self.share_load = data.get("share_load", True)
+        self.replicas = data.get("replicas", self.quorum)
+        if self.enable:
+            assert self.instance in self.members \
+                   and 0 < self.quorum <= self.replicas <= len(self.members), "Config file quorum section error"
+
+    def __repr__(self) -> str:
+        return f"QuorumConfig(instance={self.instance}, quorum={self.quorum}/{len(self.members)})"
+
+
+class _VerdictProtocol(asyncio.DatagramProtocol):
+    def __init__(self, gate: "QuorumGate"):
+        self.gate = gate
+
+    def datagram_received(self, data: bytes, addr: Tuple[str, int]):
+        try:
+            message = json.loads(zlib.decompress(data))
+        except (zlib.error, ValueError) as e:
+            log.warning(f"收到无法解析的判定数据{addr}: {e}")
+            return
+        self.gate.receive(message)
+
+
+class QuorumGate(object):
+    """
+    多个监控实例之间共享检测判定，主机下线需要quorum个实例都判定失败。
+    每个实例每flush_interval把所有站点的失败主机与本实例下线的主机压缩后批量发给其他实例，
+    判定最多晚一个周期生效; 开启share_load时每个主机只由replicas个实例检测，站点的leader检测所有主机。
+    每个站点只由排在最前面的存活实例(leader)执行下线，max_inactive按所有实例下线的主机计算。
+    leader接管其他实例(包括已宕掉的实例最后一次上报的)下线的主机，之后由它负责上线，
+    被接管的实例不再上报这些主机
+    """
+    def __init__(self, conf: QuorumConfig):
+        self.conf = conf
+        self.instance = conf.instance
+        self._members = sorted(conf.members)
+        self._peers = {name: self._address(addr) for name, addr in conf.members.items() if name != conf.instance}
+        self._local: Dict[str, Set[str]] = dict()
+        # 站点 -> 实例 -> (收到时间, 失败主机)
+        self._votes: Dict[str, Dict[str, Tuple[float, Set[str]]]] = dict()
+        # 站点 -> 本实例下线、由本实例负责上线的主机
+        self._inactive: Dict[str, Set[str]] = dict()
+        # 站点 -> 实例 -> 最后一次上报的下线主机，实例宕掉后保留，由leader接管
+        self._offline: Dict[str, Dict[str, Set[str]]] = dict()
+        # 站点 -> 实例 -> 已从该实例接管的主机，该实例不再上报时移除
+        self._adopted: Dict[str, Dict[str, Set[str]]] = dict()
+        self._seen: Dict[str, float] = dict()
+        self._started = time.time()
+        self._transport: Optional[asyncio.DatagramTransport] = None
+        self.sent = 0
+        self.received = 0
+
+    def __repr__(self) -> str:
+        return f"QuorumGate(instance={self.instance}, peers={list(self._peers)})"
+
+    @staticmethod
+    def _address(addr: str) -> Tuple[str, int]:
+        host, _, port = addr.rpartition(":")
+        return host, int(port)
+
+    def _alive(self, name: str, now: float) -> bool:
+        return name == self.instance or now - self._seen.get(name, 0) <= self.conf.ttl
+
+    def _rank(self, key: str) -> List[str]:
+        """rendezvous hash，所有实例对同一个key算出相同的顺序"""
+        def _score(name: str) -> bytes:
+            return hashlib.md5(f"{name}/{key}".encode()).digest()
+        return sorted(self._members, key=_score, reverse=True)
+
+    def assigned(self, site: str, host: str) -> bool:
+        """
+        本实例是否需要检测该主机，宕掉的实例负责的主机由后面的实例补上;
+        本实例下线的主机始终由本实例检测，恢复后由它上线; 只有leader能下线主机，下线需要它自己的失败记录
+        """
+        if not self.conf.share_load or host in self._inactive.get(site, ()):
+            return True
+        if self.leader(site) == self.instance:
+            return True
+        now = time.time()
+        alive = [name for name in self._rank(f"{site}/{host}") if self._alive(name, now)]
+        return self.instance in alive[:self.conf.replicas]
+
+    def leader(self, site: str) -> Optional[str]:
+        """站点的leader，启动后ttl秒内还不知道其他实例是否存活，返回None"""
+        now = time.time()
+        if now - self._started < self.conf.ttl:
+            return None
+        return [name for name in self._rank(site) if self._alive(name, now)][0]
+
+    def publish(self, site: str, failed: Set[str]):
+        self._local[site] = set(failed)
+
+    def sync(self, site: str, inactive: Set[str]) -> Tuple[bool, Set[str], Set[str]]:
+        """
+        返回(本实例是否为站点的leader, 需要接管的主机, 已被leader接管、需要释放的主机)。
+        leader接管其他实例上报的、还未接管过的下线主机; 其他实例释放leader已上报的主机
+        """
+        leader = self.leader(site)
+        if leader is None:
+            return False, set(), set()
+        reports = self._offline.get(site, {})
+        if leader != self.instance:
+            return False, set(), inactive & reports.get(leader, set())
+        adopt, adopted = set(), self._adopted.setdefault(site, dict())
+        for name, hosts in reports.items():
+            adopt |= hosts - adopted.get(name, set()) - inactive
+            adopted[name] = set(hosts)
+        return True, adopt, set()
+
+    def handing_over(self, site: str, host: str) -> bool:
+        """存活的其他实例还在上报该主机(交接未完成)，上线要等它释放，否则它看不到leader上报该主机，不会再释放"""
+        now = time.time()
+        return any(host in hosts and self._alive(name, now) for name, hosts in self._offline.get(site, {}).items())
+
+    def set_inactive(self, site: str, inactive: Set[str]):
+        """本实例负责的下线主机，下次发送时上报"""
+        self._inactive[site] = set(inactive)
+
+    def inactive_count(self, site: str, inactive: Set[str]) -> int:
+        """所有实例下线的主机数: 本实例与存活的其他实例上报的下线主机"""
+        now = time.time()
+        hosts = set(inactive)
+        for name, reported in self._offline.get(site, {}).items():
+            if self._alive(name, now):
+                hosts |= reported
+        return len(hosts)
+
+    def receive(self, message: dict):
+        now = time.time()
+        name = message.get("i")
+        if name not in self._peers:
+            return
+        self.received += 1
+        self._seen[name] = now
+        for site, hosts in message.get("s", {}).items():
+            self._votes.setdefault(site, {})[name] = (now, set(hosts))
+        for site, hosts in message.get("o", {}).items():
+            self._offline.setdefault(site, {})[name] = set(hosts)
+
+    def votes(self, site: str, host: str) -> int:
+        now = time.time()
+        count = 1 if host in self._local.get(site, set()) else 0
+        for name, (received, hosts) in self._votes.get(site, {}).items():
+            if now - received <= self.conf.ttl and host in hosts:
+                count += 1
+        return count
+
+    def allow_offline(self, site: str, host: str) -> bool:
+        if self.votes(site, host) < self.conf.quorum:
+            return False
+        return self.leader(site) == self.instance
+
+    def _pack(self, chunk: Dict[str, Tuple[List[str], List[str]]]) -> bytes:
+        failed = {site: item[0] for site, item in chunk.items()}
+        offline = {site: item[1] for site, item in chunk.items()}
+        return zlib.compress(json.dumps(dict(i=self.instance, s=failed, o=offline), separators=(",", ":")).encode())
+
+    def _encode(self) -> List[bytes]:
+        """按未压缩大小把站点分组，保证每个包压缩后不超过MAX_DATAGRAM，一个站点的失败与下线主机在同一个包中"""
+        packets, chunk, size = list(), dict(), 0
+        for site in set(self._local) | set(self._inactive):
+            item = sorted(self._local.get(site, ())), sorted(self._inactive.get(site, ()))
+            item_size = 2 * len(site) + sum(len(host) + 3 for hosts in item for host in hosts) + 12
+            if chunk and size + item_size > MAX_DATAGRAM:
+                packets.append(self._pack(chunk))
+                chunk, size = dict(), 0
+            chunk[site] = item
+            size += item_size
+        packets.append(self._pack(chunk))
+        return packets
+
+    async def start(self):
+        self._started = time.time()
+        loop = asyncio.get_event_loop()
+        self._transport, _ = await loop.create_datagram_endpoint(
+            lambda: _VerdictProtocol(self), local_addr=self._address(self.conf.members[self.instance])
+        )
+        log.info(f"{self} 开始交换检测判定")
+
+    async def run(self):
+        if self._transport is None:
+            await self.start()
+        while True:
+            await asyncio.sleep(self.conf.flush_interval)
+            # 即使没有失败主机也要发送，作为存活信号
+            for packet in self._encode():
+                for addr in self._peers.values():
+                    self._transport.sendto(packet, addr)
+                    self.sent += 1
+
+    def stats(self) -> str:
+        now = time.time()
+        alive = [name for name in self._peers if self._alive(name, now)]
+        return f"判定交换: 发送{self.sent}, 接收{self.received}, 存活实例{alive}"
+
+    def close(self):
+        if self._transport is not None:
+            self._transport.close()
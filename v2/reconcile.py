@@ -0,0 +1,178 @@
+import time
+import asyncio
+from typing import Dict, Set, Callable, Awaitable, Optional
+
+from utils import SimpleLog
+
+DEFAULT_RECONCILE_INTERVAL = 30
+DEFAULT_RETRY_BASE = 5
+DEFAULT_RETRY_MAX = 300
+log = SimpleLog(__name__).log
+
+
+class ReconcileConfig(object):
+    def __init__(self, data: dict):
+        self.enable = data.get("enable", True)
+        # 比较期望状态与网关实际状态的间隔(秒)
+        self.interval = data.get("interval", DEFAULT_RECONCILE_INTERVAL)
+        # 修改失败后第n次重试的等待为retry_base * 2^(n-1)秒，最长retry_max秒
+        self.retry_base = data.get("retry_base", DEFAULT_RETRY_BASE)
+        self.retry_max = data.get("retry_max", DEFAULT_RETRY_MAX)
+        assert isinstance(self.enable, bool) and self.interval > 0 \
+               and 0 < self.retry_base <= self.retry_max, "Config file reconcile section error"
+
+    def __repr__(self) -> str:
+        return f"ReconcileConfig(enable={self.enable}, interval={self.interval})"
+
+
+class _Desired(object):
+    __slots__ = ("status", "since", "attempts", "next_try", "converged", "running")
+
+    def __init__(self, status: str):
+        self.status = status
+        # 期望状态开始的时间，收敛时间从这里算起
+        self.since = time.time()
+        self.attempts = 0
+        self.next_try = 0.0
+        self.converged = False
+        self.running = False
+
+    def __repr__(self) -> str:
+        return f"_Desired({self.status}, converged={self.converged}, attempts={self.attempts})"
+
+
+class Reconciler(object):
+    """
+    保存每个站点中由本进程上/下线的主机的期望状态，每interval秒与网关每个目标(例如每台NGINX)的实际状态比较，
+    所有目标都一致才算收敛，只在不一致的目标上重新修改。修改失败或超时按指数退避重试，已收敛的主机再次不一致时计为一次偏离。
+    上线的主机收敛后不再跟踪，网关上手工下线的其他主机不受影响
+    """
+    def __init__(self, conf: ReconcileConfig, change: Callable[[object, str, str, Optional[Set[str]]], Awaitable[object]]):
+        self.conf = conf
+        # change(site, host, status, targets)返回GatewayChange，targets为None时修改全部目标
+        self._change = change
+        self._sites: Dict[str, object] = dict()
+        self._desired: Dict[str, Dict[str, _Desired]] = dict()
+        self.attempts = 0
+        self.retries = 0
+        self.drifts = 0
+        self.converged = 0
+        self.converge_total = 0.0
+        self.converge_max = 0.0
+
+    def __repr__(self) -> str:
+        return f"Reconciler(hosts={self.tracked}, interval={self.conf.interval})"
+
+    @property
+    def tracked(self) -> int:
+        return sum(len(hosts) for hosts in self._desired.values())
+
+    @property
+    def pending(self) -> int:
+        """未收敛的主机数"""
+        return sum(1 for hosts in self._desired.values() for desired in hosts.values() if not desired.converged)
+
+    def desired(self, site_name: str, host: str) -> Optional[str]:
+        desired = self._desired.get(site_name, {}).get(host)
+        return desired.status if desired else None
+
+    def _converge(self, site, host: str, desired: _Desired):
+        elapsed = time.time() - desired.since
+        desired.converged = True
+        self.converged += 1
+        self.converge_total += elapsed
+        self.converge_max = max(self.converge_max, elapsed)
+        if desired.attempts > 1:
+            log.info(f"{site.name} {host} {desired.status}经过{desired.attempts}次修改后收敛, 耗时{elapsed:.1f}s")
+        if desired.status == "up":
+            self._desired[site.name].pop(host, None)
+
+    async def _apply(self, site, host: str, desired: _Desired, targets: Set[str] = None) -> bool:
+        if desired.running:
+            return False
+        desired.running = True
+        desired.attempts += 1
+        self.attempts += 1
+        if desired.attempts > 1:
+            self.retries += 1
+        try:
+            change = await self._change(site, host, desired.status, targets)
+            ok = change.outcome == "ok"
+        except Exception as e:
+            log.exception(f"{site.name} {host} {desired.status}修改异常: {e}")
+            ok = False
+        finally:
+            desired.running = False
+        if self._desired.get(site.name, {}).get(host) is not desired:
+            # 修改期间期望状态已变化，结果交给新的期望状态处理
+            return ok
+        if ok:
+            self._converge(site, host, desired)
+        else:
+            delay = min(self.conf.retry_base * 2 ** (desired.attempts - 1), self.conf.retry_max)
+            desired.next_try = time.time() + delay
+            log.warning(f"{site.name} {host} {desired.status}未完成, {delay}秒后重试")
+        return ok
+
+    async def want(self, site, host: str, status: str) -> bool:
+        """设置期望状态并立即修改一次，返回本次修改是否成功，失败的由run()重试"""
+        self._sites[site.name] = site
+        desired = _Desired(status)
+        self._desired.setdefault(site.name, dict())[host] = desired
+        return await self._apply(site, host, desired)
+
+    def forget(self, site_name: str, hosts: Set[str]):
+        """主机已从站点移除，不再跟踪"""
+        for host in hosts:
+            self._desired.get(site_name, {}).pop(host, None)
+
+    async def reconcile(self, site) -> int:
+        """比较一个站点的期望状态与网关每个目标上的已下线主机，返回重新修改的主机数"""
+        hosts = self._desired.get(site.name)
+        if not hosts:
+            return 0
+        loop = asyncio.get_event_loop()
+        try:
+            offline = await loop.run_in_executor(None, site.gateway.get_offline_by_target)
+        except Exception as e:
+            log.exception(f"{site.name}获取网关状态异常: {e}")
+            offline = None
+        if offline is None:
+            return 0
+        # 查询失败的目标状态未知，不能判定收敛，也不重新修改
+        unknown = {target for target, servers in offline.items() if servers is None}
+        now, changes = time.time(), list()
+        for host, desired in list(hosts.items()):
+            if desired.running:
+                # 正在修改，结果由_apply处理
+                continue
+            # 状态与期望不一致的目标
+            lagging = {target for target, servers in offline.items()
+                       if servers is not None and (host in servers) != (desired.status == "down")}
+            if not lagging:
+                if not desired.converged and not unknown:
+                    self._converge(site, host, desired)
+                continue
+            if desired.converged:
+                # 已收敛的主机被其他操作(手工修改、配置发布)改回
+                self.drifts += 1
+                log.warning(f"{site.name} {host}期望{desired.status}, 网关{sorted(lagging)}上不一致, 重新修改")
+                desired.converged, desired.since, desired.attempts, desired.next_try = False, now, 0, 0.0
+            if desired.next_try <= now:
+                changes.append(self._apply(site, host, desired, lagging))
+        if changes:
+            await asyncio.gather(*changes)
+        return len(changes)
+
+    async def reconcile_all(self):
+        await asyncio.gather(*[self.reconcile(self._sites[name]) for name in list(self._desired)])
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.conf.interval)
+            await self.reconcile_all()
+
+    def stats(self) -> str:
+        mean = self.converge_total / self.converged if self.converged else 0.0
+        return (f"网关状态: 跟踪{self.tracked}个主机, 未收敛{self.pending}, 修改{self.attempts}次(重试{self.retries}), "
+                f"偏离{self.drifts}次, 收敛{self.converged}次 平均{mean:.1f}s 最长{self.converge_max:.1f}s")
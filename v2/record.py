@@ -0,0 +1,285 @@
+import time
+import itertools
+from typing import List, Tuple, Dict, Set, Optional
+
+from quorum import QuorumGate
+from config import SiteConfig
+from window import WindowFactory
+from snapshot import HostState
+from utils import SimpleLog, HostRecord, TimerWheel
+
+log = SimpleLog(__name__).log
+
+
+class ErrorRecord(object):
+    def __init__(self, host: str, status: int, action: str):
+        self.host = host
+        self.status = status
+        self.action = action
+
+
+class SiteRecord(object):
+    def __init__(self, _site: SiteConfig):
+        self.conf = _site
+        self.name = _site.name
+        self.max_failed = _site.max_failed
+        self.auto_inter = _site.auto_interval
+        self.max_inactive = _site.max_inactive
+        if not self.max_inactive:
+            self.max_inactive = len(_site.servers) // 2
+        # 已经下线的主机存入self._inactive
+        self._inactive = set()
+        # self._record有所有曾经异常的记录
+        self._record: Dict[str: HostRecord] = dict()
+        # 多实例共同判定，为None时由本实例单独决定下线
+        self.quorum: Optional[QuorumGate] = None
+        # 增量处理: 计数达到max_failed的主机、本周期需要重新判断的主机、已下线主机的下次动作时间
+        self._failed: Set[str] = set()
+        self._dirty: Set[str] = set()
+        self._timers = TimerWheel()
+        # time窗口的计数随时间减少，按最早的失败移出窗口的时间重新计算
+        self._expiry = TimerWheel()
+        # 记录的创建顺序，get_results按此顺序处理，与遍历self._record的顺序一致
+        self._seq: Dict[str, int] = dict()
+        self._counter = itertools.count()
+
+    def __repr__(self) -> str:
+        return "SiteRecord(name={},errors={})".format(self.name, self._record)
+
+    def _add(self, host: str, record):
+        self._record[host] = record
+        self._seq[host] = next(self._counter)
+
+    def _changed(self, host: str):
+        """计数越过max_failed或归零的主机需要在get_results中重新判断"""
+        record = self._record[host]
+        count = record.count
+        if count == 0 or (count >= self.max_failed) != (host in self._failed):
+            self._dirty.add(host)
+        if count >= self.max_failed:
+            self._failed.add(host)
+        else:
+            self._failed.discard(host)
+        if self.conf.window == "time" and count > 0:
+            self._expiry.schedule(host, record.next_expire_time())
+
+    def _expire_windows(self):
+        for host in self._expiry.expire(time.time()):
+            if host in self._record:
+                self._changed(host)
+
+    def _update_window(self, _results: List[Tuple[int, str]]):
+        """time/count窗口: 每次检测结果都记入窗口，计数即窗口内的失败次数"""
+        for status, host in _results:
+            if status > 400:
+                if host not in self._record:
+                    self._add(host, WindowFactory.create_record(self.conf))
+                self._record[host].update(1)
+                self._record[host].set_status(status)
+                self._changed(host)
+            elif host in self._record:
+                self._record[host].update(-1)
+                self._changed(host)
+        log.info(self._record)
+
+    async def update(self, _results: List[Tuple[int, str]]):
+        if self.conf.window != "decay":
+            return self._update_window(_results)
+        for _result in _results:
+            status, host = _result
+            if status > 400:
+                # 判断是不是第一次发生
+                if host in self._record:
+                    # 之前有记录，需要更新
+                    if host in self._inactive:
+                        # 已下线，更新的计数为0，实际只更新了时间
+                        self._record[host].update(0)
+                    else:
+                        # 还未下线，继续更新记录
+                        if self._record[host].count < self.max_failed:
+                            # 防止整数溢出，只有小于才更新
+                            self._record[host].update(1)
+                        else:
+                            self._record[host].update(0)
+                else:
+                    # 初次，之前未记录
+                    self._add(host, HostRecord(self.conf.duration, self.conf.auto_interval))
+                # 更新最后状态
+                self._record[host].set_status(status)
+                self._changed(host)
+            else:
+                # 状态码是正常的情况,如果存在，那就一直减少到0
+                if host in self._record and self._record[host].count > 0:
+                    self._record[host].update(-1)
+                    self._changed(host)
+        # 其他情况就不管
+        log.info(self._record)
+
+    def export_state(self) -> List[HostState]:
+        """有记录的主机状态(已下线的主机都有记录)，用于快照"""
+        return [(host, record.count, record.expire_time, record.next_action_time,
+                 record.next_notify_time, record.last_status, host in self._inactive)
+                for host, record in self._record.items()]
+
+    def _new_record(self, count: int, expire: float):
+        if self.conf.window != "decay":
+            record = WindowFactory.create_record(self.conf)
+            # 窗口只恢复失败次数，按恢复时刻的失败记入
+            for _ in range(count):
+                record.update(1)
+        else:
+            record = HostRecord(self.conf.duration, self.conf.auto_interval)
+            record.count = count
+            record.expire_time = expire
+        return record
+
+    def restore_state(self, states: List[HostState]):
+        for host, count, expire, next_action, next_notify, status, inactive in states:
+            record = self._new_record(count, expire)
+            record.next_action_time = next_action
+            record.next_notify_time = next_notify
+            record.set_status(status)
+            self._add(host, record)
+            if inactive:
+                self._inactive.add(host)
+            self._changed(host)
+            self._dirty.add(host)
+
+    def update_servers(self, servers: Set[str], removed: Set[str]):
+        """站点的主机有变化: 移除的主机丢弃记录(包括已下线的)，未配置max_inactive时按新的主机数计算"""
+        for host in removed:
+            if host in self._record:
+                del self._record[host]
+                del self._seq[host]
+            self._inactive.discard(host)
+            self._failed.discard(host)
+            self._dirty.discard(host)
+            self._timers.cancel(host)
+            self._expiry.cancel(host)
+        if not self.conf.max_inactive:
+            self.max_inactive = len(servers) // 2
+
+    def action_done(self, host: str, ok: bool, now: float = None):
+        """恢复动作结束: 仍未恢复的主机从动作结束时起再等auto_interval秒，避免耗时长的动作刚结束又被触发"""
+        if host not in self._inactive or host not in self._record:
+            return
+        record = self._record[host]
+        record.next_action_time = (time.time() if now is None else now) + self.auto_inter
+        self._timers.schedule(host, record.next_action_time)
+        log.info(f"{host}恢复动作结束, 结果{ok}, 下次动作时间{record.next_action_time:.0f}")
+
+    def _sync_quorum(self) -> bool:
+        """多实例时接管或释放下线的主机，返回本实例是否负责本站点的上/下线"""
+        if self.quorum is None:
+            return True
+        leader, adopt, release = self.quorum.sync(self.name, self._inactive)
+        now = time.time()
+        for host in adopt & set(self.conf.servers):
+            log.info("{}由其他实例下线，由本实例接管".format(host))
+            if host not in self._record:
+                # 状态码未知记为0
+                self._add(host, self._new_record(self.max_failed, now + self.conf.duration))
+                self._record[host].set_status(0)
+            elif self.conf.window == "decay":
+                self._record[host].count = max(self._record[host].count, self.max_failed)
+            self._record[host].next_action_time = now + self.auto_inter
+            self._inactive.add(host)
+            self._changed(host)
+            self._dirty.add(host)
+        for host in release:
+            log.info("{}已由站点的leader实例接管".format(host))
+            self._inactive.discard(host)
+            self._dirty.add(host)
+        return leader
+
+    def get_state(self, host: str) -> str:
+        """offline: 已下线; suspect: 有失败记录; healthy: 正常"""
+        if host in self._inactive:
+            return "offline"
+        if host in self._record and self._record[host].count > 0:
+            return "suspect"
+        return "healthy"
+
+    def _inactive_count(self) -> int:
+        """多实例时按所有实例下线的主机计算"""
+        if self.quorum is None:
+            return len(self._inactive)
+        return self.quorum.inactive_count(self.name, self._inactive)
+
+    def get_failed_hosts(self) -> Set[str]:
+        """当前判定为失败的主机(失败次数达到max_failed)"""
+        self._expire_windows()
+        return set(self._failed)
+
+    def get_error_hosts(self) -> Set[str]:
+        results = self.get_failed_hosts()
+        results.update(self._inactive)
+        return results
+
+    def _pending(self) -> List[str]:
+        """
+        本周期需要判断的主机: update中或time窗口随时间计数越过max_failed或归零的主机、下次动作时间已到的已下线主机，
+        以及已失败未下线的主机(多实例判定与下线数量限制随时会变化)。其他主机的判断结果不会变化
+        """
+        self._expire_windows()
+        hosts = self._dirty
+        self._dirty = set()
+        hosts.update(self._timers.expire(time.time()))
+        hosts.update(self._failed - self._inactive)
+        return sorted((host for host in hosts if host in self._record), key=self._seq.get)
+
+    async def get_results(self) -> List[ErrorRecord]:
+        results: List[ErrorRecord] = list()
+        leader = self._sync_quorum()
+        for host in self._pending():
+            record = self._record[host]
+            if not leader and host in self._inactive:
+                log.info("{}已下线，等待站点的leader实例接管".format(host))
+                continue
+            if record.count >= self.max_failed:
+                log.info("{}超过最大失败的次数,检查是否满足下线条件".format(host))
+                if host in self._inactive:
+                    log.info("{}已下线的主机还未恢复，等待下个动作的周期时间再执行相关动作".format(host))
+                    if record.is_action():
+                        record.next_action_time = time.time() + self.auto_inter
+                        error_record = ErrorRecord(host, record.last_status, "offline")
+                        results.append(error_record)
+                    else:
+                        log.info("{}不满足条件: 操作的间隔时间未到，忽略此次动作".format(host))
+                    self._timers.schedule(host, record.next_action_time)
+                elif self.quorum is not None and not self.quorum.allow_offline(self.name, host):
+                    log.info("{}不满足条件: {}/{}个监控实例判定失败，下线由站点的leader实例执行".format(
+                        host, self.quorum.votes(self.name, host), self.quorum.conf.quorum))
+                else:
+                    if self.max_inactive >= self._inactive_count() + 1:
+                        log.info("{}满足条件：下线主机数在范围内".format(host))
+                        record.next_action_time = time.time() + self.auto_inter
+                        self._inactive.add(host)
+                        self._timers.schedule(host, record.next_action_time)
+                        error_record = ErrorRecord(host, record.last_status, "offline")
+                        results.append(error_record)
+                    else:
+                        log.info("{}不满足条件: 下线主机过多".format(host))
+                        # 通知加一个间隔时间，防止太频繁
+                        if record.is_notify():
+                            record.next_notify_time = time.time() + self.auto_inter
+                            error_record = ErrorRecord(host, record.last_status, "notify")
+                            results.append(error_record)
+            else:
+                # 记录没有大于，有可能是等于0或者1-7，更新计数
+                if record.count == 0 and host in self._inactive:
+                    if self.quorum is not None and self.quorum.handing_over(self.name, host):
+                        log.info("{}已恢复，等待其他实例释放后上线".format(host))
+                        continue
+                    log.info("{}之前异常，现在恢复。将执行上线".format(host))
+                    self._inactive.remove(host)
+                    ok_record = ErrorRecord(host, record.last_status, "online")
+                    results.append(ok_record)
+                if record.count == 0:
+                    del self._record[host]
+                    del self._seq[host]
+                    self._timers.cancel(host)
+                    self._expiry.cancel(host)
+        if self.quorum is not None:
+            self.quorum.set_inactive(self.name, self._inactive)
+        return results
@@ -0,0 +1,143 @@
+import math
+import asyncio
+from typing import List, Dict, Iterable, Callable, Awaitable
+
+from config import SiteConfig, _AdaptiveConfig
+from utils import SimpleLog
+
+log = SimpleLog(__name__).log
+
+
+class SiteTask(object):
+    """
+    单个站点的检测任务，按站点自己的check_interval周期执行。每个周期的检测受deadline约束，
+    慢站点不会推迟其他站点的检测; 检测之后的结果处理(判断上/下线、通知)会修改记录，
+    不受deadline约束，超时的周期也会处理已完成的检测结果
+    """
+    def __init__(self, site: SiteConfig, probe: Callable[[SiteConfig], Awaitable[int]],
+                 settle: Callable[[SiteConfig], Awaitable[None]]):
+        self.site = site
+        self.interval = site.tick_interval
+        self.deadline = site.deadline
+        self._probe = probe
+        self._settle = settle
+        self.cycles = 0
+        self.overruns = 0
+        self.probes = 0
+
+    def __repr__(self) -> str:
+        return f"SiteTask(site={self.site.name}, interval={self.interval}, deadline={self.deadline})"
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        next_time = loop.time()
+        while True:
+            try:
+                # probe返回本周期的检测次数
+                self.probes += await asyncio.wait_for(self._probe(self.site), timeout=self.deadline)
+            except asyncio.TimeoutError:
+                self.overruns += 1
+                log.warning(f"{self.site.name} 检测超过{self.deadline}秒，未完成的检测取消")
+            except Exception as e:
+                log.exception(f"{self.site.name} 检测周期异常: {e}")
+            try:
+                await self._settle(self.site)
+            except Exception as e:
+                log.exception(f"{self.site.name} 处理检测结果异常: {e}")
+            self.cycles += 1
+            next_time += self.interval
+            now = loop.time()
+            if next_time < now:
+                # 错过的周期直接跳过，不累积延迟
+                missed = math.ceil((now - next_time) / self.interval)
+                next_time += missed * self.interval
+            await asyncio.sleep(next_time - now)
+
+
+class AdaptivePlan(object):
+    """
+    按SiteRecord中的主机状态决定每个主机下次检测的时间:
+    healthy每次检测正常后间隔翻倍直到max_interval，suspect按min_interval，offline按recover_interval
+    """
+    def __init__(self, conf: _AdaptiveConfig, check_interval: int):
+        self.conf = conf
+        self.check_interval = check_interval
+        self._next: Dict[str, float] = dict()
+        self._interval: Dict[str, float] = dict()
+        self.skipped = 0
+
+    def __repr__(self) -> str:
+        return f"AdaptivePlan(hosts={len(self._next)}, skipped={self.skipped})"
+
+    def due(self, servers: Iterable[str], now: float) -> List[str]:
+        """本周期需要检测的主机，允许半个调度间隔的误差，避免因毫秒级偏差错过一个周期"""
+        servers = list(servers)
+        limit = now + self.conf.min_interval / 2
+        results = [server for server in servers if self._next.get(server, 0) <= limit]
+        self.skipped += len(servers) - len(results)
+        return results
+
+    def schedule(self, server: str, state: str, now: float):
+        if state == "offline":
+            interval = self.conf.recover_interval
+            self._interval.pop(server, None)
+        elif state == "suspect":
+            interval = self.conf.min_interval
+            self._interval.pop(server, None)
+        else:
+            # 正常主机从check_interval开始退避
+            last = self._interval.get(server)
+            interval = min(last * 2, self.conf.max_interval) if last else self.check_interval
+            self._interval[server] = interval
+        self._next[server] = now + interval
+
+    def forget(self, servers: Iterable[str]):
+        for server in servers:
+            self._next.pop(server, None)
+            self._interval.pop(server, None)
+
+
+class SiteScheduler(object):
+    """每个站点一个asyncio任务，并定期输出实际检测速率与配置速率的对比"""
+    def __init__(self, sites: List[SiteConfig], probe: Callable[[SiteConfig], Awaitable[int]],
+                 settle: Callable[[SiteConfig], Awaitable[None]], report_interval: int = 60):
+        self._tasks = [SiteTask(site, probe, settle) for site in sites]
+        self.report_interval = report_interval
+        self._reporters: List[Callable[[], str]] = list()
+
+    def __repr__(self) -> str:
+        return f"SiteScheduler(sites={len(self._tasks)})"
+
+    def add_reporter(self, reporter: Callable[[], str]):
+        """定期输出速率时附带输出的其他统计信息"""
+        self._reporters.append(reporter)
+
+    @property
+    def configured_rate(self) -> float:
+        """按配置的check_interval计算的每秒检测次数"""
+        return sum(len(task.site.servers) / task.site.check_interval for task in self._tasks)
+
+    @property
+    def probes(self) -> int:
+        return sum(task.probes for task in self._tasks)
+
+    @property
+    def overruns(self) -> int:
+        return sum(task.overruns for task in self._tasks)
+
+    async def _report(self):
+        loop = asyncio.get_event_loop()
+        last_time, last_probes = loop.time(), self.probes
+        while True:
+            await asyncio.sleep(self.report_interval)
+            now, probes = loop.time(), self.probes
+            rate = (probes - last_probes) / (now - last_time)
+            log.info(f"检测速率: 实际{rate:.1f}/s, 配置{self.configured_rate:.1f}/s, 累计超时周期{self.overruns}")
+            for reporter in self._reporters:
+                log.info(reporter())
+            last_time, last_probes = now, probes
+
+    async def run(self):
+        tasks = [asyncio.ensure_future(task.run()) for task in self._tasks]
+        tasks.append(asyncio.ensure_future(self._report()))
+        await asyncio.gather(*tasks)
@@ -0,0 +1,84 @@
+import queue
+import asyncio
+import multiprocessing
+from typing import List, Any, Callable, AsyncIterator
+
+from utils import SimpleLog
+
+log = SimpleLog(__name__).log
+
+
+class ShardCoordinator(object):
+    """
+    多进程分片: 把items按权重分到workers个进程，每个进程运行target(items, queue)，
+    有自己的事件循环与记录。worker通过queue把事件交回协调进程统一处理，
+    worker异常退出时按原分片重新拉起
+    """
+    def __init__(self, items: List[Any], workers: int, target: Callable[[List[Any], Any], None],
+                 weight: Callable[[Any], float] = None, restart: bool = True):
+        self.workers = workers
+        self.restart = restart
+        self._target = target
+        self.shards = self.partition(items, workers, weight if weight else (lambda _: 1))
+        self._queue = multiprocessing.Queue()
+        self._procs: List[multiprocessing.Process] = list()
+        self.restarts = 0
+
+    def __repr__(self) -> str:
+        return f"ShardCoordinator(workers={self.workers}, shards={[len(shard) for shard in self.shards]})"
+
+    @staticmethod
+    def partition(items: List[Any], workers: int, weight: Callable[[Any], float]) -> List[List[Any]]:
+        """按权重从大到小依次放入当前负载最小的分片"""
+        shards: List[List[Any]] = [list() for _ in range(max(workers, 1))]
+        loads = [0] * len(shards)
+        for item in sorted(items, key=weight, reverse=True):
+            index = loads.index(min(loads))
+            shards[index].append(item)
+            loads[index] += weight(item)
+        return [shard for shard in shards if shard]
+
+    def _spawn(self, index: int) -> multiprocessing.Process:
+        proc = multiprocessing.Process(target=self._target, args=(self.shards[index], self._queue),
+                                       name=f"shard-{index}", daemon=True)
+        proc.start()
+        return proc
+
+    def start(self):
+        self._procs = [self._spawn(index) for index in range(len(self.shards))]
+        log.info(f"启动{len(self._procs)}个检测进程, {self}")
+
+    def _check_workers(self):
+        if not self.restart:
+            return
+        for index, proc in enumerate(self._procs):
+            if not proc.is_alive():
+                log.error(f"检测进程{proc.name}已退出(exitcode={proc.exitcode})，重新启动")
+                self.restarts += 1
+                self._procs[index] = self._spawn(index)
+
+    def _get(self) -> Any:
+        try:
+            return self._queue.get(timeout=1)
+        except queue.Empty:
+            return None
+
+    async def events(self) -> AsyncIterator[Any]:
+        loop = asyncio.get_event_loop()
+        while True:
+            event = await loop.run_in_executor(None, self._get)
+            self._check_workers()
+            if event is not None:
+                yield event
+
+    def alive(self) -> int:
+        return sum(1 for proc in self._procs if proc.is_alive())
+
+    def stats(self) -> str:
+        return f"检测进程: 存活{self.alive()}/{len(self._procs)}, 重启{self.restarts}次"
+
+    def stop(self):
+        for proc in self._procs:
+            proc.terminate()
+        for proc in self._procs:
+            proc.join()
@@ -0,0 +1,153 @@
+import os
+import time
+import sqlite3
+import asyncio
+from contextlib import closing
+from typing import List, Tuple, Dict, Set, Optional
+
+from utils import SimpleLog
+
+DEFAULT_SNAPSHOT_FILE = "state.db"
+DEFAULT_SNAPSHOT_INTERVAL = 30
+# (主机, 失败计数, 过期时间, 下次动作时间, 下次通知时间, 最后状态码, 是否已下线)，时间均为time.time()，
+# 不随时间过期的计数(count窗口)过期时间为inf
+HostState = Tuple[str, int, float, float, float, int, bool]
+log = SimpleLog(__name__).log
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS hosts (
+    site TEXT NOT NULL,
+    host TEXT NOT NULL,
+    count INTEGER NOT NULL,
+    expire REAL NOT NULL,
+    next_action REAL NOT NULL,
+    next_notify REAL NOT NULL,
+    status INTEGER NOT NULL,
+    inactive INTEGER NOT NULL,
+    PRIMARY KEY (site, host)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sites (
+    site TEXT PRIMARY KEY,
+    saved REAL NOT NULL
+);
+"""
+
+
+class SnapshotConfig(object):
+    def __init__(self, data: dict):
+        self.enable = data.get("enable", False)
+        self.file = data.get("file", DEFAULT_SNAPSHOT_FILE)
+        self.interval = data.get("interval", DEFAULT_SNAPSHOT_INTERVAL)
+        assert isinstance(self.file, str) and self.interval > 0, "Config file snapshot section error"
+
+    def __repr__(self) -> str:
+        return f"SnapshotConfig(file={self.file}, interval={self.interval})"
+
+
+def reconcile(states: List[HostState], servers: Set[str], offline: Optional[Set[str]],
+              max_failed: int, duration: int, auto_interval: int, now: float) -> List[HostState]:
+    """
+    快照与网关当前状态合并，offline为None时以快照为准:
+    快照中已下线、网关上已上线(例如人工恢复)的主机不再视为下线;
+    网关上已下线、快照中没有的主机按达到max_failed恢复，检测正常后按原流程上线;
+    不在站点中的主机与已过期的失败计数丢弃
+    """
+    results: List[HostState] = list()
+    for host, count, expire, next_action, next_notify, status, inactive in states:
+        if host not in servers:
+            continue
+        if inactive and offline is not None and host not in offline:
+            log.info(f"{host}在快照中已下线，网关上已上线，以网关为准")
+            inactive = False
+        if not inactive and (count <= 0 or expire < now):
+            continue
+        results.append((host, count, expire, next_action, next_notify, status, inactive))
+    if offline:
+        known = {state[0] for state in results}
+        for host in sorted((offline & servers) - known):
+            log.info(f"{host}在网关上已下线，快照中没有记录，按已下线恢复")
+            # 状态码未知记为0
+            results.append((host, max_failed, now + duration, now + auto_interval, now + auto_interval, 0, True))
+    return results
+
+
+class SnapshotStore(object):
+    """
+    记录状态的快照，保存在SQLite文件中。每个站点的主机状态在一个事务中整体替换，
+    写入中途退出不会留下半个快照; 分片进程只替换自己的站点，可以共用一个文件。
+    导出在事件循环中进行(只复制数据)，写入在线程池中执行
+    """
+    def __init__(self, conf: SnapshotConfig):
+        self.conf = conf
+        self.saves = 0
+        self.hosts = 0
+        self.save_ms = 0.0
+        self.restore_ms = 0.0
+
+    def __repr__(self) -> str:
+        return f"SnapshotStore(file={self.conf.file})"
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.conf.file, timeout=10)
+        conn.executescript(_SCHEMA)
+        return conn
+
+    def save(self, states: Dict[str, List[HostState]]):
+        start, now = time.perf_counter(), time.time()
+        with closing(self._connect()) as conn, conn:
+            for site, hosts in states.items():
+                conn.execute("DELETE FROM hosts WHERE site = ?", (site,))
+                conn.executemany("INSERT INTO hosts VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                                 [(site, *state[:6], int(state[6])) for state in hosts])
+                conn.execute("INSERT OR REPLACE INTO sites VALUES (?, ?)", (site, now))
+        self.saves += 1
+        self.hosts = sum(len(hosts) for hosts in states.values())
+        self.save_ms = (time.perf_counter() - start) * 1000
+
+    def load(self, sites: List[str]) -> Dict[str, List[HostState]]:
+        results: Dict[str, List[HostState]] = {site: list() for site in sites}
+        if not os.path.exists(self.conf.file):
+            return results
+        with closing(self._connect()) as conn:
+            for row in conn.execute("SELECT site, host, count, expire, next_action, next_notify, status, inactive "
+                                    "FROM hosts"):
+                if row[0] in results:
+                    results[row[0]].append((*row[1:7], bool(row[7])))
+        return results
+
+    @staticmethod
+    def export(records: dict) -> Dict[str, List[HostState]]:
+        return {name: record.export_state() for name, record in records.items()}
+
+    async def restore(self, sites: list, records: dict):
+        """启动时从快照恢复records，并与各站点网关上的下线状态合并"""
+        loop = asyncio.get_event_loop()
+        start, now = time.perf_counter(), time.time()
+        states = await loop.run_in_executor(None, self.load, [site.name for site in sites])
+        offlines = await asyncio.gather(*[loop.run_in_executor(None, site.gateway.get_offline_servers)
+                                          for site in sites])
+        total = 0
+        for site, offline in zip(sites, offlines):
+            if offline is None and any(state[6] for state in states[site.name]):
+                log.info(f"{site.name}无法获取网关上的下线状态，以快照为准")
+            hosts = reconcile(states[site.name], set(site.servers), offline,
+                              site.max_failed, site.duration, site.auto_interval, now)
+            records[site.name].restore_state(hosts)
+            total += len(hosts)
+        self.restore_ms = (time.perf_counter() - start) * 1000
+        log.info(f"从快照恢复{total}个主机的记录，耗时{self.restore_ms:.1f}ms")
+
+    async def snapshot(self, records: dict):
+        states = self.export(records)
+        await asyncio.get_event_loop().run_in_executor(None, self.save, states)
+
+    async def run(self, records: dict):
+        while True:
+            await asyncio.sleep(self.conf.interval)
+            try:
+                await self.snapshot(records)
+            except sqlite3.Error as e:
+                log.error(f"保存快照失败: {e}")
+
+    def stats(self) -> str:
+        return f"快照: 已保存{self.saves}次, 最近一次{self.hosts}个主机耗时{self.save_ms:.1f}ms"
@@ -0,0 +1,281 @@
+import os
+import time
+import asyncio
+import tempfile
+import subprocess
+from typing import List, Tuple, Dict, Optional
+
+from metrics import LatencyHistogram
+from utils import SimpleLog
+
+DEFAULT_CONTROL_DIR = os.path.join(tempfile.gettempdir(), "monitor-auto-ssh")
+DEFAULT_MAX_SESSIONS = 4
+DEFAULT_COMMAND_TIMEOUT = 5
+DEFAULT_CONNECT_TIMEOUT = 5
+DEFAULT_CHECK_INTERVAL = 30
+DEFAULT_PERSIST = 600
+# 命令超时或无法执行时的返回码，与ssh自身的错误返回码一致
+FAILED_RETURNCODE = 255
+log = SimpleLog(__name__).log
+
+
+class SSHConfig(object):
+    """
+    到NGINX主机的SSH复用会话配置，在gateway.nginx.ssh中配置:
+    每个主机保持一个已认证的主连接(ControlMaster)，命令通过主连接的新通道执行，不再重新握手
+    """
+    def __init__(self, data: dict = None):
+        data = data if data else {}
+        self.control_dir = data.get("control_dir", DEFAULT_CONTROL_DIR)
+        # 单个主机同时执行的命令数，不超过sshd的MaxSessions(默认10)
+        self.max_sessions = data.get("max_sessions", DEFAULT_MAX_SESSIONS)
+        self.timeout = data.get("timeout", DEFAULT_COMMAND_TIMEOUT)
+        self.connect_timeout = data.get("connect_timeout", DEFAULT_CONNECT_TIMEOUT)
+        self.check_interval = data.get("check_interval", DEFAULT_CHECK_INTERVAL)
+        # 主连接空闲多久后自动退出，防止本进程异常退出后遗留
+        self.persist = data.get("persist", DEFAULT_PERSIST)
+        assert isinstance(self.control_dir, str) \
+               and isinstance(self.max_sessions, int) and self.max_sessions > 0 \
+               and isinstance(self.timeout, (int, float)) \
+               and isinstance(self.connect_timeout, int) \
+               and self.check_interval > 0 \
+               and isinstance(self.persist, int), "Config file gateway nginx ssh section error"
+
+    def __repr__(self) -> str:
+        return f"SSHConfig(max_sessions={self.max_sessions}, timeout={self.timeout})"
+
+
+class SSHSession(object):
+    """
+    单个NGINX主机的复用会话: 主连接由ssh -M -f在后台保持，命令用ControlMaster=no复用主连接。
+    主连接不存在时ssh会直接新建连接，命令仍能执行，只是需要完整握手
+    """
+    def __init__(self, host: str, username: str, conf: SSHConfig):
+        self.host = host
+        self.username = username
+        self.conf = conf
+        # %C为本机、远程主机、端口与用户的哈希，避免socket路径过长
+        self.control_path = os.path.join(conf.control_dir, "%C")
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._connecting: Optional[asyncio.Future] = None
+        self.histogram = LatencyHistogram()
+        self.commands = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.reconnects = 0
+        self.connected = False
+        # 主连接建立失败后，check_interval内命令不再尝试建立，由SSHPool.run()重试
+        self._retry_time = 0.0
+
+    def __repr__(self) -> str:
+        return f"SSHSession({self.username}@{self.host}, connected={self.connected})"
+
+    @property
+    def target(self) -> str:
+        return f"{self.username}@{self.host}"
+
+    def _options(self) -> List[str]:
+        return ["-o", f"ControlPath={self.control_path}", "-o", "BatchMode=yes",
+                "-o", f"ConnectTimeout={self.conf.connect_timeout}",
+                "-o", "ServerAliveInterval=10", "-o", "ServerAliveCountMax=3"]
+
+    def _master_argv(self) -> List[str]:
+        return ["ssh", "-M", "-f", "-N", "-o", f"ControlPersist={self.conf.persist}"] + self._options() + [self.target]
+
+    def _check_argv(self) -> List[str]:
+        return ["ssh", "-O", "check"] + self._options() + [self.target]
+
+    def _command_argv(self, command: str) -> List[str]:
+        return ["ssh", "-o", "ControlMaster=no"] + self._options() + [self.target, command]
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        # 在事件循环中第一次使用时创建
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.conf.max_sessions)
+        return self._semaphore
+
+    def _observe(self, returncode: int, start: float):
+        self.histogram.observe((time.perf_counter() - start) * 1000)
+        self.commands += 1
+        if returncode:
+            self.failures += 1
+
+    def _connected(self, code: int) -> bool:
+        self.connected = code == 0
+        if not self.connected:
+            self._retry_time = time.time() + self.conf.check_interval
+            log.error(f"建立到{self.target}的SSH主连接失败，返回码{code}，命令将单独建立连接")
+        return self.connected
+
+    def _call(self, argv: List[str], timeout: float) -> int:
+        try:
+            # ssh -f在认证完成后转入后台，输出不能用PIPE，否则要等后台进程退出
+            return subprocess.run(argv, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                  stderr=subprocess.DEVNULL, timeout=timeout).returncode
+        except subprocess.TimeoutExpired:
+            return FAILED_RETURNCODE
+
+    async def _call_async(self, argv: List[str], timeout: float) -> int:
+        proc = await asyncio.create_subprocess_exec(
+            *argv, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            return await asyncio.wait_for(proc.wait(), timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            return FAILED_RETURNCODE
+
+    def connect_sync(self) -> bool:
+        # 主连接已存在(例如其他分片进程建立的)时直接复用，ssh -M在socket已存在时会另建一个不复用的连接
+        if self._call(self._check_argv(), self.conf.timeout) == 0:
+            return self._connected(0)
+        os.makedirs(self.conf.control_dir, mode=0o700, exist_ok=True)
+        return self._connected(self._call(self._master_argv(), self.conf.connect_timeout + 5))
+
+    async def check(self) -> bool:
+        """主连接是否存活，ssh -O check只访问本地socket，不产生网络请求"""
+        return await self._call_async(self._check_argv(), self.conf.timeout) == 0
+
+    async def connect(self) -> bool:
+        """同一主机同时只建立一个主连接，其他调用等待同一结果"""
+        if self._connecting is not None:
+            return await asyncio.shield(self._connecting)
+        self._connecting = asyncio.get_event_loop().create_future()
+        try:
+            if await self.check():
+                code = 0
+            else:
+                os.makedirs(self.conf.control_dir, mode=0o700, exist_ok=True)
+                code = await self._call_async(self._master_argv(), self.conf.connect_timeout + 5)
+            self._connecting.set_result(self._connected(code))
+            return self.connected
+        finally:
+            if not self._connecting.done():
+                self._connecting.set_result(False)
+            self._connecting = None
+
+    async def ensure(self) -> bool:
+        """检查主连接，断开后重连"""
+        if await self.check():
+            self.connected = True
+            return True
+        if self.connected:
+            log.warning(f"到{self.target}的SSH主连接已断开，重新连接")
+            self.reconnects += 1
+        return await self.connect()
+
+    @property
+    def _should_connect(self) -> bool:
+        return not self.connected and time.time() >= self._retry_time
+
+    async def run(self, command: str, timeout: float = None) -> Tuple[int, str, str]:
+        """通过主连接执行命令，返回(返回码, stdout, stderr)，超时的返回码为FAILED_RETURNCODE"""
+        timeout = timeout if timeout else self.conf.timeout
+        if self._should_connect:
+            await self.connect()
+        async with self.semaphore:
+            start = time.perf_counter()
+            proc = await asyncio.create_subprocess_exec(
+                *self._command_argv(command), stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            try:
+                stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+                code = proc.returncode
+            except asyncio.TimeoutError:
+                proc.kill()
+                await proc.wait()
+                self.timeouts += 1
+                log.error(f"在{self.host}上执行远程命令超时...")
+                stdout, stderr, code = b"", b"", FAILED_RETURNCODE
+            except asyncio.CancelledError:
+                # 调用方取消(例如网关修改的整体超时)时结束ssh进程，等待进程退出，避免留下僵尸进程
+                proc.kill()
+                await asyncio.shield(proc.wait())
+                raise
+            self._observe(code, start)
+        if code == FAILED_RETURNCODE:
+            # ssh自身出错(连接断开、超时)，下次执行前重建主连接
+            self.connected = False
+        return code, stdout.decode("utf8", errors="ignore"), stderr.decode("utf8", errors="ignore")
+
+    def run_sync(self, command: str, timeout: float = None) -> Tuple[int, str, str]:
+        """同步执行，用于事件循环之外(例如启动时获取后端主机)"""
+        timeout = timeout if timeout else self.conf.timeout
+        if self._should_connect:
+            self.connect_sync()
+        start = time.perf_counter()
+        try:
+            std = subprocess.run(self._command_argv(command), stdin=subprocess.DEVNULL,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=timeout)
+            code, stdout, stderr = std.returncode, std.stdout, std.stderr
+        except subprocess.TimeoutExpired:
+            self.timeouts += 1
+            log.error(f"在{self.host}上执行远程命令超时...")
+            stdout, stderr, code = b"", b"", FAILED_RETURNCODE
+        self._observe(code, start)
+        if code == FAILED_RETURNCODE:
+            self.connected = False
+        return code, stdout.decode("utf8", errors="ignore"), stderr.decode("utf8", errors="ignore")
+
+    def close(self):
+        if not self.connected:
+            return
+        subprocess.run(["ssh", "-O", "exit"] + self._options() + [self.target], stdin=subprocess.DEVNULL,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=self.conf.timeout)
+        self.connected = False
+
+    def stats(self) -> str:
+        return (f"{self.host} 命令{self.commands}, 失败{self.failures}, 超时{self.timeouts}, "
+                f"重连{self.reconnects}, p50={self.histogram.quantile(0.5)}ms p95={self.histogram.quantile(0.95)}ms")
+
+
+class SSHPool(object):
+    """
+    进程内共用的SSH会话池，每个(用户, NGINX主机)一个复用会话，所有站点共用。
+    run()定期检查主连接并重连，stats()输出每个主机的命令延迟
+    """
+    _shared: Optional["SSHPool"] = None
+
+    def __init__(self, conf: SSHConfig = None):
+        self.conf = conf if conf else SSHConfig()
+        self._sessions: Dict[Tuple[str, str], SSHSession] = dict()
+
+    def __repr__(self) -> str:
+        return f"SSHPool(sessions={len(self._sessions)})"
+
+    @classmethod
+    def shared(cls, data: dict = None) -> "SSHPool":
+        """第一次调用时按data创建，之后都返回同一个会话池"""
+        if cls._shared is None:
+            cls._shared = cls(SSHConfig(data))
+        return cls._shared
+
+    def session(self, host: str, username: str) -> SSHSession:
+        key = (username, host)
+        if key not in self._sessions:
+            self._sessions[key] = SSHSession(host, username, self.conf)
+        return self._sessions[key]
+
+    @property
+    def sessions(self) -> List[SSHSession]:
+        return list(self._sessions.values())
+
+    async def check_all(self):
+        if self._sessions:
+            await asyncio.gather(*[session.ensure() for session in self._sessions.values()])
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.conf.check_interval)
+            await self.check_all()
+
+    def stats(self) -> str:
+        return "SSH会话: " + "; ".join(session.stats() for session in self._sessions.values())
+
+    def close(self):
+        for session in self._sessions.values():
+            try:
+                session.close()
+            except (OSError, subprocess.TimeoutExpired):
+                log.warning(f"关闭{session.target}的SSH主连接失败")
@@ -0,0 +1,247 @@
+import time
+from array import array
+from typing import List, Tuple, Dict, Set, Optional
+
+from quorum import QuorumGate
+from config import SiteConfig
+from record import ErrorRecord, SiteRecord
+from snapshot import HostState
+from utils import SimpleLog, _Single
+
+log = SimpleLog(__name__).log
+
+_RECORDED = 1
+_INACTIVE = 2
+
+
+class ArraySiteRecord(object):
+    """
+    与SiteRecord判定逻辑相同的记录实现，主机状态按主机编号存放在连续的数组中:
+    失败计数、过期时间、下次动作/通知时间、最后状态码与标记位。
+    每个周期只取一次当前时间，一次遍历应用全部结果，只对有记录的主机计算上/下线与通知
+    """
+    def __init__(self, _site: SiteConfig):
+        self.conf = _site
+        self.name = _site.name
+        self.duration = _site.duration
+        self.max_failed = _site.max_failed
+        self.auto_inter = _site.auto_interval
+        self.max_inactive = _site.max_inactive
+        if not self.max_inactive:
+            self.max_inactive = len(_site.servers) // 2
+        self._ids: Dict[str, int] = dict()
+        self._hosts: List[str] = list()
+        self._count = array("i")
+        self._expire = array("d")
+        self._next_action = array("d")
+        self._next_notify = array("d")
+        self._status = array("H")
+        self._flags = bytearray()
+        # 有记录的主机编号，对应SiteRecord._record，保持记录的先后顺序
+        self._recorded: Dict[int, None] = dict()
+        self._inactive: Set[int] = set()
+        self.quorum: Optional[QuorumGate] = None
+        for host in _site.servers:
+            self._id(host)
+
+    def __repr__(self) -> str:
+        return "ArraySiteRecord(name={},hosts={},errors={})".format(self.name, len(self._hosts), len(self._recorded))
+
+    def _id(self, host: str) -> int:
+        _id = self._ids.get(host)
+        if _id is None:
+            _id = len(self._hosts)
+            self._ids[host] = _id
+            self._hosts.append(host)
+            self._count.append(0)
+            self._expire.append(0.0)
+            self._next_action.append(0.0)
+            self._next_notify.append(0.0)
+            self._status.append(200)
+            self._flags.append(0)
+        return _id
+
+    def apply(self, _results: List[Tuple[int, str]], now: float = None):
+        """
+        应用一个周期的全部结果，计数规则与HostRecord.update一致。
+        正常结果只会影响已有记录的主机，所以先筛出失败结果，再只遍历有记录的主机;
+        结果顺序与主机编号一致时(burst模式检测全部主机)按位置取结果，不需要查表
+        """
+        now = time.time() if now is None else now
+        ids, hosts, flags = self._ids, self._hosts, self._flags
+        count, expire, last = self._count, self._expire, self._status
+        max_failed, new_expire = self.max_failed, now + self.duration
+        aligned = len(_results) == len(hosts)
+        for i, (status, host) in [(i, result) for i, result in enumerate(_results) if result[0] > 400]:
+            _id = i if aligned and hosts[i] == host else ids.get(host)
+            if _id is None:
+                _id = self._id(host)
+                count, expire, last = self._count, self._expire, self._status
+            flag = flags[_id]
+            if flag & _RECORDED:
+                v = 0 if flag & _INACTIVE or count[_id] >= max_failed else 1
+                count[_id] = count[_id] + v if now <= expire[_id] else v
+            else:
+                count[_id] = 1
+                self._next_action[_id] = self._next_notify[_id] = now + self.auto_inter
+                flags[_id] = flag | _RECORDED
+                self._recorded[_id] = None
+            expire[_id] = new_expire
+            last[_id] = status
+        index = None
+        for _id in self._recorded:
+            if count[_id] <= 0:
+                continue
+            if aligned and _results[_id][1] == hosts[_id]:
+                status = _results[_id][0]
+            else:
+                if index is None:
+                    index = {host: status for status, host in _results}
+                status = index.get(hosts[_id], 0)
+            if 0 < status <= 400:
+                count[_id] = count[_id] - 1 if now <= expire[_id] else 0
+                expire[_id] = new_expire
+
+    async def update(self, _results: List[Tuple[int, str]]):
+        self.apply(_results)
+
+    def export_state(self) -> List[HostState]:
+        return [(self._hosts[_id], self._count[_id], self._expire[_id], self._next_action[_id],
+                 self._next_notify[_id], self._status[_id], bool(self._flags[_id] & _INACTIVE))
+                for _id in self._recorded]
+
+    def restore_state(self, states: List[HostState]):
+        for host, count, expire, next_action, next_notify, status, inactive in states:
+            _id = self._id(host)
+            self._count[_id] = count
+            self._expire[_id] = expire
+            self._next_action[_id] = next_action
+            self._next_notify[_id] = next_notify
+            self._status[_id] = status
+            self._flags[_id] = _RECORDED | _INACTIVE if inactive else _RECORDED
+            self._recorded[_id] = None
+            if inactive:
+                self._inactive.add(_id)
+
+    def update_servers(self, servers: Set[str], removed: Set[str]):
+        """新增的主机分配编号，移除的主机清除记录，编号保留，主机重新加入时复用"""
+        for host in servers:
+            self._id(host)
+        for host in removed:
+            _id = self._ids.get(host)
+            if _id is None:
+                continue
+            self._count[_id] = 0
+            self._flags[_id] = 0
+            self._recorded.pop(_id, None)
+            self._inactive.discard(_id)
+        if not self.conf.max_inactive:
+            self.max_inactive = len(servers) // 2
+
+    def action_done(self, host: str, ok: bool, now: float = None):
+        """与SiteRecord.action_done一致"""
+        _id = self._ids.get(host)
+        if _id is None or _id not in self._inactive:
+            return
+        self._next_action[_id] = (time.time() if now is None else now) + self.auto_inter
+        log.info(f"{host}恢复动作结束, 结果{ok}")
+
+    def _sync_quorum(self, now: float) -> bool:
+        """与SiteRecord._sync_quorum一致"""
+        if self.quorum is None:
+            return True
+        inactive = {self._hosts[_id] for _id in self._inactive}
+        leader, adopt, release = self.quorum.sync(self.name, inactive)
+        for host in adopt & set(self.conf.servers):
+            log.info("{}由其他实例下线，由本实例接管".format(host))
+            _id = self._id(host)
+            if not self._flags[_id] & _RECORDED:
+                self._count[_id] = 0
+                self._status[_id] = 0
+                self._next_notify[_id] = now + self.auto_inter
+            self._count[_id] = max(self._count[_id], self.max_failed)
+            self._expire[_id] = now + self.duration
+            self._next_action[_id] = now + self.auto_inter
+            self._flags[_id] = _RECORDED | _INACTIVE
+            self._recorded[_id] = None
+            self._inactive.add(_id)
+        for host in release:
+            log.info("{}已由站点的leader实例接管".format(host))
+            _id = self._ids[host]
+            self._flags[_id] &= ~_INACTIVE
+            self._inactive.discard(_id)
+        return leader
+
+    def _inactive_count(self) -> int:
+        if self.quorum is None:
+            return len(self._inactive)
+        return self.quorum.inactive_count(self.name, {self._hosts[_id] for _id in self._inactive})
+
+    def get_state(self, host: str) -> str:
+        _id = self._ids.get(host)
+        if _id is None:
+            return "healthy"
+        if self._flags[_id] & _INACTIVE:
+            return "offline"
+        if self._flags[_id] & _RECORDED and self._count[_id] > 0:
+            return "suspect"
+        return "healthy"
+
+    def get_failed_hosts(self) -> Set[str]:
+        return {self._hosts[_id] for _id in self._recorded if self._count[_id] >= self.max_failed}
+
+    def get_error_hosts(self) -> Set[str]:
+        results = self.get_failed_hosts()
+        results.update(self._hosts[_id] for _id in self._inactive)
+        return results
+
+    def transitions(self, now: float = None) -> List[ErrorRecord]:
+        """只遍历有记录的主机，得到本周期的下线/通知/上线结果"""
+        now = time.time() if now is None else now
+        results: List[ErrorRecord] = list()
+        leader = self._sync_quorum(now)
+        count, flags, status = self._count, self._flags, self._status
+        for _id in list(self._recorded):
+            host = self._hosts[_id]
+            if not leader and flags[_id] & _INACTIVE:
+                # 已下线的主机等待站点的leader实例接管
+                continue
+            if count[_id] >= self.max_failed:
+                if flags[_id] & _INACTIVE:
+                    if now >= self._next_action[_id]:
+                        self._next_action[_id] = now + self.auto_inter
+                        results.append(ErrorRecord(host, status[_id], "offline"))
+                elif self.quorum is not None and not self.quorum.allow_offline(self.name, host):
+                    continue
+                elif self.max_inactive >= self._inactive_count() + 1:
+                    log.info("{}满足条件：下线主机数在范围内".format(host))
+                    self._next_action[_id] = now + self.auto_inter
+                    flags[_id] |= _INACTIVE
+                    self._inactive.add(_id)
+                    results.append(ErrorRecord(host, status[_id], "offline"))
+                elif now >= self._next_notify[_id]:
+                    self._next_notify[_id] = now + self.auto_inter
+                    results.append(ErrorRecord(host, status[_id], "notify"))
+            elif count[_id] == 0:
+                if flags[_id] & _INACTIVE:
+                    if self.quorum is not None and self.quorum.handing_over(self.name, host):
+                        continue
+                    log.info("{}之前异常，现在恢复。将执行上线".format(host))
+                    self._inactive.discard(_id)
+                    results.append(ErrorRecord(host, status[_id], "online"))
+                flags[_id] = 0
+                del self._recorded[_id]
+        if self.quorum is not None:
+            self.quorum.set_inactive(self.name, {self._hosts[_id] for _id in self._inactive})
+        return results
+
+    async def get_results(self) -> List[ErrorRecord]:
+        return self.transitions()
+
+
+class RecordFactory(_Single):
+    @staticmethod
+    def create_record(site_conf: SiteConfig):
+        if site_conf.record_store == "array":
+            return ArraySiteRecord(site_conf)
+        return SiteRecord(site_conf)
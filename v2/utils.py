@@ -2,11 +2,14 @@ import time
 import asyncio
 import logging
 import logging.handlers
-from typing import List, Dict
+from typing import List, Dict, Hashable
 from abc import ABCMeta, abstractmethod
 
 import aiohttp
 
+# 通知接口的超时(秒)，结果处理不受检测的deadline约束，通知不能无限等待
+NOTIFY_TIMEOUT = 10
+
 
 class _Single(metaclass=ABCMeta):
     _instance = None
@@ -76,6 +79,23 @@ class AbstractAsyncNotifies(metaclass=ABCMeta):
 _log = SimpleLog(__name__).log
 
 
+def install_event_loop(name: str) -> str:
+    """
+    安装事件循环实现，返回实际使用的实现名称。
+    uvloop为可选依赖，未安装时回退到asyncio默认实现
+    """
+    if name == "uvloop":
+        try:
+            import uvloop
+        except ImportError:
+            _log.warning("uvloop未安装，使用asyncio默认事件循环")
+            return "asyncio"
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        return "uvloop"
+    asyncio.set_event_loop_policy(None)
+    return "asyncio"
+
+
 class _AsyncDDingNotify(AbstractAsyncNotify):
     _send_fmt = "https://oapi.dingtalk.com/robot/send?access_token={token}"
 
@@ -89,7 +109,8 @@ class _AsyncDDingNotify(AbstractAsyncNotify):
                 'content': msg
             }
         }
-        async with aiohttp.request('POST', self.send_api, json=msgs) as resp:
+        async with aiohttp.request('POST', self.send_api, json=msgs,
+                                   timeout=aiohttp.ClientTimeout(total=NOTIFY_TIMEOUT)) as resp:
             try:
                 if resp.status == 200 and resp.headers.get("Content-Type", "") == "application/json":
                     response = await resp.json()
@@ -160,5 +181,56 @@ class HostRecord(AbstractHostRecord):
         if self.is_valid():
             self.count += v
         else:
-            self.count = v
+            # 过期后重新计数，成功不会让计数变为负数
+            self.count = max(v, 0)
         self.expire_time = time.time() + self.duration
+
+
+class TimerWheel(object):
+    """
+    哈希时间轮: 按resolution秒分成slots个槽，定时器放入到期时间所在的槽，
+    超过一圈的定时器留在槽中等下一圈。每个key只保留最后一次设置的到期时间，
+    expire只扫描上次调用以来经过的槽
+    """
+    def __init__(self, resolution: float = 1.0, slots: int = 512):
+        self.resolution = resolution
+        self._slots: List[List[Hashable]] = [list() for _ in range(slots)]
+        self._deadlines: Dict[Hashable, float] = dict()
+        self._tick = int(time.time() // resolution)
+
+    def __repr__(self) -> str:
+        return f"TimerWheel(timers={len(self._deadlines)})"
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def schedule(self, key: Hashable, when: float):
+        self._deadlines[key] = when
+        # 已经到期的放入当前槽，下次expire时返回
+        tick = max(int(when // self.resolution), self._tick)
+        self._slots[tick % len(self._slots)].append(key)
+
+    def cancel(self, key: Hashable):
+        self._deadlines.pop(key, None)
+
+    def expire(self, now: float) -> List[Hashable]:
+        due: List[Hashable] = list()
+        tick = int(now // self.resolution)
+        # 最多扫描一圈
+        for _tick in range(self._tick, min(tick, self._tick + len(self._slots) - 1) + 1):
+            index = _tick % len(self._slots)
+            keep: List[Hashable] = list()
+            kept = set()
+            for key in self._slots[index]:
+                when = self._deadlines.get(key)
+                if when is None:
+                    continue
+                if when <= now:
+                    due.append(key)
+                    del self._deadlines[key]
+                elif int(when // self.resolution) % len(self._slots) == index and key not in kept:
+                    keep.append(key)
+                    kept.add(key)
+            self._slots[index] = keep
+        self._tick = max(tick, self._tick)
+        return due
@@ -0,0 +1,145 @@
+import time
+from array import array
+
+from config import SiteConfig
+from utils import AbstractHostRecord, _Single
+
+# 时间窗口单个分片的最大计数
+MAX_SLOT_COUNT = 0xFFFF
+
+
+class CountWindow(object):
+    """最近size次检测中的失败次数，环形数组每次检测占一个字节"""
+    def __init__(self, size: int):
+        self._ring = bytearray(size)
+        self._pos = 0
+        self.failures = 0
+
+    def __repr__(self) -> str:
+        return f"CountWindow({self.failures}/{len(self._ring)})"
+
+    def push(self, failed: bool, now: float):
+        v = 1 if failed else 0
+        self.failures += v - self._ring[self._pos]
+        self._ring[self._pos] = v
+        self._pos = (self._pos + 1) % len(self._ring)
+
+    def count(self, now: float) -> int:
+        return self.failures
+
+    def next_expire(self) -> float:
+        # 计数只随检测变化
+        return 0.0
+
+    def last_expire(self) -> float:
+        return float("inf")
+
+
+class TimeWindow(object):
+    """
+    最近duration秒内的失败次数，按width秒分片的环形计数，
+    过期的分片清零后复用，维护总数，不保存单次检测
+    """
+    def __init__(self, duration: int, width: int):
+        self.width = width
+        self._slots = array("H", bytes(2 * max(1, -(-duration // width))))
+        self._epoch = -1
+        self.failures = 0
+
+    def __repr__(self) -> str:
+        return f"TimeWindow({self.failures}/{len(self._slots) * self.width}s)"
+
+    def _advance(self, now: float) -> int:
+        epoch = int(now // self.width)
+        if self._epoch < 0:
+            self._epoch = epoch
+        # 最多清空一圈，之后的分片都已过期
+        for _epoch in range(self._epoch + 1, min(epoch, self._epoch + len(self._slots)) + 1):
+            index = _epoch % len(self._slots)
+            self.failures -= self._slots[index]
+            self._slots[index] = 0
+        self._epoch = max(epoch, self._epoch)
+        return self._epoch % len(self._slots)
+
+    def push(self, failed: bool, now: float):
+        index = self._advance(now)
+        if failed and self._slots[index] < MAX_SLOT_COUNT:
+            self._slots[index] += 1
+            self.failures += 1
+
+    def count(self, now: float) -> int:
+        self._advance(now)
+        return self.failures
+
+    def next_expire(self) -> float:
+        """最早的失败所在分片移出窗口的时间，窗口内没有失败时为0"""
+        size = len(self._slots)
+        for _epoch in range(self._epoch - size + 1, self._epoch + 1):
+            if self._slots[_epoch % size]:
+                return float((_epoch + size) * self.width)
+        return 0.0
+
+    def last_expire(self) -> float:
+        """最后一次失败所在分片移出窗口的时间，窗口内没有失败时为0"""
+        size = len(self._slots)
+        for _epoch in range(self._epoch, self._epoch - size, -1):
+            if self._slots[_epoch % size]:
+                return float((_epoch + size) * self.width)
+        return 0.0
+
+
+class WindowHostRecord(AbstractHostRecord):
+    """
+    与HostRecord接口相同，count为窗口内的准确失败次数:
+    update(v)中v>0记一次失败，否则记一次成功，窗口内没有失败时count为0
+    """
+    def __init__(self, window, auto_interval: int):
+        self.window = window
+        self.next_action_time = time.time() + auto_interval
+        self.next_notify_time = time.time() + auto_interval
+        self._last_status = 200
+
+    def __repr__(self) -> str:
+        return f"WindowHostRecord({self.window})"
+
+    @property
+    def count(self) -> int:
+        return self.window.count(time.time())
+
+    @property
+    def last_status(self) -> int:
+        return self._last_status
+
+    def set_status(self, status: int) -> None:
+        self._last_status = status
+
+    def is_valid(self) -> bool:
+        return self.count > 0
+
+    def is_action(self) -> bool:
+        return time.time() >= self.next_action_time
+
+    def is_notify(self) -> bool:
+        return time.time() >= self.next_notify_time
+
+    def update(self, v: int) -> None:
+        self.window.push(v > 0, time.time())
+
+    def next_expire_time(self) -> float:
+        """计数下次因时间减少的时间，为0时计数不会随时间变化"""
+        return self.window.next_expire()
+
+    @property
+    def expire_time(self) -> float:
+        """计数因时间归零的时间，与HostRecord.expire_time对应，count窗口不随时间过期，为inf"""
+        return self.window.last_expire()
+
+
+class WindowFactory(_Single):
+    @staticmethod
+    def create_record(site_conf: SiteConfig) -> WindowHostRecord:
+        if site_conf.window == "count":
+            window = CountWindow(site_conf.window_size)
+        else:
+            window = TimeWindow(site_conf.duration, site_conf.check_interval)
+        return WindowHostRecord(window, site_conf.auto_interval)